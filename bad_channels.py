@@ -0,0 +1,161 @@
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+import spikeinterface as si
+import spikeinterface.preprocessing as spre
+
+from jobs import Cancelled
+from probe import channel_neighbors
+
+
+class BadChannelAnalysis:
+    """
+    The neighborhood_r2 method of spre.detect_bad_channels, with its intermediate results cached.
+
+    The highpass filtered random chunks are kept for each (highpass_filter_cutoff, num_random_chunks,
+    chunk_duration_s, seed) and the r2 of every channel with its neighbors for each radius on top of them,
+    so sweeping the threshold only compares numbers and changing the radius doesn't read the data again.
+    The chunks are of all the channels, removing channels beforehand selects their columns.
+
+    With the same seed the results are identical to spre.detect_bad_channels. Its default seed is None,
+    i.e. different chunks at every call, here it's 0 so that the cache is meaningful.
+
+    :param recording: the recording to analyze
+    """
+
+    def __init__(self, recording: si.BaseRecording):
+        self.recording = recording
+        self.chunks = {}
+        self.r2s = {}
+        self.lock = threading.Lock()
+
+    def random_chunks(self, highpass_filter_cutoff=300, num_random_chunks=10, chunk_duration_s=.3, seed=0,
+                      progress=None, cancel=None):
+        """
+        The highpass filtered random chunks, centered by the median of each channel.
+        They are drawn like si.get_random_data_chunks, but read one by one to report the progress.
+
+        :param progress: called as progress(done, total) after each chunk read
+        :param cancel: a threading.Event, checked before each chunk, raising Cancelled when set
+        """
+        key = (highpass_filter_cutoff, num_random_chunks, chunk_duration_s, seed)
+        with self.lock:
+            if key not in self.chunks:
+                re = self.recording
+                if not re.is_filtered():
+                    re = spre.highpass_filter(re, freq_min=highpass_filter_cutoff)
+                chunk_size = int(chunk_duration_s * re.get_sampling_frequency())
+                if any(chunk_size > re.get_num_samples(i) for i in range(re.get_num_segments())):
+                    raise ValueError('chunk_size is greater than the number of samples of a segment.')
+                rng = np.random.default_rng(seed)
+                starts = [(i, s) for i in range(re.get_num_segments()) for s in
+                          rng.integers(0, re.get_num_samples(i) - chunk_size, size=num_random_chunks)]
+                chunks = []
+                for i, s in starts:
+                    if cancel is not None and cancel.is_set():
+                        raise Cancelled()
+                    c = re.get_traces(segment_index=i, start_frame=s, end_frame=s + chunk_size, return_scaled=False)
+                    c = c.astype(np.float32, copy=False)
+                    chunks.append(c - np.median(c, axis=0, keepdims=True))
+                    if progress is not None:
+                        progress(len(chunks), len(starts))
+                self.chunks[key] = chunks
+            return self.chunks[key]
+
+    def r2(self, neighborhood_r2_radius_um=30., channel_ids=None, progress=None, cancel=None, **chunk_kwargs):
+        """
+        The squared median correlation of each channel with the median of its neighbors.
+
+        :param neighborhood_r2_radius_um: the radius under which two channels are neighbors
+        :param channel_ids: the channels left, by default all
+        :param progress: called as progress(done, total), reading the chunks is the first half and the
+            correlations the second
+        :param cancel: a threading.Event, checked before each chunk, raising Cancelled when set
+        :param chunk_kwargs: the arguments of random_chunks
+        :return: the r2 of the channels, nan for those without neighbors
+        """
+        if channel_ids is None:
+            channel_ids = self.recording.get_channel_ids()
+        chunk_kwargs = dict(dict(highpass_filter_cutoff=300, num_random_chunks=10, chunk_duration_s=.3, seed=0),
+                            **chunk_kwargs)
+        key = (tuple(chunk_kwargs.values()), neighborhood_r2_radius_um, tuple(str(i) for i in channel_ids))
+        if key in self.r2s:
+            return self.r2s[key]
+        half = None if progress is None else lambda done, total: progress(done, 2 * total)
+        chunks = self.random_chunks(progress=half, cancel=cancel, **chunk_kwargs)
+        indices = self.recording.ids_to_indices(channel_ids)
+
+        geom = self.recording.get_channel_locations()[indices]
+        num_channels = len(indices)
+        neighbors = channel_neighbors(geom, radius=neighborhood_r2_radius_um)
+        counts = np.array([len(n) for n in neighbors], dtype=int)
+        if num_channels > 0 and counts.min() < 1:
+            warnings.warn(f'neighborhood_r2_radius_um={neighborhood_r2_radius_um} led to channels with no '
+                          f'neighbors, which will not be marked as bad.')
+        # the channels grouped by their number of neighbors, so that each group takes a plain median
+        groups = []
+        for k in np.unique(counts[counts > 0]):
+            rows = np.flatnonzero(counts == k)
+            groups.append((rows, np.stack([neighbors[c] for c in rows])))
+
+        correlations = []
+        for i, chunk in enumerate(chunks):
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            chunk = chunk[:, indices]
+            # channels with no neighbors keep a nan median trace and get a nan r2
+            neighbmeans = np.full_like(chunk, np.nan)
+            for rows, index in groups:
+                neighbmeans[:, rows] = np.median(chunk[:, index], axis=2)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                denom = np.sqrt(np.nanmean(np.square(chunk), axis=0) * np.nanmean(np.square(neighbmeans), axis=0))
+                denom[denom == 0] = 1
+                correlations.append(np.nanmean(chunk * neighbmeans, axis=0) / denom)
+            if progress is not None:
+                progress(len(chunks) + i + 1, 2 * len(chunks))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            r2 = np.nanmedian(correlations, 0) ** 2 if correlations else np.full(num_channels, np.nan)
+        self.r2s[key] = r2
+        return r2
+
+    def detect(self, neighborhood_r2_threshold=0.9, neighborhood_r2_radius_um=30., channel_ids=None,
+               highpass_filter_cutoff=300, num_random_chunks=10, chunk_duration_s=.3, seed=0, progress=None,
+               cancel=None, **kwargs):
+        """
+        Detect the bad channels, a drop-in for spre.detect_bad_channels(recording, 'neighborhood_r2', ...).
+
+        :param channel_ids: the channels left, by default all
+        :param progress: called as progress(done, total) as the chunks are read and correlated
+        :param cancel: a threading.Event, checked before each chunk, raising Cancelled when set
+        :param kwargs: other arguments of spre.detect_bad_channels, unused by this method
+        :return: (bad channel ids, channel labels)
+        """
+        if channel_ids is None:
+            channel_ids = self.recording.get_channel_ids()
+        channel_ids = np.asarray(channel_ids)
+        r2 = self.r2(neighborhood_r2_radius_um, channel_ids, highpass_filter_cutoff=highpass_filter_cutoff,
+                     num_random_chunks=num_random_chunks, chunk_duration_s=chunk_duration_s, seed=seed,
+                     progress=progress, cancel=cancel)
+        # nan < x is False, channels without neighbors are kept
+        bad = r2 < neighborhood_r2_threshold
+        labels = np.full(len(channel_ids), 'good', dtype='U5')
+        labels[bad] = 'noise'
+        return channel_ids[bad], labels
+
+    def curve(self, thresholds=None, neighborhood_r2_radius_um=30., channel_ids=None, **chunk_kwargs):
+        """
+        The number of channels removed as a function of the threshold.
+
+        :param thresholds: the thresholds to evaluate, by default 0 to 1 by 0.01
+        :return: a series of the number of bad channels indexed by the threshold
+        """
+        if thresholds is None:
+            thresholds = np.linspace(0, 1, 101)
+        r2 = self.r2(neighborhood_r2_radius_um, channel_ids, **chunk_kwargs)
+        r2 = np.sort(r2[~np.isnan(r2)])
+        counts = np.searchsorted(r2, thresholds, side='left')
+        return pd.Series(counts, index=pd.Index(thresholds, name='threshold'), name='num_removed')
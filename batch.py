@@ -0,0 +1,237 @@
+import json
+import os
+import shutil
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from graphlib import TopologicalSorter
+from pathlib import Path
+
+import profiling
+from cache import make_key
+
+
+def _select(session, params, inputs, folder):
+    import spikeinterface as si
+    if session.get('store') is not None:
+        from rhd_store import read_store
+        re = read_store(session['store'])
+        if session.get('t1') is not None:
+            re = re.frame_slice(session['t1'], session['t2'])
+    else:
+        from rhd_selection import SignalSelector
+        stream_name = params.get('stream_name', 'RHD2000 amplifier channel')
+        s = SignalSelector(session['rhd_dir'], stream_name, n_jobs=params.get('n_jobs'))
+        re = s.choose_and_concat(session['t1'], session['t2'], stream_name)
+        if params.get('probe', 'my_probe') is not None:
+            from probe import get_probe
+            re = re.set_probe(get_probe(params.get('probe', 'my_probe')))
+    re.dump_to_json(folder / 'recording.json')
+    return si.load_extractor(folder / 'recording.json')
+
+
+def _preprocess(session, params, inputs, folder):
+    from preproc import preprocess
+    return preprocess(inputs['select'], folder=folder / 'recording', **params)
+
+
+def _sort(session, params, inputs, folder):
+    from kilosort import kilosort
+    if params.get('cache') is not None:
+        # the sortings are shared across batches, the stage only records where the output is
+        from cache import DiskCache
+        params = dict(params, cache=DiskCache(params['cache'], params.get('cache_budget', 200 * 2 ** 30)))
+        params.pop('cache_budget', None)
+        sorting = kilosort(inputs['preprocess'], **params)
+        (folder / 'sorter_output_folder.txt').write_text(sorting.get_annotation('sorter_output_folder'))
+        return _load_sort(folder)
+    kilosort(inputs['preprocess'], output_folder=folder / 'kilosort', **params)
+    return folder / 'kilosort'
+
+
+def _metrics(session, params, inputs, folder):
+    from cellexplorer import cell_metrics_gen
+    cell_metrics_gen(str(inputs['sort']), **params)
+
+
+def _load_select(folder):
+    import spikeinterface as si
+    return si.load_extractor(folder / 'recording.json')
+
+
+def _load_sort(folder):
+    if (folder / 'sorter_output_folder.txt').exists():
+        return Path((folder / 'sorter_output_folder.txt').read_text())
+    return folder / 'kilosort'
+
+
+def _load_preprocess(folder):
+    from preproc import load_preprocessed
+    return load_preprocessed(folder / 'recording')
+
+
+# name: (upstream stages, run(session, params, inputs, folder) -> output, load(folder) -> output)
+STAGES = {
+    'select': ([], _select, _load_select),
+    'preprocess': (['select'], _preprocess, _load_preprocess),
+    'sort': (['preprocess'], _sort, _load_sort),
+    'metrics': (['sort'], _metrics, lambda folder: None),
+}
+
+
+def stage_order(stages):
+    """
+    The stages to run and all their upstream stages, in dependency order.
+    """
+    graph, todo = {}, list(stages)
+    while todo:
+        s = todo.pop()
+        if s not in graph:
+            graph[s] = STAGES[s][0]
+            todo += STAGES[s][0]
+    return list(TopologicalSorter(graph).static_order())
+
+
+def run_session(session, params, folder, force=()):
+    """
+    Run the stages of one session, skipping those whose checkpoint matches their parameters and inputs.
+
+    Each stage writes into its own subfolder, and its checkpoint.json is written last, so a stage interrupted
+    or failed is run again from scratch next time, and so are the stages downstream of one that runs.
+
+    :param session: the session from the manifest, with a 'name', the source ('rhd_dir', 't1', 't2' or 'store')
+        and optionally the 'stages' to run and per-stage parameter overrides under 'params'
+    :param params: the parameters of each stage, merged with the overrides of the session
+    :param folder: the output folder of the session
+    :param force: stages to run even if checkpointed
+    :return: the summary of the session
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    source = {k: session.get(k) for k in ('rhd_dir', 't1', 't2', 'store')}
+    summary = {'name': session['name'], 'status': 'done', 'stages': {}}
+    keys, outputs, ran = {}, {}, set()
+    for stage in stage_order(session.get('stages', STAGES)):
+        upstream, run, load = STAGES[stage]
+        p = dict(params.get(stage, {}), **session.get('params', {}).get(stage, {}))
+        # the number of threads doesn't change the outputs, a session admitted with other cpus keeps its checkpoints
+        keys[stage] = make_key(stage, {k: v for k, v in p.items() if k != 'n_jobs'}, [keys[u] for u in upstream],
+                               source if not upstream else None)
+        stage_folder = folder / stage
+        checkpoint = stage_folder / 'checkpoint.json'
+        info = {'key': keys[stage]}
+        if stage not in force and not ran.intersection(upstream) and checkpoint.exists() and \
+                json.loads(checkpoint.read_text())['key'] == keys[stage]:
+            outputs[stage] = load(stage_folder)
+            info['status'] = 'checkpointed'
+            summary['stages'][stage] = info
+            continue
+
+        shutil.rmtree(stage_folder, ignore_errors=True)
+        stage_folder.mkdir(parents=True)
+        ran.add(stage)
+        t = time.perf_counter()
+        try:
+            with profiling.stage(stage, session=session['name']):
+                outputs[stage] = run(session, p, {u: outputs[u] for u in upstream}, stage_folder)
+        except Exception as e:
+            info.update(status='failed', seconds=time.perf_counter() - t, error=f'{type(e).__name__}: {e}',
+                        traceback=traceback.format_exc())
+            summary['stages'][stage] = info
+            summary['status'] = 'failed'
+            break
+        info.update(status='done', seconds=time.perf_counter() - t, finished=time.time())
+        checkpoint.write_text(json.dumps(info, indent=2))
+        summary['stages'][stage] = info
+    # the workers of run_batch don't run the exit hooks
+    profiling.save()
+    return summary
+
+
+def total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def run_batch(manifest, cpus=None, memory=None, force=(), verbose=True):
+    """
+    Run the sessions of a manifest concurrently in a process pool.
+
+    The manifest is a json file or dict like
+    {"output": "data/batch", "params": {"preprocess": {...}, "sort": {...}},
+     "sessions": [{"name": "day1", "rhd_dir": "data/day1", "t1": 0, "t2": 36000000, "cpus": 4, "memory_gb": 8}]}.
+    A session is started only when its cpus and memory_gb fit in what the running sessions leave.
+
+    :param manifest: the manifest
+    :param cpus: the cores to use, by default all
+    :param memory: the memory to use in bytes, by default the physical memory
+    :param force: stages to run even if checkpointed
+    :return: the run summary, also saved as run_summary.json in the output folder
+    """
+    if not isinstance(manifest, dict):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    output = Path(manifest.get('output', 'data/batch'))
+    output.mkdir(parents=True, exist_ok=True)
+    cpus = cpus or os.cpu_count() or 1
+    memory = memory or total_memory() or float('inf')
+    params = manifest.get('params', {})
+    sessions = manifest['sessions']
+    assert len({s['name'] for s in sessions}) == len(sessions), 'Session names must be unique.'
+
+    def demand(s):
+        return min(s.get('cpus', 1), cpus), min(s.get('memory_gb', 0) * 2 ** 30, memory)
+
+    summary = {'started': time.time(), 'cpus': cpus, 'memory': memory, 'sessions': {}}
+    pending, running = list(sessions), {}
+    used_cpus, used_memory = 0, 0
+    with ProcessPoolExecutor(min(cpus, len(sessions)) or 1) as pool:
+        while pending or running:
+            # start the sessions in manifest order while they fit, at least one is always running
+            while pending:
+                c, m = demand(pending[0])
+                if running and (used_cpus + c > cpus or used_memory + m > memory):
+                    break
+                s = pending.pop(0)
+                # preprocess runs on the cores admitted for the session, not all those of the machine
+                p = dict(params, preprocess=dict(params.get('preprocess', {}), n_jobs=c))
+                running[pool.submit(run_session, s, p, output / s['name'], force)] = (s, c, m)
+                used_cpus, used_memory = used_cpus + c, used_memory + m
+                if verbose:
+                    print(f"batch: started {s['name']}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                s, c, m = running.pop(fut)
+                used_cpus, used_memory = used_cpus - c, used_memory - m
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    result = {'name': s['name'], 'status': 'failed', 'error': f'{type(e).__name__}: {e}', 'stages': {}}
+                summary['sessions'][s['name']] = result
+                if verbose:
+                    print(f"batch: {s['name']} {result['status']}")
+            with open(output / 'run_summary.json', 'w') as f:
+                json.dump(summary, f, indent=2, default=str)
+
+    summary['finished'] = time.time()
+    summary['status'] = 'done' if all(s['status'] == 'done' for s in summary['sessions'].values()) else 'failed'
+    with open(output / 'run_summary.json', 'w') as f:
+        json.dump(summary, f, indent=2, default=str)
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the pipeline over the sessions of a manifest.')
+    parser.add_argument('manifest')
+    parser.add_argument('--cpus', type=int, default=None)
+    parser.add_argument('--memory-gb', type=float, default=None)
+    parser.add_argument('--force', nargs='*', default=[], choices=list(STAGES))
+    parser.add_argument('--profile', default=None, help='save a profile of the run to this json')
+    args = parser.parse_args()
+    if args.profile:
+        os.environ[profiling.ENV] = args.profile
+        profiling.enable(args.profile)
+    run_batch(args.manifest, args.cpus, args.memory_gb * 2 ** 30 if args.memory_gb else None, args.force)
@@ -0,0 +1,302 @@
+import datetime
+import json
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+BASELINE = Path(__file__).resolve().parent / 'benchmark_baseline.json'
+RHD_MAGIC = 0xC6912702
+RHD_BLOCK = 60
+RHD_GAIN = 0.195
+STAGES = ['scan', 'select', 'preprocess', 'bad_channels', 'mech_noise', 'preview', 'overview', 'sort', 'metrics']
+
+
+def _qstring(s):
+    data = s.encode('utf-16-le')
+    return struct.pack('<I', len(data)) + data
+
+
+def rhd_header(num_channels, fs):
+    """
+    The header of an RHD file of version 1.3 with num_channels amplifier channels, 64 per port.
+    """
+    h = struct.pack('<Ihhf', RHD_MAGIC, 1, 3, fs)
+    h += struct.pack('<hffffffhff', 1, 1., .1, 7500., 1., .1, 7500., 0, 1000., 1000.)
+    h += _qstring('') * 3
+    h += struct.pack('<hh', 0, 0)
+    ports = -(-num_channels // 64)
+    h += struct.pack('<h', ports)
+    for p in range(ports):
+        letter = chr(ord('A') + p)
+        n = min(64, num_channels - p * 64)
+        h += _qstring(f'Port {letter}') + _qstring(letter) + struct.pack('<hhh', 1, n, n)
+        for i in range(n):
+            name = f'{letter}-{i:03d}'
+            h += _qstring(name) + _qstring(name)
+            h += struct.pack('<hhhhhhhhhhff', i, i, 0, 1, i, p, 0, 0, 0, 0, 1e5, -45.)
+    return h
+
+
+def write_rhd(path, traces, fs, first_timestamp=0, header=None):
+    """
+    Write traces in uV as an RHD file read by se.read_intan, the frames beyond a multiple of 60 are dropped.
+
+    :param path: the .rhd file
+    :param traces: (frames, channels) in uV, or already as the uint16 codes of Intan
+    :param fs: the sampling frequency
+    :param first_timestamp: the sample index of the first frame
+    :param header: the header, to append blocks to an open file pass False
+    """
+    nb = len(traces) // RHD_BLOCK
+    traces = traces[: nb * RHD_BLOCK]
+    if traces.dtype != np.uint16:
+        traces = np.clip(np.rint(traces / RHD_GAIN) + 32768, 0, 65535).astype(np.uint16)
+    ts = np.arange(first_timestamp, first_timestamp + nb * RHD_BLOCK, dtype=np.int32).reshape(nb, RHD_BLOCK)
+    data = np.ascontiguousarray(traces.reshape(nb, RHD_BLOCK, -1).transpose(0, 2, 1))
+    blocks = np.concatenate([ts.view(np.uint8).reshape(nb, -1), data.view(np.uint8).reshape(nb, -1)], axis=1)
+    if header is False:
+        with open(path, 'ab') as f:
+            blocks.tofile(f)
+        return
+    with open(path, 'wb') as f:
+        f.write(header if header is not None else rhd_header(traces.shape[1], fs))
+        blocks.tofile(f)
+
+
+def bench_probe(num_channels):
+    """
+    A 4-column probe with 20 um pitch, the channels in order.
+    """
+    from probeinterface import generate_multi_columns_probe
+    probe = generate_multi_columns_probe(num_columns=4, num_contact_per_column=num_channels // 4, xpitch=20,
+                                         ypitch=20)
+    probe.set_device_channel_indices(np.arange(num_channels))
+    return probe
+
+
+def synthetic_session(folder, num_channels=64, duration=60., file_duration=60., fs=20000., noise_uv=10.,
+                      num_units=None, rate=5., amplitude_uv=150., artifact_interval=10., artifact_uv=800.,
+                      block_duration=1., seed=0):
+    """
+    Write an Intan-like session: one RHD file per file_duration named as the Intan software does, with gaussian
+    noise, spikes of units spread over the nearby channels and mechanical artifacts common to all channels.
+    The data is generated in blocks, so hours of 1024 channels fit in memory.
+
+    :param folder: the output folder
+    :param num_channels: the number of amplifier channels, a multiple of 4
+    :param duration: the duration in seconds
+    :param file_duration: the duration of each file
+    :param num_units: the number of units, by default a quarter of the channels
+    :param rate: the firing rate of each unit
+    :param artifact_interval: the mean interval in seconds between two artifacts
+    :return: the ground truth, a dict with the spike 'times' and 'units', the 'peak_channels' and 'artifacts'
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_units = num_channels // 4 if num_units is None else num_units
+    locations = bench_probe(num_channels).contact_positions
+    peaks = rng.choice(num_channels, num_units, replace=num_units > num_channels)
+    d = np.linalg.norm(locations[None] - locations[peaks][:, None], axis=2)
+    spread = [np.flatnonzero(i < 60) for i in d]
+    weights = [np.exp(-d[u, c] / 25.) for u, c in enumerate(spread)]
+    t = np.arange(int(2e-3 * fs)) / fs
+    template = -np.exp(-((t - .4e-3) / .15e-3) ** 2) + .35 * np.exp(-((t - .9e-3) / .3e-3) ** 2)
+    # the noise is taken at random offsets of a bank, much faster than drawing it all
+    bank = (rng.normal(size=(int(2 * fs), num_channels)) * noise_uv).astype(np.float32)
+    header = rhd_header(num_channels, fs)
+    # every file and block holds whole data blocks of RHD_BLOCK frames
+    block = int(block_duration * fs) // RHD_BLOCK * RHD_BLOCK
+    per_file = int(file_duration * fs) // RHD_BLOCK * RHD_BLOCK
+    total = int(duration * fs) // RHD_BLOCK * RHD_BLOCK
+    start = datetime.datetime(2023, 6, 23, 10, 0, 0)
+    truth_t, truth_u, artifacts = [], [], []
+    for f0 in range(0, total, per_file):
+        path = folder / f'bench_{start + datetime.timedelta(seconds=f0 / fs):%y%m%d_%H%M%S}.rhd'
+        path.write_bytes(header)
+        end = min(f0 + per_file, total)
+        for b0 in range(f0, end, block):
+            n = min(block, end - b0)
+            o = rng.integers(0, len(bank) - n)
+            tr = bank[o: o + n].copy()
+            for u in range(num_units):
+                s = np.flatnonzero(rng.random(n - len(t)) < rate / fs)
+                if len(s) > 0:
+                    amp = amplitude_uv * rng.uniform(.8, 1.2)
+                    np.add.at(tr, (s[:, None, None] + np.arange(len(t))[None, :, None], spread[u][None, None, :]),
+                              amp * template[None, :, None] * weights[u][None, None, :])
+                    truth_t.append(s + b0)
+                    truth_u.append(np.full(len(s), u))
+            if rng.random() < n / fs / artifact_interval and n > int(.1 * fs):
+                a = rng.integers(0, n - int(.1 * fs))
+                tr[a: a + int(.1 * fs)] += artifact_uv * np.sin(np.linspace(0, np.pi, int(.1 * fs)))[:, None]
+                artifacts.append(b0 + a)
+            write_rhd(path, tr, fs, b0, header=False)
+    order = np.argsort(np.concatenate(truth_t)) if truth_t else np.zeros(0, dtype=int)
+    return {'times': np.concatenate(truth_t)[order] if truth_t else np.zeros(0, dtype=int),
+            'units': np.concatenate(truth_u)[order] if truth_u else np.zeros(0, dtype=int),
+            'peak_channels': peaks, 'artifacts': np.array(artifacts)}
+
+
+def run_case(num_channels, duration, folder, file_duration=60., n_jobs=-1, verbose=True):
+    """
+    Time every stage of the pipeline on a synthetic session, with the threshold sorter and the native metrics
+    standing in for Kilosort and MATLAB.
+
+    :return: the seconds and the throughput in channel-seconds per second of each stage
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    from bad_channels import BadChannelAnalysis
+    from cell_metrics import process
+    from kilosort import kilosort, threshold_sorter
+    from mech_noise import interval_energy, noise_mask_from_energy
+    from preproc import preprocess
+    from preview import PreviewPipeline
+    from pyramid import get_pyramid, plot_timeseries
+    from rhd_selection import SignalSelector
+
+    folder = Path(folder)
+    t = time.perf_counter()
+    synthetic_session(folder / 'rhd', num_channels, duration, file_duration)
+    generated = time.perf_counter() - t
+    data = num_channels * duration
+    out = {}
+
+    def timed(stage, func):
+        t = time.perf_counter()
+        result = func()
+        out[stage] = {'seconds': time.perf_counter() - t}
+        out[stage]['throughput'] = data / out[stage]['seconds']
+        if verbose:
+            print(f'{num_channels} channels {duration:g}s {stage}: {out[stage]["seconds"]:.2f}s')
+        return result
+
+    # the selector scans the headers as it's made, without a catalog left from a previous run
+    for f in (folder / 'rhd').glob('catalog_*.csv'):
+        f.unlink()
+    s = timed('scan', lambda: SignalSelector(folder / 'rhd', n_jobs=n_jobs))
+    cat = s.catalog('RHD2000 amplifier channel')
+    total = int(cat['num_samples'].sum())
+    re = timed('select', lambda: s.choose_and_concat(0, total))
+    re = re.set_probe(bench_probe(num_channels))
+    pre = timed('preprocess', lambda: preprocess(re, folder=folder / 'preprocess', n_jobs=n_jobs))
+    timed('bad_channels', lambda: BadChannelAnalysis(pre).detect())
+    timed('mech_noise', lambda: noise_mask_from_energy(interval_energy(pre, n_jobs=n_jobs)))
+    params = {'mech': {'window': 2000, 'interval': 200, 'noise_cap': 2.5},
+              'butter': {'low': 300, 'high': 6000, 'order': 5, 'iterations': 1},
+              'reref': {'reference': 'global', 'operator': 'median'}}
+    timed('preview', lambda: PreviewPipeline(re).get_traces(params, 0, int(2 * re.get_sampling_frequency())))
+
+    def overview():
+        fig, ax = plt.subplots(figsize=(10, 6))
+        plot_timeseries(pre, ax, pyramid=get_pyramid(pre, folder / 'pyramid', n_jobs=n_jobs), width=1000)
+        fig.savefig(folder / 'overview.png')
+        plt.close(fig)
+
+    timed('overview', overview)
+    timed('sort', lambda: kilosort(pre, folder / 'sort', sorter=threshold_sorter, sorter_name='threshold'))
+    timed('metrics', lambda: process(folder / 'sort'))
+    out['generate'] = {'seconds': generated}
+    return out
+
+
+def compare(results, baseline, tolerance=.2):
+    """
+    The stages whose throughput fell below (1 - tolerance) of the baseline.
+
+    :return: a list of (case, stage, throughput, baseline throughput)
+    """
+    regressions = []
+    for case, stages in results.items():
+        for stage, r in stages.items():
+            b = baseline.get(case, {}).get(stage)
+            if b is not None and 'throughput' in r and r['throughput'] < b['throughput'] * (1 - tolerance):
+                regressions.append((case, stage, r['throughput'], b['throughput']))
+    return regressions
+
+
+def missing_baseline(results, baseline):
+    """
+    The stages timed without a baseline, compare can't tell whether they regressed.
+
+    :return: a list of (case, stage)
+    """
+    return [(case, stage) for case, stages in results.items() for stage, r in stages.items()
+            if 'throughput' in r and baseline.get(case, {}).get(stage) is None]
+
+
+def run_suite(channels=(64, 128, 256, 1024), durations=(60.,), file_duration=60., folder=None, baseline=BASELINE,
+              tolerance=.2, save_baseline=False, require_baseline=False, n_jobs=-1, verbose=True):
+    """
+    Run the cases, compare them with the baseline and optionally store them as the new baseline.
+    The baseline is of a machine, record one before comparing on another.
+
+    :param channels: the channel counts
+    :param durations: the durations in seconds, e.g. (60, 600, 3600)
+    :param folder: where the sessions are generated, by default a temporary folder removed after each case
+    :param baseline: the baseline json
+    :param tolerance: the fraction of the baseline throughput that may be lost
+    :param save_baseline: store the results as the baseline, merged with the cases it has
+    :param require_baseline: raise when stages have no baseline instead of warning, unless saving it
+    :param n_jobs: the processes of the stages, -1 for all the cores
+    :return: the results by case and the regressions
+    """
+    results = {}
+    for n in channels:
+        for d in durations:
+            case = f'{n}ch_{d:g}s'
+            work = Path(folder) / case if folder is not None else Path(tempfile.mkdtemp(prefix=f'bench_{case}_'))
+            try:
+                results[case] = run_case(n, d, work, file_duration, n_jobs, verbose)
+            finally:
+                if folder is None:
+                    shutil.rmtree(work, ignore_errors=True)
+    baseline = Path(baseline)
+    stored = json.loads(baseline.read_text()) if baseline.exists() else {'results': {}}
+    regressions = compare(results, stored['results'], tolerance)
+    missing = missing_baseline(results, stored['results'])
+    if missing and not save_baseline:
+        msg = (f'{len(missing)} stages of {sorted({c for c, _ in missing})} have no baseline in {baseline} and '
+               f'were not compared, record one on this machine with save_baseline (--save-baseline).')
+        if require_baseline:
+            raise ValueError(msg)
+        warnings.warn(msg)
+    if save_baseline:
+        stored['results'].update(results)
+        stored['machine'] = {'platform': platform.platform(), 'processor': platform.processor(),
+                             'cpu_count': os.cpu_count(), 'python': platform.python_version()}
+        stored['updated'] = time.time()
+        baseline.write_text(json.dumps(stored, indent=2))
+    if verbose:
+        for case, stage, r, b in regressions:
+            print(f'regression {case} {stage}: {r:.0f} channel-s/s, baseline {b:.0f}')
+    return results, regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Time the pipeline stages on synthetic Intan sessions.')
+    parser.add_argument('--channels', type=int, nargs='+', default=[64, 128, 256, 1024])
+    parser.add_argument('--durations', type=float, nargs='+', default=[60.], help='in seconds')
+    parser.add_argument('--file-duration', type=float, default=60.)
+    parser.add_argument('--folder', default=None, help='keep the sessions and outputs here')
+    parser.add_argument('--baseline', default=str(BASELINE))
+    parser.add_argument('--tolerance', type=float, default=.2)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--require-baseline', action='store_true', help='fail on the stages without a baseline')
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    args = parser.parse_args()
+    _, regressions = run_suite(args.channels, args.durations, args.file_duration, args.folder, args.baseline,
+                               args.tolerance, args.save_baseline, args.require_baseline, args.n_jobs)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+HEADER_BYTES = 1 << 16
+
+
+def file_signature(path):
+    """
+    Identify a source file by its size, modification time and a hash of its header.
+    """
+    path = Path(path)
+    st = path.stat()
+    with open(path, 'rb') as f:
+        header = hashlib.sha1(f.read(HEADER_BYTES)).hexdigest()
+    return {'name': path.name, 'size': st.st_size, 'mtime': st.st_mtime, 'header': header}
+
+
+PATH_KWARGS = ('file_path', 'file_paths', 'folder_path')
+
+
+def _describe(obj, key=None):
+    # turn the kwargs of a recording into something hashable, replacing files and arrays by their signature,
+    # only the path kwargs are looked up on disk so a channel id matching a file name stays a string
+    if isinstance(obj, dict):
+        return {str(k): _describe(v, k) for k, v in sorted(obj.items(), key=lambda i: str(i[0]))}
+    if isinstance(obj, (list, tuple)):
+        return [_describe(i, key) for i in obj]
+    if isinstance(obj, np.ndarray):
+        return {'shape': obj.shape, 'dtype': obj.dtype.str,
+                'sha1': hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()}
+    if key in PATH_KWARGS and isinstance(obj, (str, Path)) and os.path.isfile(obj):
+        return file_signature(obj)
+    if isinstance(obj, (np.generic, Path)):
+        return str(obj)
+    return obj
+
+
+def fingerprint_recording(recording):
+    """
+    A description of a recording that changes whenever its data would: the source files, the chain of
+    lazy operations with their parameters, the channels kept and the probe.
+
+    :param recording: a spikeinterface recording
+    :return: a json-serializable dict
+    """
+    d = recording.to_dict(recursive=True)
+    fp = {
+        'graph': _describe(d),
+        'channel_ids': [str(i) for i in recording.get_channel_ids()],
+        'num_samples': [recording.get_num_samples(i) for i in range(recording.get_num_segments())],
+        'sampling_frequency': recording.get_sampling_frequency(),
+    }
+    if recording.has_probe():
+        probe = recording.get_probe()
+        fp['probe'] = _describe(probe.to_numpy(complete=True))
+        fp['device_channel_indices'] = _describe(np.asarray(probe.device_channel_indices))
+    return fp
+
+
+def fingerprint_sorting(sorting):
+    """
+    A description of a sorting that changes whenever its spikes do: the units and a hash of their spike trains.
+
+    :param sorting: a spikeinterface sorting
+    :return: a json-serializable dict
+    """
+    h = hashlib.sha1()
+    for s in range(sorting.get_num_segments()):
+        for u in sorting.get_unit_ids():
+            h.update(str(u).encode())
+            h.update(np.asarray(sorting.get_unit_spike_train(u, segment_index=s), dtype=np.int64).tobytes())
+    return {'unit_ids': [str(u) for u in sorting.get_unit_ids()], 'num_segments': sorting.get_num_segments(),
+            'sampling_frequency': sorting.get_sampling_frequency(), 'spikes': h.hexdigest()}
+
+
+def make_key(*parts):
+    """
+    Hash any json-serializable parts into a cache key.
+    """
+    s = json.dumps(_describe(list(parts)), sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def folder_size(folder):
+    return sum(f.stat().st_size for f in Path(folder).rglob('*') if f.is_file())
+
+
+class DiskCache:
+    """
+    A content-addressed folder cache with least-recently-used eviction under a disk budget.
+
+    Each entry is a folder named by its key containing the stored output and a cache.json with its
+    description, size and access times.
+
+    :param root: the folder of the cache
+    :param budget: the maximum total size in bytes
+    """
+
+    def __init__(self, root, budget=50 * 2 ** 30):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+
+    def path(self, key):
+        return self.root / key
+
+    def info(self, key):
+        """
+        The description of an entry, or None if it's not cached.
+        """
+        meta = self.path(key) / 'cache.json'
+        if not meta.exists():
+            return None
+        with open(meta) as f:
+            return json.load(f)
+
+    def _write_info(self, key, info):
+        with open(self.path(key) / 'cache.json', 'w') as f:
+            json.dump(info, f, indent=2, default=str)
+
+    def get(self, key):
+        """
+        Look up an entry and mark it as used.
+
+        :return: the folder of the entry, or None on a miss
+        """
+        info = self.info(key)
+        if info is None:
+            return None
+        info['last_used'] = time.time()
+        info['hits'] = info.get('hits', 0) + 1
+        self._write_info(key, info)
+        return self.path(key)
+
+    def put(self, key, build, kind='', description=None):
+        """
+        Build an entry atomically: the output is written to a staging folder then moved in place.
+
+        :param key: the key from make_key
+        :param build: called as build(folder) to write the output into the empty folder
+        :param kind: a label of the entry, e.g. 'preprocess'
+        :param description: the parameters that made the key, kept for inspection
+        :return: the folder of the entry
+        """
+        staging = self.root / f'.staging-{uuid.uuid4().hex[:8]}'
+        staging.mkdir()
+        try:
+            build(staging)
+            now = time.time()
+            info = {'key': key, 'kind': kind, 'size': folder_size(staging), 'created': now, 'last_used': now,
+                    'hits': 0, 'description': description}
+            with open(staging / 'cache.json', 'w') as f:
+                json.dump(info, f, indent=2, default=str)
+            if self.path(key).exists():
+                shutil.rmtree(staging)
+            else:
+                os.replace(staging, self.path(key))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return self.path(key)
+
+    def list(self):
+        """
+        All the entries, the most recently used first.
+        """
+        rows = [self.info(p.name) for p in self.root.iterdir() if p.is_dir() and not p.name.startswith('.')]
+        tab = pd.DataFrame([r for r in rows if r is not None],
+                           columns=['key', 'kind', 'size', 'created', 'last_used', 'hits', 'description'])
+        for c in ('created', 'last_used'):
+            tab[c] = pd.to_datetime(tab[c], unit='s')
+        return tab.sort_values('last_used', ascending=False).set_index('key')
+
+    def total_size(self):
+        return int(self.list()['size'].sum())
+
+    def invalidate(self, key=None, kind=None):
+        """
+        Remove an entry, all the entries of a kind, or everything when no argument is given.
+        """
+        tab = self.list()
+        if key is not None:
+            tab = tab.loc[[key]] if key in tab.index else tab.iloc[:0]
+        if kind is not None:
+            tab = tab[tab['kind'] == kind]
+        for k in tab.index:
+            shutil.rmtree(self.path(k), ignore_errors=True)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits the budget.
+        """
+        tab = self.list()
+        total = tab['size'].sum()
+        for k in tab.index[::-1]:
+            if total <= self.budget:
+                break
+            if k == keep:
+                continue
+            shutil.rmtree(self.path(k), ignore_errors=True)
+            total -= tab.at[k, 'size']
@@ -0,0 +1,275 @@
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.stats
+from scipy.ndimage import convolve1d
+
+from jobs import get_n_jobs
+
+# the largest dense counts of a block, in bins
+BLOCK_BINS = 1 << 22
+
+_trains = None
+
+
+def _init(times, labels):
+    global _trains
+    _trains = times, labels
+
+
+def _block(a, b, num_units, bin_size, half):
+    # the CCGs of the reference units a..b-1 against the units from a on, walking the merged spike train
+    # away from each reference spike in both directions until it leaves the window
+    times, labels = _trains
+    window = (half + .5) * bin_size
+    num_bins = 2 * half + 1
+    counts = np.zeros((b - a) * num_units * num_bins, dtype=np.int64)
+    keys, pending = [], 0
+    ref0 = np.flatnonzero((labels >= a) & (labels < b))
+    for direction in (1, -1):
+        ref, i = ref0, 1
+        while len(ref) > 0:
+            other = ref + direction * i
+            inside = (other >= 0) & (other < len(times))
+            ref, other = ref[inside], other[inside]
+            lag = times[other] - times[ref]
+            inside = np.abs(lag) < window
+            # the spikes beyond the window stay beyond it for larger i
+            ref, other, lag = ref[inside], other[inside], lag[inside]
+            keep = labels[other] >= labels[ref]
+            if keep.any():
+                # bins centered on 0 and symmetric, so that the CCG of (b, a) is that of (a, b) reversed
+                k = (np.sign(lag[keep]) * np.floor(np.abs(lag[keep]) / bin_size + .5)).astype(np.int64) + half
+                rows = (labels[ref[keep]] - a) * num_units + labels[other[keep]]
+                keys.append(rows * num_bins + k)
+                pending += len(k)
+                # the keys are counted in batches, a bincount per step would sweep the whole block each time
+                if pending > len(counts) or pending > 1 << 24:
+                    counts += np.bincount(np.concatenate(keys), minlength=len(counts))
+                    keys, pending = [], 0
+            i += 1
+    if keys:
+        counts += np.bincount(np.concatenate(keys), minlength=len(counts))
+    counts = counts.reshape(-1, num_bins)
+    rows = np.flatnonzero(counts.any(axis=1))
+    counts = counts[rows]
+    dtype = np.uint16 if counts.max(initial=0) <= np.iinfo(np.uint16).max else np.int32
+    return a * num_units + rows, scipy.sparse.csr_matrix(counts.astype(dtype))
+
+
+class CCG:
+    """
+    The cross-correlograms of all the pairs of units, kept for the pairs a <= b only in a sparse
+    (pairs, bins) matrix, the row of (a, b) being a * num_units + b.
+
+    :param counts: the sparse counts
+    :param units: the unit ids
+    :param bin_size: the bin size in seconds
+    :param spike_count: the number of spikes of each unit
+    """
+
+    def __init__(self, counts, units, bin_size, spike_count):
+        self.counts = counts
+        self.units = np.asarray(units)
+        self.bin_size = bin_size
+        self.spike_count = spike_count
+        self.half = counts.shape[1] // 2
+
+    @property
+    def lags(self):
+        return np.arange(-self.half, self.half + 1) * self.bin_size
+
+    def get(self, a, b):
+        """
+        The CCG of unit b around the spikes of unit a, by unit index, positive lags when b fires after a.
+        """
+        if a <= b:
+            return self.counts[a * len(self.units) + b].toarray().ravel()
+        return self.counts[b * len(self.units) + a].toarray().ravel()[::-1]
+
+    def nbytes(self):
+        return self.counts.data.nbytes + self.counts.indices.nbytes + self.counts.indptr.nbytes
+
+
+def compute_ccg(times, labels, fs, bin_ms=.5, window_ms=25., n_jobs=-1, units=None):
+    """
+    The CCGs of all the pairs of units, computed by blocks of reference units in a process pool.
+
+    :param times: the spike times in frames
+    :param labels: the unit of each spike
+    :param fs: the sampling frequency
+    :param bin_ms: the bin size in ms
+    :param window_ms: the largest lag in ms, the CCGs have 2 * round(window_ms / bin_ms) + 1 bins
+    :param n_jobs: the number of processes, -1 for all the cores
+    :param units: the unit ids, by default the distinct labels
+    :return: a CCG
+    """
+    times = np.asarray(times).ravel().astype(np.int64)
+    labels = np.asarray(labels).ravel()
+    units, labels = np.unique(labels, return_inverse=True) if units is None else \
+        (np.asarray(units), np.searchsorted(units, labels))
+    order = np.argsort(times, kind='stable')
+    times, labels = times[order], labels[order]
+    n = len(units)
+    bin_size = bin_ms * fs / 1000
+    half = int(round(window_ms / bin_ms))
+    block = max(1, BLOCK_BINS // (n * (2 * half + 1)))
+    blocks = [(a, min(n, a + block)) for a in range(0, n, block)]
+    n_jobs = min(get_n_jobs(n_jobs), len(blocks))
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs, initializer=_init, initargs=(times, labels)) as pool:
+            results = list(pool.map(_block, *zip(*[(a, b, n, bin_size, half) for a, b in blocks])))
+    else:
+        _init(times, labels)
+        results = [_block(a, b, n, bin_size, half) for a, b in blocks]
+    rows = np.concatenate([r for r, _ in results])
+    stacked = scipy.sparse.vstack([m for _, m in results], format='csr') if results else \
+        scipy.sparse.csr_matrix((0, 2 * half + 1), dtype=np.int32)
+    # scatter the nonzero rows into the full pair index
+    counts = scipy.sparse.csr_matrix((stacked.data, stacked.indices,
+                                      np.concatenate([[0], np.cumsum(np.bincount(rows, np.diff(stacked.indptr),
+                                                                                 minlength=n * n))]).astype(np.int64)),
+                                     shape=(n * n, 2 * half + 1))
+    return CCG(counts, units, bin_ms / 1000, np.bincount(labels, minlength=n))
+
+
+def hollow_gaussian(bin_ms, sigma_ms=10., hollow=.6):
+    """
+    The partially hollowed gaussian of Stark & Abeles 2009, predicting the slow part of a CCG.
+    """
+    half = int(np.ceil(3 * sigma_ms / bin_ms))
+    x = np.arange(-half, half + 1) * bin_ms
+    k = np.exp(-x ** 2 / (2 * sigma_ms ** 2))
+    k[half] *= 1 - hollow
+    return k / k.sum()
+
+
+def monosynaptic_candidates(ccg: CCG, lag_ms=(.8, 2.8), alpha=.001, min_spikes=100, sigma_ms=10.,
+                            correction='fdr', rows_per_chunk=20000):
+    """
+    Screen all the pairs for excitatory monosynaptic connections as in English et al. 2017, used by CellExplorer:
+    a peak in the short-lag window both unlikely against the CCG smoothed by a hollow gaussian (p_fast),
+    and larger than the opposite lags (p_causal), both Poisson tests.
+
+    :param ccg: from compute_ccg
+    :param lag_ms: the window of the synaptic lag
+    :param alpha: the threshold of both p-values, corrected for the bins of the lag window
+    :param min_spikes: the pairs whose units fire less are skipped
+    :param sigma_ms: the width of the hollow gaussian
+    :param correction: for all the pairs tested, on the larger of the p-values, 'fdr' for Benjamini-Hochberg,
+        'bonferroni' or None for none, as in English et al.
+    :param rows_per_chunk: the pairs made dense at once
+    :return: a table of the candidates, with the presynaptic and postsynaptic unit ids, the lag in ms of the
+        peak, its count and both p-values
+    """
+    n = len(ccg.units)
+    bin_ms = ccg.bin_size * 1000
+    lags = np.arange(-ccg.half, ccg.half + 1) * bin_ms
+    causal = np.flatnonzero((lags >= lag_ms[0]) & (lags <= lag_ms[1]))
+    anticausal = np.flatnonzero((lags <= -lag_ms[0]) & (lags >= -lag_ms[1]))
+    kernel = hollow_gaussian(bin_ms, sigma_ms)
+    a, b = np.divmod(np.arange(n * n), n)
+    rows = np.flatnonzero((a < b) & (ccg.spike_count[a] >= min_spikes) & (ccg.spike_count[b] >= min_spikes)
+                          & (np.diff(ccg.counts.indptr) > 0))
+    out = []
+    tests = 0
+    for i in range(0, len(rows), rows_per_chunk):
+        r = rows[i: i + rows_per_chunk]
+        c = ccg.counts[r].toarray().astype(float)
+        pred = convolve1d(c, kernel, axis=1, mode='reflect')
+        # both directions, a -> b at positive lags and b -> a at negative ones
+        for pre, post, window, opposite in ((a[r], b[r], causal, anticausal), (b[r], a[r], anticausal, causal)):
+            peak = window[c[:, window].argmax(axis=1)]
+            count = c[np.arange(len(r)), peak]
+            slow = pred[np.arange(len(r)), peak]
+            # the peak is the largest of the bins of the window, so both p-values are Bonferroni corrected for
+            # them, and an empty opposite window is no evidence, the rate against it is floored to the slow one
+            p_fast = np.minimum(scipy.stats.poisson.sf(count - 1, slow) * len(window), 1)
+            p_causal = np.minimum(scipy.stats.poisson.sf(count - 1, np.maximum(c[:, opposite].max(axis=1), slow))
+                                  * len(window), 1)
+            hit = (p_fast < alpha) & (p_causal < alpha)
+            tests += len(r)
+            out.append(pd.DataFrame({'pre': ccg.units[pre[hit]], 'post': ccg.units[post[hit]],
+                                     'lag_ms': np.abs(lags[peak[hit]]), 'count': count[hit],
+                                     'p_fast': p_fast[hit], 'p_causal': p_causal[hit]}))
+    if not out:
+        return pd.DataFrame(columns=['pre', 'post', 'lag_ms', 'count', 'p_fast', 'p_causal'])
+    found = pd.concat(out, ignore_index=True)
+    p = np.maximum(found['p_fast'], found['p_causal']).to_numpy()
+    if correction == 'bonferroni':
+        found = found[p * tests < alpha]
+    elif correction == 'fdr':
+        # Benjamini-Hochberg over all the directed pairs tested, those above alpha can't pass so aren't kept
+        order = np.sort(p)
+        passed = np.flatnonzero(order <= np.arange(1, len(p) + 1) * alpha / max(tests, 1))
+        found = found[p <= order[passed[-1]]] if len(passed) > 0 else found.iloc[:0]
+    elif correction is not None:
+        raise ValueError(f'Unknown correction {correction!r}.')
+    return found.sort_values('p_fast', ignore_index=True)
+
+
+def kilosort_ccg(kilosort_folder, **kwargs):
+    """
+    The CCGs of the units of a Kilosort output, see compute_ccg.
+    """
+    from cell_metrics import load_kilosort
+    ks = load_kilosort(kilosort_folder)
+    return compute_ccg(ks['spike_times'], ks['spike_clusters'], ks['fs'], **kwargs)
+
+
+def synthetic_trains(num_units, duration=60., rate=5., fs=20000., num_connections=10, lag_ms=1.5, prob=.2, seed=0):
+    """
+    Poisson spike trains, with some pairs where a spike of the first unit makes the second fire after lag_ms.
+
+    :return: times in frames, labels and the (pre, post) connections
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(rate * duration, num_units)
+    labels = np.repeat(np.arange(num_units), counts)
+    times = rng.integers(0, int(duration * fs), len(labels))
+    pairs = rng.choice(num_units, (num_connections, 2), replace=False) if num_units >= 2 * num_connections else \
+        np.empty((0, 2), dtype=int)
+    extra_t, extra_l = [], []
+    for pre, post in pairs:
+        t = times[labels == pre]
+        t = t[rng.random(len(t)) < prob] + int(lag_ms * fs / 1000) + rng.integers(-3, 4, 1)[0]
+        extra_t.append(t)
+        extra_l.append(np.full(len(t), post))
+    times = np.concatenate([times] + extra_t)
+    labels = np.concatenate([labels] + extra_l)
+    return times, labels, pairs
+
+
+def benchmark(num_units=(100, 500, 2000), duration=60., rate=5., n_jobs=-1, **kwargs):
+    """
+    Time compute_ccg and monosynaptic_candidates on synthetic trains, with the size of the CCGs stored,
+    the peak memory of the processes, and the planted connections recovered against the false positives.
+
+    :return: a table by number of units
+    """
+    result = []
+    for n in num_units:
+        times, labels, pairs = synthetic_trains(n, duration, rate)
+        t = time.perf_counter()
+        ccg = compute_ccg(times, labels, 20000., n_jobs=n_jobs, **kwargs)
+        t_ccg = time.perf_counter() - t
+        t = time.perf_counter()
+        found = monosynaptic_candidates(ccg)
+        t_mono = time.perf_counter() - t
+        true = {tuple(p) for p in pairs}
+        recovered = sum((p, q) in true for p, q in zip(found['pre'], found['post']))
+        result.append({'units': n, 'spikes': len(times), 'ccg_s': t_ccg, 'mono_s': t_mono,
+                       'stored_mb': ccg.nbytes() / 2 ** 20,
+                       'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024,
+                       'connections': len(pairs), 'recovered': recovered, 'false_positives': len(found) - recovered})
+        print(result[-1])
+    return pd.DataFrame(result).set_index('units')
+
+
+if __name__ == '__main__':
+    print(benchmark())
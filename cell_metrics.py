@@ -0,0 +1,235 @@
+import runpy
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.io
+import scipy.sparse
+
+# the ACGs of CellExplorer: (bin size in ms, half window in ms)
+ACG_WIDE = (1., 500.)
+ACG_NARROW = (.5, 50.)
+REFRACTORY_MS = 2.
+# trough-to-peak in ms separating narrow interneurons from pyramidal cells, as in CellExplorer
+NARROW_TROUGH_TO_PEAK = .425
+
+
+def sorter_output(folder):
+    """
+    The folder holding the Kilosort files, either folder itself or its sorter_output subfolder.
+    """
+    folder = Path(folder)
+    if not (folder / 'spike_times.npy').exists() and (folder / 'sorter_output' / 'spike_times.npy').exists():
+        return folder / 'sorter_output'
+    return folder
+
+
+def load_kilosort(folder):
+    """
+    Memory map the Kilosort output.
+
+    :param folder: the Kilosort output folder or the folder holding its sorter_output
+    :return: a dict of the arrays, with the sampling frequency as 'fs'
+    """
+    folder = sorter_output(folder)
+
+    def load(name):
+        return np.load(folder / f'{name}.npy', mmap_mode='r')
+
+    out = {name: load(name) for name in
+           ('spike_times', 'spike_templates', 'templates', 'amplitudes', 'channel_map', 'channel_positions')}
+    out['spike_clusters'] = load('spike_clusters') if (folder / 'spike_clusters.npy').exists() \
+        else out['spike_templates']
+    out['fs'] = float(runpy.run_path(str(folder / 'params.py'))['sample_rate'])
+    return out
+
+
+def autocorrelograms(times, labels, num_units, bin_size, window):
+    """
+    The autocorrelograms of all the units at once. The spikes are sorted by unit and time, and the i-th next
+    spike of every spike is compared at once, for growing i until no pair is within the window.
+
+    :param times: the spike times in frames, sorted within each unit
+    :param labels: the unit index of each spike, sorted
+    :param num_units: the number of units
+    :param bin_size: the bin size in frames
+    :param window: the half window in frames
+    :return: the counts of each lag bin (units, 2 * half + 1), the bins centered on 0. As in CellExplorer's CCG,
+        a pair is binned by floor(lag / bin_size + 0.5) from both spikes, so the pairs closer than half a bin
+        are counted twice in the 0 lag and a spike is never paired with itself
+    """
+    half = int(round(window / bin_size))
+    # the positive and the negative lags of each pair, by the magnitude of their bin
+    pos = np.zeros(num_units * (half + 1), dtype=np.int64)
+    neg = np.zeros_like(pos)
+    i = 1
+    while i < len(times):
+        dt = times[i:] - times[:-i]
+        same = (labels[i:] == labels[:-i]) & (dt <= (half + .5) * bin_size)
+        if not same.any():
+            break
+        x = dt[same] / bin_size
+        lab = labels[i:][same] * (half + 1)
+        for counts, b in ((pos, np.floor(x + .5)), (neg, np.ceil(x - .5))):
+            b = b.astype(np.int64)
+            keep = b <= half
+            counts += np.bincount(lab[keep] + b[keep], minlength=len(counts))
+        i += 1
+    pos, neg = pos.reshape(num_units, half + 1), neg.reshape(num_units, half + 1)
+    return np.concatenate([neg[:, :0:-1], neg[:, :1] + pos[:, :1], pos[:, 1:]], axis=1)
+
+
+def unit_templates(templates, spike_clusters, spike_templates, units):
+    """
+    The template of each unit, the mean of the templates of its spikes, as units merged or split
+    after Kilosort span several templates.
+    """
+    rows = np.searchsorted(units, spike_clusters)
+    counts = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, np.asarray(spike_templates).ravel())),
+                                     shape=(len(units), templates.shape[0]))
+    counts = scipy.sparse.diags(1 / np.asarray(counts.sum(axis=1)).ravel()) @ counts
+    n_templates, n_samples, n_channels = templates.shape
+    return (counts @ np.asarray(templates).reshape(n_templates, -1)).reshape(len(units), n_samples, n_channels)
+
+
+def compute_cell_metrics(kilosort_folder, monosynaptic=False, n_jobs=-1):
+    """
+    The standard metrics of CellExplorer for all the units of a Kilosort output, without MATLAB.
+
+    The ACGs are those of CellExplorer, wide (1 ms bins, +-500 ms) and narrow (0.5 ms bins, +-50 ms) in Hz,
+    the inputs of its classification along with the burst index and trough-to-peak. The exponential fits
+    of the ACG are not computed, so the cell types come from the trough-to-peak only.
+
+    :param kilosort_folder: the Kilosort output folder or the folder holding its sorter_output
+    :param monosynaptic: also screen all the pairs for monosynaptic connections with ccg, as putativeConnections
+    :param n_jobs: the processes of the CCGs
+    :return: a dict of the metrics by field of cell_metrics, one value per unit
+    """
+    ks = load_kilosort(kilosort_folder)
+    fs = ks['fs']
+    times = np.asarray(ks['spike_times']).ravel().astype(np.int64)
+    clusters = np.asarray(ks['spike_clusters']).ravel()
+    units, labels = np.unique(clusters, return_inverse=True)
+    n = len(units)
+    order = np.lexsort((times, labels))
+    t, lab = times[order], labels[order]
+    spike_count = np.bincount(lab, minlength=n)
+    first = np.searchsorted(lab, np.arange(n))
+    last = first + spike_count - 1
+    span = (t[last] - t[first]) / fs
+
+    # intervals within each unit
+    isi = np.diff(t) / fs
+    same = lab[1:] == lab[:-1]
+    isi_lab = lab[1:][same]
+    isi = isi[same]
+    violations = np.bincount(isi_lab, isi < REFRACTORY_MS / 1000, minlength=n)
+    pair = (isi_lab[1:] == isi_lab[:-1])
+    a, b = isi[:-1][pair], isi[1:][pair]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cv2 = np.bincount(isi_lab[1:][pair], 2 * np.abs(b - a) / (a + b), minlength=n) / \
+            np.bincount(isi_lab[1:][pair], minlength=n)
+        firing_rate = np.where(span > 0, spike_count / span, np.nan)
+
+    acg = {}
+    for name, (bin_ms, half_ms) in (('wide', ACG_WIDE), ('narrow', ACG_NARROW)):
+        counts = autocorrelograms(t, lab, n, bin_ms * fs / 1000, half_ms * fs / 1000)
+        acg[name] = (counts / spike_count[:, None] / (bin_ms / 1000)).T
+    lags = np.arange(-ACG_WIDE[1], ACG_WIDE[1] + ACG_WIDE[0], ACG_WIDE[0])
+    burst = acg['wide'][(lags >= 3) & (lags <= 5)].mean(axis=0)
+    baseline = acg['wide'][(lags >= 40) & (lags <= 50)].mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        burst_index = (burst - baseline) / np.maximum(burst, baseline)
+
+    tpl = unit_templates(ks['templates'], clusters, ks['spike_templates'], units)
+    ptp = tpl.max(axis=1) - tpl.min(axis=1)
+    peak = ptp.argmax(axis=1)
+    waveform = tpl[np.arange(n), :, peak]
+    trough = waveform.argmin(axis=1)
+    frames = np.arange(waveform.shape[1])
+    after = np.where(frames >= trough[:, None], waveform, -np.inf).argmax(axis=1)
+    peak_before = np.where(frames <= trough[:, None], waveform, -np.inf).max(axis=1)
+    peak_after = waveform[np.arange(n), after]
+    trough_to_peak = (after - trough) / fs * 1000
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ab_ratio = (peak_after - peak_before) / (peak_after + peak_before)
+    # position from the 16 largest channels, weighted by their amplitude
+    top = np.argsort(ptp, axis=1)[:, -16:]
+    w = np.take_along_axis(ptp, top, axis=1)
+    w = w / np.maximum(w.sum(axis=1, keepdims=True), np.finfo(float).tiny)
+    pos = np.asarray(ks['channel_positions'])[top]
+    channel_map = np.asarray(ks['channel_map']).ravel()
+
+    metrics = {
+        'UID': np.arange(1, n + 1),
+        'cluID': units,
+        'spikeCount': spike_count,
+        'firingRate': firing_rate,
+        'cv2': cv2,
+        'refractoryPeriodViolation': 1000 * violations / spike_count,
+        'burstIndex_Royer2012': burst_index,
+        'troughToPeak': trough_to_peak,
+        'ab_ratio': ab_ratio,
+        'peakVoltage': ptp[np.arange(n), peak],
+        'maxWaveformCh': channel_map[peak],
+        'maxWaveformCh1': channel_map[peak] + 1,
+        'trilat_x': (w * pos[..., 0]).sum(axis=1),
+        'trilat_y': (w * pos[..., 1]).sum(axis=1),
+        'putativeCellType': np.where(trough_to_peak <= NARROW_TROUGH_TO_PEAK,
+                                     'Narrow Interneuron', 'Pyramidal Cell').astype(object),
+        'acg': acg,
+        'waveforms': {'filt': waveform.T, 'time': (frames - trough.mean()) / fs * 1000},
+        'sr': fs,
+    }
+    if monosynaptic:
+        from ccg import compute_ccg, monosynaptic_candidates
+        found = monosynaptic_candidates(compute_ccg(t, lab, fs, n_jobs=n_jobs, units=np.arange(n)))
+        # pairs of UIDs, as CellExplorer
+        metrics['putativeConnections'] = {'excitatory': found[['pre', 'post']].to_numpy(float) + 1,
+                                          'inhibitory': np.zeros((0, 2))}
+    return metrics
+
+
+def save_cell_metrics(metrics, basepath, basename=None):
+    """
+    Write the metrics as CellExplorer does, a cell_metrics struct in basepath/basename.cell_metrics.cellinfo.mat.
+
+    :param metrics: from compute_cell_metrics
+    :param basepath: the session folder
+    :param basename: the session name, by default the name of basepath
+    :return: the path of the file
+    """
+    basepath = Path(basepath).resolve()
+    basename = basename or basepath.name
+    metrics = dict(metrics)
+    n = len(metrics['UID'])
+    fs = metrics.pop('sr')
+    cell_metrics = {k: v.astype(float) if isinstance(v, np.ndarray) and v.dtype.kind in 'iub' else v
+                    for k, v in metrics.items()}
+    cell_metrics.update({
+        'sessionName': np.array([basename] * n, dtype=object),
+        'electrodeGroup': np.ones(n),
+        'spikeSortingMethod': np.array(['Kilosort'] * n, dtype=object),
+        'brainRegion': np.array(['Unknown'] * n, dtype=object),
+        'labels': np.array([''] * n, dtype=object),
+        'general': {'basename': basename, 'basepath': str(basepath), 'cellCount': float(n), 'sr': fs,
+                    'processinginfo': {'function': 'cell_metrics.compute_cell_metrics',
+                                       'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+                    'acgs': {'wide': {'binSize': ACG_WIDE[0], 'window': ACG_WIDE[1]},
+                             'narrow': {'binSize': ACG_NARROW[0], 'window': ACG_NARROW[1]}}},
+    })
+    path = basepath / f'{basename}.cell_metrics.cellinfo.mat'
+    scipy.io.savemat(path, {'cell_metrics': cell_metrics}, long_field_names=True, do_compression=True)
+    return path
+
+
+def process(kilosort_folder, basename=None, monosynaptic=False):
+    """
+    Compute the metrics of a Kilosort output and save them in its folder, the native counterpart of
+    cell_metrics_probe.m.
+
+    :return: the metrics
+    """
+    metrics = compute_cell_metrics(kilosort_folder, monosynaptic)
+    save_cell_metrics(metrics, kilosort_folder, basename)
+    return metrics
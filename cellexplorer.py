@@ -1,10 +1,223 @@
-import matlab.engine
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import profiling
 
-def cell_metrics_gen(kilosort_folder):
-    eng = matlab.engine.start_matlab() # can use a different way to connect to matlab
-    eng.cell_metrics_probe(kilosort_folder)
+
+class MatlabBackend:
+    """
+    Start MATLAB engines with CellExplorer on the path, or attach to shared MATLAB sessions.
+
+    :param shared_names: names of sessions shared with matlab.engine.shareEngine to attach to, one per engine,
+        new engines are started when there are more engines than names
+    :param paths: folders added recursively to the MATLAB path of each engine, e.g. CellExplorer and this repo
+    """
+
+    def __init__(self, shared_names=(), paths=()):
+        self.shared_names = list(shared_names)
+        self.paths = list(paths)
+
+    def start(self, index):
+        import matlab.engine
+        if index < len(self.shared_names):
+            eng = matlab.engine.connect_matlab(self.shared_names[index])
+        else:
+            eng = matlab.engine.start_matlab()
+        for p in self.paths:
+            eng.addpath(eng.genpath(str(p)), nargout=0)
+        return eng
+
+    def alive(self, eng):
+        try:
+            eng.eval('1;', nargout=0)
+            return True
+        except Exception:
+            return False
+
+    def stop(self, index, eng):
+        # shared sessions belong to their user
+        if index >= len(self.shared_names):
+            try:
+                eng.quit()
+            except Exception:
+                pass
+
+
+class MockEngine:
+    """
+    An engine calling Python functions in place of MATLAB ones, crashed by kill().
+    """
+
+    def __init__(self, functions):
+        self.functions = functions
+        self.dead = False
+
+    def kill(self):
+        self.dead = True
+
+    def __getattr__(self, name):
+        if name not in self.functions:
+            raise AttributeError(name)
+
+        def call(*args, nargout=1):
+            if self.dead:
+                raise RuntimeError('engine terminated')
+            return self.functions[name](*args)
+        return call
+
+
+class MockBackend:
+    """
+    A backend of MockEngines, to run the pool without MATLAB.
+
+    :param functions: the functions of the engines by name, e.g. {'cell_metrics_probe': cell_metrics.process}
+    :param startup: the seconds each engine takes to start
+    """
+
+    def __init__(self, functions, startup=0.):
+        self.functions = functions
+        self.startup = startup
+
+    def start(self, index):
+        time.sleep(self.startup)
+        return MockEngine(self.functions)
+
+    def alive(self, eng):
+        return not eng.dead
+
+    def stop(self, index, eng):
+        eng.kill()
+
+
+class EnginePool:
+    """
+    Long-lived engines shared by all the metric requests. The engines are started once, requests are queued
+    onto the free ones, and an engine found dead after a failed call is restarted and the call retried.
+
+    :param backend: MatlabBackend or MockBackend, by default a MatlabBackend
+    :param size: the number of engines
+    :param retries: how many times a call is retried on a restarted engine
+    """
+
+    def __init__(self, backend=None, size=1, retries=1):
+        self.backend = backend if backend is not None else MatlabBackend()
+        self.size = size
+        self.retries = retries
+        self.free = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = [{'index': i, 'calls': 0, 'failures': 0, 'restarts': 0, 'busy': False} for i in range(size)]
+        self.engines = [None] * size
+        with ThreadPoolExecutor(size) as pool:
+            self.engines = list(pool.map(self._start, range(size)))
+        for i in range(size):
+            self.free.put(i)
+        self.workers = ThreadPoolExecutor(size)
+
+    def _start(self, i):
+        with profiling.stage('engine_start', engine=i):
+            return self.backend.start(i)
+
+    def _restart(self, i):
+        self.backend.stop(i, self.engines[i])
+        self.engines[i] = self._start(i)
+        with self.lock:
+            self.stats[i]['restarts'] += 1
+
+    def _run(self, name, args, kwargs):
+        i = self.free.get()
+        with self.lock:
+            self.stats[i]['busy'] = True
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    with profiling.stage(name, engine=i):
+                        result = getattr(self.engines[i], name)(*args, **kwargs)
+                    with self.lock:
+                        self.stats[i]['calls'] += 1
+                    return result
+                except Exception:
+                    with self.lock:
+                        self.stats[i]['failures'] += 1
+                    if self.backend.alive(self.engines[i]):
+                        raise
+                    self._restart(i)
+                    if attempt == self.retries:
+                        raise
+        finally:
+            with self.lock:
+                self.stats[i]['busy'] = False
+            self.free.put(i)
+
+    def submit(self, name, *args, **kwargs):
+        """
+        Queue a call of a MATLAB function on the next free engine.
+
+        :return: a Future of the result
+        """
+        return self.workers.submit(self._run, name, args, kwargs)
+
+    def call(self, name, *args, **kwargs):
+        return self.submit(name, *args, **kwargs).result()
+
+    def health(self):
+        """
+        Check the idle engines, restarting the dead ones.
+
+        :return: the state of each engine, with its calls, failures and restarts, alive is None for the busy ones
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self.free.get_nowait())
+            except queue.Empty:
+                break
+        alive = {}
+        for i in idle:
+            alive[i] = self.backend.alive(self.engines[i])
+            if not alive[i]:
+                self._restart(i)
+            self.free.put(i)
+        # the stats are updated by the workers, copied under the lock for a consistent snapshot
+        with self.lock:
+            return [dict(self.stats[i], alive=alive.get(i)) for i in range(self.size)]
+
+    def close(self):
+        self.workers.shutdown()
+        for i, eng in enumerate(self.engines):
+            self.backend.stop(i, eng)
+
+
+_pool = None
+
+
+def get_pool(size=1, backend=None):
+    """
+    The pool shared by the calls of cell_metrics_gen, started the first time.
+    """
+    global _pool
+    if _pool is None:
+        _pool = EnginePool(backend, size)
+    return _pool
+
+
+def cell_metrics_gen(kilosort_folder, pool: EnginePool = None, native=False, monosynaptic=False):
+    """
+    Generate the cell metrics of a Kilosort output with CellExplorer.
+
+    :param kilosort_folder: the Kilosort output folder
+    :param pool: the engines to run cell_metrics_probe.m on, by default the shared pool of get_pool
+    :param native: compute the standard metrics with cell_metrics instead, without MATLAB
+    :param monosynaptic: with native, also screen the monosynaptic connections from the CCGs of ccg
+    :return: the cell metrics
+    """
+    if native:
+        from cell_metrics import process
+        return process(kilosort_folder, monosynaptic=monosynaptic)
+    eng = pool if pool is not None else get_pool()  # engines are started once and reused across sessions
+    return eng.call('cell_metrics_probe', str(kilosort_folder))
 
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    pass
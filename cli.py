@@ -0,0 +1,526 @@
+"""
+The command line of the pipeline, each subcommand importing only what it needs:
+
+    python cli.py ingest data data/store
+    python cli.py select data data/select --t1 200000 --t2 201000
+    python cli.py preprocess data/select data/preprocess --reference local
+    python cli.py qc data/preprocess --params qc.json --output data/qc
+    python cli.py report data/select data/preprocess data/report
+    python cli.py sort data/preprocess data/output
+    python cli.py metrics data/output --native
+    python cli.py run manifest.json
+
+With `python cli.py daemon` running, the subcommands are run by it, whose modules, recordings and MATLAB engines
+are already loaded, so they start in milliseconds. --no-daemon runs in the calling process anyway.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import profiling
+
+ADDRESS = r'\\.\pipe\linlab_probe_pipeline' if sys.platform == 'win32' else \
+    str(Path.home() / '.cache' / 'linlab_probe_pipeline' / 'daemon.sock')
+# the modules a daemon imports at start
+WARM_MODULES = ['numpy', 'pandas', 'scipy.signal', 'spikeinterface', 'spikeinterface.extractors',
+                'spikeinterface.preprocessing', 'spikeinterface.sorters', 'rhd_selection', 'rhd_store', 'preproc',
+                'kilosort', 'cellexplorer', 'cell_metrics', 'bad_channels', 'mech_noise', 'reference', 'batch',
+                'matplotlib.figure', 'qc_report']
+QCHECK_DIR = Path(__file__).resolve().parent / 'gui' / 'qcheck'
+
+# opened once per process, kept warm by the daemon
+_recordings = {}
+_selectors = {}
+_caches = {}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def open_recording(path):
+    """
+    Open a recording written by the pipeline: a preprocessed or streamed folder, an ingested store, or a folder
+    or json saved by spikeinterface. It's reused while its description file is unchanged.
+    """
+    path = Path(path).resolve()
+    for name in ('preprocess.json', 'store.json', 'recording.json', 'binary.json', 'si_folder.json', ''):
+        desc = path / name if name else path
+        if desc.is_file():
+            break
+    else:
+        raise FileNotFoundError(f'No recording in {path}.')
+    key = str(path), _mtime(desc)
+    if key not in _recordings:
+        if desc.name == 'preprocess.json':
+            if 'stream' in json.loads(desc.read_text()):
+                from streaming import load_stream
+                re = load_stream(path)
+            else:
+                from preproc import load_preprocessed
+                re = load_preprocessed(path)
+        elif desc.name == 'store.json':
+            from rhd_store import read_store
+            re = read_store(path)
+        else:
+            import spikeinterface as si
+            re = si.load_extractor(desc if desc.name == 'recording.json' else path)
+            if desc.name == 'recording.json' and (path / 'probe.json').exists():
+                from probeinterface import read_probeinterface
+                re = re.set_probegroup(read_probeinterface(path / 'probe.json'))
+        for k in [k for k in _recordings if k[0] == key[0]]:
+            del _recordings[k]
+        _recordings[key] = re
+    return _recordings[key]
+
+
+def get_selector(rhd_dir, stream_name):
+    from rhd_selection import SignalSelector
+    key = str(Path(rhd_dir).resolve()), stream_name
+    if key not in _selectors:
+        _selectors[key] = SignalSelector(rhd_dir, stream_name)
+    else:
+        _selectors[key].catalog(stream_name, refresh=True)
+    return _selectors[key]
+
+
+def get_cache(folder, budget_gb=200.):
+    if folder is None:
+        return None
+    from cache import DiskCache
+    key = str(Path(folder).resolve())
+    if key not in _caches:
+        _caches[key] = DiskCache(folder, budget_gb * 2 ** 30)
+    return _caches[key]
+
+
+def load_probe(value):
+    """
+    A probe of the registry by name, or a probeinterface json file.
+    """
+    if os.path.isfile(value):
+        from probeinterface import read_probeinterface
+        return read_probeinterface(value).probes[0]
+    from probe import get_probe
+    return get_probe(value)
+
+
+def load_params(value):
+    """
+    Keyword arguments given as a json file or a json string.
+    """
+    if value is None:
+        return {}
+    if os.path.isfile(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def cmd_ingest(args):
+    from rhd_store import ingest
+    probe = None if args.probe is None else load_probe(args.probe)
+    ingest(args.rhd_dir, args.store, args.stream_name, probe, args.n_jobs, verbose=True)
+
+
+def cmd_select(args):
+    # the range defaults to the whole session
+    t1 = 0 if args.t1 is None else args.t1
+    if (Path(args.source) / 'store.json').exists():
+        re = open_recording(args.source)
+        if args.t1 is not None or args.t2 is not None:
+            re = re.frame_slice(t1, re.get_num_samples() if args.t2 is None else args.t2)
+    else:
+        s = get_selector(args.source, args.stream_name)
+        t2 = int(s.catalog(args.stream_name)['num_samples'].sum()) if args.t2 is None else args.t2
+        re = s.choose_and_concat(t1, t2, args.stream_name)
+        if args.probe != 'none':
+            re = re.set_probe(load_probe(args.probe))
+    out = Path(args.output)
+    out.mkdir(parents=True, exist_ok=True)
+    re.dump_to_json(out / 'recording.json')
+    # the json doesn't keep the properties, the probe among them
+    if re.has_probe():
+        from probeinterface import write_probeinterface
+        write_probeinterface(out / 'probe.json', re.get_probegroup())
+    print(re)
+
+
+def cmd_preprocess(args):
+    from preproc import preprocess
+    re = preprocess(open_recording(args.recording), args.low, args.high, args.order, args.iterations, args.direction,
+                    None if args.reference == 'none' else args.reference, args.operator, tuple(args.local_radius),
+                    folder=args.output, n_jobs=args.n_jobs, chunk_duration=args.chunk_duration, verbose=True,
+                    cache=get_cache(args.cache))
+    if args.cache is not None:
+        print(f'preprocess: {re}')
+
+
+def _qcheck_path():
+    # the QCheck modules import each other as top-level modules, added once as the daemon runs many commands
+    if str(QCHECK_DIR) not in sys.path:
+        sys.path.append(str(QCHECK_DIR))
+
+
+def cmd_qc(args):
+    params = load_params(args.params)
+    re = open_recording(args.recording)
+    if args.gui:
+        from PySide6.QtWidgets import QApplication
+        _qcheck_path()
+        from entry import QCheck
+        app = QApplication.instance() or QApplication([])
+        widget = QCheck(re)
+        with open(QCHECK_DIR / 'style.qss') as f:
+            app.setStyleSheet(f.read())
+        widget.show()
+        app.exec()
+        return
+    _qcheck_path()
+    from utils import QC_STAGES, resolve_impedance_table, run_qc
+    impedance = None
+    if args.impedance is not None:
+        import pandas as pd
+        impedance = resolve_impedance_table(pd.read_csv(args.impedance))
+
+    def progress(stage, done, total):
+        if done == 0:
+            print(f'qc: {QC_STAGES[stage]}')
+
+    out = run_qc(re, params, impedance, progress)
+    removed = sorted(set(map(str, re.get_channel_ids())) - set(map(str, out.get_channel_ids())))
+    print(f'qc: {len(removed)} channels removed {" ".join(removed)}')
+    if args.output is not None:
+        out.save(folder=args.output, format='binary', n_jobs=args.n_jobs, chunk_duration=args.chunk_duration,
+                 overwrite=True)
+        Path(args.output, 'removed_channels.json').write_text(json.dumps(removed))
+        print(f'qc: saved to {args.output}')
+
+
+def cmd_report(args):
+    from qc_report import qc_report
+    impedance = None
+    if args.impedance is not None:
+        import pandas as pd
+        _qcheck_path()
+        from utils import resolve_impedance_table
+        impedance = resolve_impedance_table(pd.read_csv(args.impedance))
+    neighbor = None if args.neighbor is None else load_params(args.neighbor)
+
+    def progress(done, total):
+        if done == total or done % 50 == 0:
+            print(f'report: {done}/{total} tiles')
+
+    index = qc_report(open_recording(args.raw), open_recording(args.preprocessed), args.output, impedance,
+                      args.impedance_threshold, neighbor, args.channels_per_tile, args.window, n_jobs=args.n_jobs,
+                      progress=progress)
+    print(f'report: {index}')
+
+
+def cmd_sort(args):
+    from kilosort import kilosort, threshold_sorter
+    params = load_params(args.params)
+    sorting = kilosort(open_recording(args.recording), args.output, args.docker or False, verbose=True,
+                       cache=get_cache(args.cache), sorter_name='threshold' if args.threshold else args.sorter,
+                       sorter=threshold_sorter if args.threshold else None, **params)
+    if args.cache is not None:
+        print(f"sort: {sorting.get_annotation('sorter_output_folder')}")
+
+
+def cmd_metrics(args):
+    from cellexplorer import cell_metrics_gen
+    cell_metrics_gen(args.kilosort_folder, native=args.native, monosynaptic=args.monosynaptic)
+    print(f'metrics: {args.kilosort_folder}')
+
+
+def cmd_run(args):
+    from batch import run_batch
+    summary = run_batch(args.manifest, args.cpus, args.memory_gb * 2 ** 30 if args.memory_gb else None, args.force)
+    return 0 if summary['status'] == 'done' else 1
+
+
+def cmd_daemon(args):
+    if args.stop or args.status:
+        reply = request(args.address, ('stop' if args.stop else 'status',))
+        if reply is None:
+            print('daemon: not running')
+            return 1
+        print(json.dumps(reply, indent=2))
+        return 0
+    serve(args.address, args.preload)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--no-daemon', action='store_true', help='run in this process even if a daemon is running')
+    parser.add_argument('--address', default=ADDRESS, help='the address of the daemon')
+    parser.add_argument('--profile', default=None, help='save a profile of the run to this json')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('ingest', help='convert a folder of RHD files into a store')
+    p.add_argument('rhd_dir')
+    p.add_argument('store')
+    p.add_argument('--stream-name', default='RHD2000 amplifier channel')
+    p.add_argument('--probe', default=None, help='a probe of the registry or a probeinterface json, by default my_probe')
+    p.add_argument('--n-jobs', type=int, default=None)
+    p.set_defaults(func=cmd_ingest)
+
+    p = sub.add_parser('select', help='select a frame range of an RHD folder or a store')
+    p.add_argument('source', help='the folder of the RHD files or a store')
+    p.add_argument('output', help='the folder the recording.json is written into')
+    p.add_argument('--t1', type=int, default=None, help='the first frame, by default 0')
+    p.add_argument('--t2', type=int, default=None, help='the end frame, by default the end of the session')
+    p.add_argument('--stream-name', default='RHD2000 amplifier channel')
+    p.add_argument('--probe', default='my_probe', help="a probe of the registry or a probeinterface json set on RHD files, 'none' to leave them "
+                                                   'without, a store has its own')
+    p.set_defaults(func=cmd_select)
+
+    p = sub.add_parser('preprocess', help='filter and reference a recording into a binary')
+    p.add_argument('recording')
+    p.add_argument('output')
+    p.add_argument('--low', type=float, default=300)
+    p.add_argument('--high', type=float, default=6000)
+    p.add_argument('--order', type=int, default=5)
+    p.add_argument('--iterations', type=int, default=1)
+    p.add_argument('--direction', default='forward-backward', choices=['forward-backward', 'forward'])
+    p.add_argument('--reference', default='global', choices=['global', 'local', 'none'])
+    p.add_argument('--operator', default='median', choices=['median', 'average'])
+    p.add_argument('--local-radius', type=float, nargs=2, default=[30, 55])
+    p.add_argument('--n-jobs', type=int, default=-1)
+    p.add_argument('--chunk-duration', default='1s')
+    p.add_argument('--cache', default=None, help='a cache folder to reuse the outputs, output is then unused')
+    p.set_defaults(func=cmd_preprocess)
+
+    p = sub.add_parser('qc', help='run the QC stages of the QCheck panel, or open it')
+    p.add_argument('recording')
+    p.add_argument('--params', default=None, help='the parameters of each stage, a json file or string')
+    p.add_argument('--impedance', default=None, help='the impedance csv of the Intan software')
+    p.add_argument('--output', default=None, help='save the result as binary')
+    p.add_argument('--gui', action='store_true', help='open the QCheck panel')
+    p.add_argument('--n-jobs', type=int, default=-1)
+    p.add_argument('--chunk-duration', default='1s')
+    p.set_defaults(func=cmd_qc)
+
+    p = sub.add_parser('report', help='render the HTML report of a raw and a preprocessed recording')
+    p.add_argument('raw')
+    p.add_argument('preprocessed')
+    p.add_argument('output')
+    p.add_argument('--impedance', default=None, help='the impedance csv of the Intan software')
+    p.add_argument('--impedance-threshold', type=float, default=None)
+    p.add_argument('--neighbor', default=None, help='the arguments of the neighborhood r2 detection, a json file or '
+                                                    'string, to map the r2 of the channels')
+    p.add_argument('--channels-per-tile', type=int, default=32)
+    p.add_argument('--window', type=float, default=300., help='the seconds of each tile')
+    p.add_argument('--n-jobs', type=int, default=-1)
+    p.set_defaults(func=cmd_report)
+
+    p = sub.add_parser('sort', help='spike sort a preprocessed recording')
+    p.add_argument('recording')
+    p.add_argument('output')
+    p.add_argument('--sorter', default='kilosort2_5')
+    p.add_argument('--docker', default=None, help='the docker image to run the sorter in')
+    p.add_argument('--threshold', action='store_true', help='use the threshold sorter instead, without MATLAB')
+    p.add_argument('--params', default=None, help='the sorter parameters, a json file or string')
+    p.add_argument('--cache', default=None, help='a cache folder to reuse the sortings')
+    p.set_defaults(func=cmd_sort)
+
+    p = sub.add_parser('metrics', help='compute the CellExplorer metrics of a Kilosort output')
+    p.add_argument('kilosort_folder')
+    p.add_argument('--native', action='store_true', help='compute them without MATLAB')
+    p.add_argument('--monosynaptic', action='store_true', help='also screen for monosynaptic connections')
+    p.set_defaults(func=cmd_metrics)
+
+    p = sub.add_parser('run', help='run the sessions of a batch manifest')
+    p.add_argument('manifest')
+    p.add_argument('--cpus', type=int, default=None)
+    p.add_argument('--memory-gb', type=float, default=None)
+    p.add_argument('--force', nargs='*', default=[], choices=['select', 'preprocess', 'sort', 'metrics'])
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser('daemon', help='keep the modules and the recordings loaded for the other subcommands')
+    p.add_argument('--stop', action='store_true', help='stop the running daemon')
+    p.add_argument('--status', action='store_true', help='show the state of the running daemon')
+    p.add_argument('--preload', nargs='*', default=WARM_MODULES, help='the modules imported at start')
+    p.set_defaults(func=cmd_daemon)
+    return parser
+
+
+def run(argv):
+    """
+    Run a command line in this process.
+
+    :return: the exit code
+    """
+    args = build_parser().parse_args(argv)
+    if args.profile:
+        profiling.enable(args.profile)
+    try:
+        with profiling.stage(f'cli.{args.command}'):
+            code = args.func(args)
+    finally:
+        if args.profile:
+            profiling.save()
+            profiling.disable()
+    return code or 0
+
+
+def _authkey():
+    # a key readable by the user only, so that only they can run commands in their daemon
+    path = Path.home() / '.cache' / 'linlab_probe_pipeline' / 'daemon.key'
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+    return path.read_bytes()
+
+
+def request(address, message, output=None):
+    """
+    Send a message to the daemon.
+
+    :param address: the address of the daemon
+    :param message: ('run', argv, cwd), ('status',) or ('stop',)
+    :param output: called with the text printed by the command as it comes
+    :return: the reply, None if no daemon is running
+    """
+    if sys.platform != 'win32' and not os.path.exists(address):
+        return None
+    from multiprocessing.connection import Client
+    try:
+        conn = Client(address, authkey=_authkey())
+    except (OSError, EOFError):
+        return None
+    with conn:
+        conn.send(message)
+        while True:
+            kind, value = conn.recv()
+            if kind != 'out':
+                return value
+            if output is not None:
+                output(value)
+
+
+class _Forward:
+    # a text stream sending what is written to the client
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        if text:
+            try:
+                self.conn.send(('out', text))
+            except OSError:
+                pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def serve(address=ADDRESS, preload=WARM_MODULES):
+    """
+    Run the daemon: import the heavy modules once, then run the commands of the clients one at a time in this
+    process, so that the recordings, caches and engines opened stay warm for the next ones.
+    """
+    import importlib
+    from multiprocessing.connection import Listener
+    started = time.time()
+    for m in preload:
+        try:
+            importlib.import_module(m)
+        except ImportError as e:
+            print(f'daemon: {m} not loaded, {e}')
+    if sys.platform != 'win32':
+        Path(address).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.exists(address):
+            if request(address, ('status',)) is not None:
+                raise RuntimeError(f'A daemon is already running at {address}.')
+            os.unlink(address)
+    listener = Listener(address, authkey=_authkey())
+    lock = threading.Lock()
+    stopping = threading.Event()
+    count = [0]
+
+    def handle(conn):
+        with conn:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            if message[0] == 'status':
+                conn.send(('reply', {'pid': os.getpid(), 'address': address, 'uptime': time.time() - started,
+                                     'commands': count[0], 'busy': lock.locked(),
+                                     'recordings': sorted({k[0] for k in _recordings}),
+                                     'modules': [m for m in preload if m in sys.modules]}))
+            elif message[0] == 'stop':
+                stopping.set()
+                conn.send(('reply', {'pid': os.getpid(), 'stopping': True}))
+                # wake up the accept of the main thread
+                from multiprocessing.connection import Client
+                with contextlib.suppress(OSError, EOFError):
+                    Client(address, authkey=_authkey()).close()
+            elif message[0] == 'run':
+                _, argv, cwd = message
+                out = _Forward(conn)
+                with lock:
+                    count[0] += 1
+                    os.chdir(cwd)
+                    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                        try:
+                            code = run(argv)
+                        except SystemExit as e:
+                            code = e.code if isinstance(e.code, int) else 1
+                        except BaseException:
+                            traceback.print_exc()
+                            code = 1
+                try:
+                    conn.send(('exit', code))
+                except OSError:
+                    pass
+
+    print(f'daemon: listening at {address}, pid {os.getpid()}, ready in {time.time() - started:.1f}s')
+    try:
+        while not stopping.is_set():
+            try:
+                conn = listener.accept()
+            except OSError:
+                # a client failing the authentication
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if sys.platform != 'win32' and os.path.exists(address):
+            os.unlink(address)
+        print('daemon: stopped')
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # parsed again by whoever runs it, only to know where
+    args, _ = build_parser().parse_known_args(argv)
+    local = args.no_daemon or args.command == 'daemon' or (args.command == 'qc' and args.gui)
+    if not local:
+        code = request(args.address, ('run', argv, os.getcwd()), lambda text: print(text, end='', flush=True))
+        if code is not None:
+            return code
+    return run(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
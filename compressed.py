@@ -0,0 +1,169 @@
+import json
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+
+# spikeinterface compares the version of the module of a recording when it clones it or loads it from a dict
+__version__ = '1.0'
+
+
+def default_codec():
+    """
+    Blosc with zstd when numcodecs is installed, else zlib from the standard library.
+    """
+    try:
+        import numcodecs  # noqa: F401
+        return 'blosc-zstd'
+    except ImportError:
+        return 'zlib'
+
+
+class Codec:
+    """
+    Compress the chunks of traces, the bytes of each sample split into planes first, as the high bytes of
+    filtered traces are mostly alike and the low ones are noise.
+
+    :param name: 'blosc-zstd', 'blosc-lz4' with numcodecs, or 'zlib'
+    :param level: the compression level
+    """
+
+    def __init__(self, name='zlib', level=None):
+        self.name = name
+        if name.startswith('blosc-'):
+            from numcodecs import Blosc
+            self.level = 5 if level is None else level
+            self.blosc = Blosc(cname=name[len('blosc-'):], clevel=self.level, shuffle=Blosc.SHUFFLE)
+        elif name == 'zlib':
+            self.level = 1 if level is None else level
+        else:
+            raise ValueError(f'Unknown codec {name}.')
+
+    def encode(self, traces):
+        traces = np.ascontiguousarray(traces)
+        if self.name != 'zlib':
+            # blosc shuffles the bytes itself
+            return self.blosc.encode(traces)
+        # the planes by shifts of the samples as unsigned integers, a strided transpose of the bytes is much slower
+        k = traces.dtype.itemsize
+        v = traces.reshape(-1).view(f'u{k}')
+        planes = np.stack([(v >> (8 * j)).astype(np.uint8) for j in range(k)])
+        return zlib.compress(planes.tobytes(), self.level)
+
+    def decode(self, blob, dtype, shape):
+        dtype = np.dtype(dtype)
+        if self.name != 'zlib':
+            return np.frombuffer(self.blosc.decode(blob), dtype=dtype).reshape(shape)
+        k = dtype.itemsize
+        u = np.dtype(f'u{k}')
+        planes = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(k, -1)
+        out = planes[0].astype(u)
+        for j in range(1, k):
+            out |= planes[j].astype(u) << u.type(8 * j)
+        return out.view(dtype).reshape(shape)
+
+
+class ChunkWriter:
+    """
+    Write the chunks of a segment compressed into one file, in any order and from several threads, with an index
+    of where each chunk lies.
+
+    :param path: the file of the chunks, the index is saved next to it as .index.npy
+    :param num_chunks: the number of chunks of the segment
+    :param codec: a Codec
+    """
+
+    def __init__(self, path, num_chunks, codec):
+        self.path = Path(path)
+        self.codec = codec
+        self.index = np.full((num_chunks, 2), -1, dtype=np.int64)
+        self.file = open(self.path, 'wb')
+        self.lock = threading.Lock()
+
+    def write(self, chunk_index, traces):
+        blob = self.codec.encode(traces)
+        with self.lock:
+            self.index[chunk_index] = self.file.tell(), len(blob)
+            self.file.write(blob)
+
+    def close(self):
+        self.file.close()
+        np.save(self.path.with_name(self.path.name + '.index.npy'), self.index)
+
+
+class CompressedRecording(BaseRecording):
+    """
+    A folder written by preproc.preprocess with compression: the chunks of each segment compressed separately
+    in one file, so reading a range only decodes the chunks it overlaps.
+
+    :param folder: the folder holding preprocess.json
+    """
+    name = 'compressed'
+
+    def __init__(self, folder):
+        folder = Path(folder)
+        with open(folder / 'preprocess.json') as f:
+            meta = json.load(f)
+        codec = Codec(meta['codec'])
+        BaseRecording.__init__(self, meta['sampling_frequency'], meta['channel_ids'], meta['dtype'])
+        for name, n in zip(meta['files'], meta['num_samples']):
+            index = np.load(folder / (name + '.index.npy'))
+            self.add_recording_segment(CompressedRecordingSegment(folder / name, index, meta['chunk_size'], n,
+                                                                  meta['num_channels'], meta['dtype'], codec,
+                                                                  meta['sampling_frequency']))
+        self.annotate(is_filtered=True)
+        self._kwargs = dict(folder=str(folder.absolute()))
+
+
+class CompressedRecordingSegment(BaseRecordingSegment):
+    def __init__(self, path, index, chunk_size, num_samples, num_channels, dtype, codec, sampling_frequency):
+        BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
+        self.path = path
+        self.index = index
+        self.chunk_size = chunk_size
+        self.num_samples = num_samples
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.data = np.memmap(path, dtype=np.uint8, mode='r') if index[:, 1].sum() > 0 else np.zeros(0, np.uint8)
+        # the last chunk decoded by each thread, reading in order often asks for the same chunk twice
+        self.local = threading.local()
+
+    def get_num_samples(self):
+        return self.num_samples
+
+    def _chunk(self, c):
+        last = getattr(self.local, 'last', None)
+        if last is not None and last[0] == c:
+            return last[1]
+        offset, length = self.index[c]
+        frames = min(self.chunk_size, self.num_samples - c * self.chunk_size)
+        traces = self.codec.decode(self.data[offset: offset + length], self.dtype, (frames, self.num_channels))
+        # read-only like the memory maps of binary recordings, as it's shared with the next call
+        traces.flags.writeable = False
+        self.local.last = c, traces
+        return traces
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.num_samples
+        c0, c1 = start_frame // self.chunk_size, -(-end_frame // self.chunk_size)
+        if c1 - c0 == 1:
+            traces = self._chunk(c0)
+        else:
+            traces = np.concatenate([self._chunk(c) for c in range(c0, c1)]) if c1 > c0 else \
+                np.zeros((0, self.num_channels), dtype=self.dtype)
+        a = c0 * self.chunk_size
+        traces = traces[start_frame - a: end_frame - a]
+        return traces if channel_indices is None else traces[:, channel_indices]
+
+
+def folder_size(folder):
+    """
+    The bytes of the files in a folder, without the pyramids and caches kept next to them.
+    """
+    return sum(f.stat().st_size for f in Path(folder).iterdir() if f.is_file())
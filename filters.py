@@ -0,0 +1,113 @@
+import numpy as np
+import scipy.signal
+from spikeinterface.core.core_tools import define_function_from_class
+from spikeinterface.preprocessing.basepreprocessor import BasePreprocessor, BasePreprocessorSegment
+
+
+def bandpass_sos(low, high, fs, order=5):
+    """
+    Butterworth bandpass in second-order sections, the same design as spre.filter.
+    """
+    return scipy.signal.iirfilter(order, [low, high], fs=fs, btype='bandpass', ftype='butter', output='sos')
+
+
+def sos_margin(sos, fs, tol=1e-9, max_duration=1.):
+    """
+    The number of frames for the impulse response to settle, used as the overlap margin of a chunk.
+
+    :param sos: the second-order sections
+    :param fs: the sampling frequency
+    :param tol: the fraction of the impulse response energy allowed beyond the margin
+    :param max_duration: the upper bound of the margin in seconds
+    :return: the margin in frames
+    """
+    n = max(1, int(max_duration * fs))
+    impulse = np.zeros(n)
+    impulse[0] = 1
+    h = scipy.signal.sosfilt(sos, impulse)
+    tail = np.cumsum(np.square(h[::-1]))[::-1]
+    if tail[0] == 0:
+        return 0
+    return int(np.argmax(tail < tol * tail[0])) or n
+
+
+def cascade_sos(low, high, fs, order=5, iterations=1):
+    """
+    The bandpass applied `iterations` times, compiled into a single cascade of second-order sections.
+    """
+    return np.tile(bandpass_sos(low, high, fs, order), (iterations, 1))
+
+
+def filter_chunk(sos, get_traces, start_frame, end_frame, num_frames, margin, direction='forward-backward'):
+    """
+    Filter a chunk reading it once with its margins.
+
+    :param sos: the second-order sections
+    :param get_traces: called as get_traces(start_frame, end_frame) to read the input
+    :param start_frame: the first frame of the chunk
+    :param end_frame: the end frame of the chunk
+    :param num_frames: the number of frames of the segment, to clip the margins
+    :param margin: the margin in frames, e.g. from sos_margin
+    :param direction: 'forward-backward' for zero phase, 'forward' for causal
+    :return: the float32 filtered chunk
+    """
+    a = max(0, start_frame - margin)
+    if direction == 'forward-backward':
+        b = min(num_frames, end_frame + margin)
+        tr = scipy.signal.sosfiltfilt(sos, get_traces(a, b).astype(np.float32), axis=0)
+    else:
+        tr = scipy.signal.sosfilt(sos, get_traces(a, end_frame).astype(np.float32), axis=0)
+    return tr[start_frame - a: end_frame - a].astype(np.float32)
+
+
+class CascadeFilterRecording(BasePreprocessor):
+    """
+    Butterworth bandpass repeated `iterations` times, run as one cascade in a single pass per chunk.
+
+    This is equivalent to wrapping spre.filter `iterations` times, but each chunk is read once with
+    a margin sized to the impulse response of the whole cascade.
+
+    :param recording: the recording to filter
+    :param low: the low cutoff in Hz
+    :param high: the high cutoff in Hz
+    :param order: the order of each Butterworth filter
+    :param iterations: the number of times the filter is applied
+    :param direction: 'forward-backward' for zero phase, 'forward' for causal
+    :param margin_ms: override the margin in ms
+    """
+    name = 'cascade_filter'
+
+    def __init__(self, recording, low=300., high=6000., order=5, iterations=1, direction='forward-backward',
+                 margin_ms=None):
+        assert direction in ('forward-backward', 'forward')
+        fs = recording.get_sampling_frequency()
+        sos = cascade_sos(low, high, fs, order, iterations)
+        margin = sos_margin(sos, fs) if margin_ms is None else int(margin_ms * fs / 1000)
+        BasePreprocessor.__init__(self, recording, dtype='float32')
+        self.annotate(is_filtered=True)
+        if 'offset_to_uV' in self.get_property_keys():
+            self.set_channel_offsets(0)
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(CascadeFilterRecordingSegment(parent_segment, sos, margin, direction))
+
+        self._kwargs = dict(recording=recording, low=low, high=high, order=order, iterations=iterations,
+                            direction=direction, margin_ms=margin_ms)
+
+
+class CascadeFilterRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, sos, margin, direction):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.sos = sos
+        self.margin = margin
+        self.direction = direction
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_samples()
+        return filter_chunk(self.sos, lambda a, b: self.parent_recording_segment.get_traces(a, b, channel_indices),
+                            start_frame, end_frame, self.get_num_samples(), self.margin, self.direction)
+
+
+cascade_filter = define_function_from_class(source_class=CascadeFilterRecording, name='cascade_filter')
@@ -1,29 +1,110 @@
 # This Python file uses the following encoding: utf-8
 import os
+import threading
 from pathlib import Path
 
 import numpy as np
 from PySide6.QtWidgets import *
-from PySide6.QtCore import QFile, Slot
+from PySide6.QtCore import QFile, QThread, Signal, Slot
 from PySide6.QtUiTools import QUiLoader
-import spikeinterface.widgets as sw
 import spikeinterface.preprocessing as spre
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg, NavigationToolbar2QT
 import matplotlib.pyplot as plt
+from matplotlib.ticker import FuncFormatter
 from utils import *
 
 
+class QCThread(QThread):
+    """
+    Run the QC stages off the GUI thread, reporting the overall percentage as the stages and chunks advance,
+    and the name of the step in progress from the stage events of profiling.
+    Every run carries a generation number so that the widget can drop the results of stale runs.
+    """
+    progress = Signal(int, int)
+    step = Signal(int, str)
+    succeeded = Signal(int, object)
+    failed = Signal(int, str)
+
+    def __init__(self, generation, recording, params, impedance, cancel, bad_channels=None, parent=None):
+        super(QCThread, self).__init__(parent)
+        self.generation = generation
+        self.recording = recording
+        self.params = params
+        self.impedance = impedance
+        self.cancel = cancel
+        self.bad_channels = bad_channels
+
+    def report(self, stage, done, total):
+        self.progress.emit(self.generation, int(100 * (stage + done / max(total, 1)) / len(QC_STAGES)))
+
+    def on_event(self, event):
+        if event['ph'] == 'B' and event['name'].startswith('qc.'):
+            self.step.emit(self.generation, event['name'][3:])
+
+    def run(self):
+        profiling.subscribe(self.on_event)
+        try:
+            re = run_qc(self.recording, self.params, self.impedance, self.report, self.cancel, self.bad_channels)
+        except Cancelled:
+            return
+        except Exception as e:
+            self.failed.emit(self.generation, f'{type(e).__name__}: {e}')
+            return
+        finally:
+            profiling.unsubscribe(self.on_event)
+        self.succeeded.emit(self.generation, re)
+
+
+class PyramidThread(QThread):
+    """
+    Build the envelope pyramid of a recording off the GUI thread, it's a full pass over the recording the first time.
+    """
+    progress = Signal(object, int)
+    succeeded = Signal(object, object)
+    failed = Signal(object, str)
+
+    def __init__(self, recording, cancel, parent=None):
+        super(PyramidThread, self).__init__(parent)
+        self.recording = recording
+        self.cancel = cancel
+
+    def run(self):
+        try:
+            pyramid = get_pyramid(self.recording, cancel=self.cancel, progress=lambda done, total: self.progress.emit(
+                self.recording, int(100 * done / max(total, 1))))
+        except Cancelled:
+            return
+        except Exception as e:
+            self.failed.emit(self.recording, f'{type(e).__name__}: {e}')
+            return
+        self.succeeded.emit(self.recording, pyramid)
+
+
 class QCheck(QWidget):
-    def __init__(self, recording: si.BaseRecording):
+    # emitted from the thread of the preview when its noise mask is ready
+    mask_ready = Signal()
+
+    def __init__(self, recording: si.BaseRecording, impedance_store: ImpedanceStore = None, session=None):
         super(QCheck, self).__init__()
         self.input = recording
+        self.impedance_store = impedance_store
         self.output: si.BaseRecording = recording
+        self.pyramid = None
+        self.pyramid_cancel: threading.Event = None
+        self.pyramid_status = ''
+        self.preview: PreviewPipeline = None
+        self.bad_channels = BadChannelAnalysis(recording)
+        self.generation = 0
+        self.cancel_event: threading.Event = None
         self.load_ui()
         self.setWindowTitle('Time Series Quality Check (by zzh)')
 
         self.max_time = recording.get_duration()
         self.channel_count = recording.get_num_channels()
         self.impedance: pd.Series = None
+        if impedance_store is not None and len(impedance_store.sessions()) > 0:
+            session = session if session is not None else impedance_store.sessions().index[-1]
+            self.set_impedance(impedance_store.impedance(session), f'{impedance_store.path} [{session}]')
 
         w = self.findChild(QWidget, 'fig')
         self.fig = plt.figure()
@@ -69,13 +150,28 @@ class QCheck(QWidget):
 
         # buttons & boxes
         self.findChild(QPushButton, 'update_fig').clicked.connect(self.update_figure)
+        self.findChild(QCheckBox, 'preview').stateChanged.connect(self.update_figure)
         self.findChild(QPushButton, 'apply').clicked.connect(self.apply)
+        self.findChild(QPushButton, 'cancel').clicked.connect(self.cancel)
+        self.findChild(QPushButton, 'cancel').setEnabled(False)
+        self.findChild(QPushButton, 'r2_curve').clicked.connect(self.plot_r2_curve)
+        self.findChild(QPushButton, 'load_table').clicked.connect(self.open_table)
         self.findChild(QCheckBox, 'channel').stateChanged.connect(self.checkbox_state_update)
         self.findChild(QCheckBox, 'mech').stateChanged.connect(self.checkbox_state_update)
         self.findChild(QCheckBox, 'butter').stateChanged.connect(self.checkbox_state_update)
         self.findChild(QCheckBox, 'neighbor').stateChanged.connect(self.checkbox_state_update)
         self.findChild(QCheckBox, 'reref').stateChanged.connect(self.checkbox_state_update)
         self.checkbox_state_update()
+        self.mask_ready.connect(self.on_mask_ready)
+
+        # restart a running QC when its parameters change
+        for w in self.findChild(QWidget, 'groupBox_2').findChildren(QSpinBox) + \
+                self.findChild(QWidget, 'groupBox_2').findChildren(QDoubleSpinBox):
+            w.valueChanged.connect(self.params_changed)
+        for w in self.findChild(QWidget, 'groupBox_2').findChildren(QComboBox):
+            w.currentIndexChanged.connect(self.params_changed)
+        for w in self.findChild(QWidget, 'groupBox_2').findChildren(QCheckBox):
+            w.stateChanged.connect(self.params_changed)
 
     @Slot()
     def checkbox_state_update(self):
@@ -145,80 +241,263 @@ class QCheck(QWidget):
         self.ax.spines['right'].set_visible(False)
         self.ax.spines['top'].set_visible(False)
         self.ax.spines['bottom'].set_visible(False)
+        time_range = (self.start_time.value(), self.end_time.value())
+        width = self.canvas.width()
+        if self.findChild(QCheckBox, 'preview').isChecked():
+            self.render_preview(time_range, width)
+            return
         channels = self.output.get_channel_ids()[self.left_ch.value(): self.right_ch.value()]
-        sw.plot_timeseries(self.output, ax=self.ax, show_channel_ids=True, channel_ids=channels,
-                           time_range=(self.start_time.value(), self.end_time.value()), add_legend=False)
+        # wide ranges are drawn from the envelope pyramid, built once for each output in the background
+        if self.pyramid is None and (time_range[1] - time_range[0]) * self.output.get_sampling_frequency() > 16 * width:
+            self.build_pyramid()
+            self.ax.set_xlim(*time_range)
+            self.ax.set_yticks([])
+            self.ax.text(.5, .5, self.pyramid_status, transform=self.ax.transAxes, ha='center', va='center')
+            self.canvas.draw()
+            return
+        plot_timeseries(self.output, self.ax, channels, time_range, self.pyramid, width)
+        self.canvas.draw()
+
+    def build_pyramid(self):
+        if self.pyramid_cancel is not None:
+            return
+        self.pyramid_cancel = threading.Event()
+        self.pyramid_status = 'Building the envelope of the recording...'
+        thread = PyramidThread(self.output, self.pyramid_cancel, self)
+        thread.progress.connect(self.on_pyramid_progress)
+        thread.succeeded.connect(self.on_pyramid_ready)
+        thread.failed.connect(self.on_pyramid_failed)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+    def stop_pyramid(self):
+        if self.pyramid_cancel is not None:
+            self.pyramid_cancel.set()
+        self.pyramid_cancel = None
+        self.pyramid = None
+
+    @Slot(object, int)
+    def on_pyramid_progress(self, recording, value):
+        if recording is self.output and self.pyramid is None:
+            self.pyramid_status = f'Building the envelope of the recording... {value}%'
+            if not self.findChild(QCheckBox, 'preview').isChecked():
+                self.update_figure()
+
+    @Slot(object, object)
+    def on_pyramid_ready(self, recording, pyramid):
+        if recording is not self.output:
+            return
+        self.pyramid = pyramid
+        if not self.findChild(QCheckBox, 'preview').isChecked():
+            self.update_figure()
+
+    @Slot(object, str)
+    def on_pyramid_failed(self, recording, message):
+        if recording is not self.output:
+            return
+        self.pyramid_status = f'Failed to build the envelope: {message}'
+        if not self.findChild(QCheckBox, 'preview').isChecked():
+            self.update_figure()
+
+    def closeEvent(self, event):
+        self.stop_pyramid()
+        if self.running():
+            self.cancel_event.set()
+        super(QCheck, self).closeEvent(event)
+
+    def render_preview(self, time_range, width):
+        """
+        Evaluate the QC stages only on the visible range, reusing the cached chunks of unchanged stages.
+        """
+        if self.preview is None:
+            self.preview = PreviewPipeline(self.input, self.impedance, bad_channels=self.bad_channels,
+                                           on_ready=self.mask_ready.emit)
+        params = self.qc_params()
+        if 'channel' in params and self.impedance is None:
+            params.pop('channel')
+        fs = self.input.get_sampling_frequency()
+        start, end = int(time_range[0] * fs), int(time_range[1] * fs)
+        channels = self.input.get_channel_ids()[self.left_ch.value(): self.right_ch.value()]
+        channels, traces = self.preview.get_traces(params, start, end, channels)
+        if len(channels) == 0:
+            self.canvas.draw()
+            return
+        window = si.NumpyRecording(traces, fs, channel_ids=channels)
+        plot_timeseries(window, self.ax, channels, (0, (end - start) / fs), None, width)
+        self.ax.xaxis.set_major_formatter(FuncFormatter(lambda x, pos: f'{x + time_range[0]:g}'))
+        waiting = self.preview.waiting()
+        if waiting:
+            names = {'neighbor': 'the bad channels', 'mech': 'the mechanical noise'}
+            self.ax.set_title(f'Computing {" and ".join(names[i] for i in waiting)}, shown without them...',
+                              fontsize='small')
         self.canvas.draw()
 
     @Slot()
-    def apply(self):
-        p = self.findChild(QProgressBar, 'progress')
-        p.setValue(0)
-        re = self.input
+    def on_mask_ready(self):
+        if self.findChild(QCheckBox, 'preview').isChecked():
+            self.update_figure()
 
-        # 1. filter by impedance
-        check = self.findChild(QCheckBox, 'channel')
-        if check.isChecked():
-            if self.impedance is None:
-                QMessageBox('Critical', 'No Impedance Table', 'No impedance for filtering probe IDs.').exec()
-                return
-            imp_thr = self.findChild(QDoubleSpinBox, 'impedance').value()
-            re = re.remove_channels([i for i in re.get_channel_ids() if self.impedance[i] > imp_thr])
-        p.setValue(20)
+    @Slot()
+    def plot_r2_curve(self):
+        """
+        Plot the number of channels the neighborhood filter removes against its threshold.
+        """
+        params = self.qc_params()
+        kw = dict(params['neighbor'])
+        threshold = kw.pop('neighborhood_r2_threshold')
+        kw.pop('welch_window_ms')
+        channels = self.input.get_channel_ids()
+        if 'channel' in params and self.impedance is not None:
+            channels = [c for c in channels if self.impedance[c] <= params['channel']['threshold']]
+        curve = self.bad_channels.curve(channel_ids=channels, **kw)
+        self.fig.clear()
+        self.ax = self.fig.subplots()
+        self.ax.step(curve.index, curve.values, where='post')
+        self.ax.axvline(threshold, color='r', linestyle='--')
+        self.ax.set_xlabel('neighborhood r2 threshold')
+        self.ax.set_ylabel('channels removed')
+        self.canvas.draw()
 
+    def qc_params(self):
+        """
+        Collect the keyword arguments of the checked stages for run_qc.
+        """
+        params = {}
+        # 1. filter by impedance
+        if self.findChild(QCheckBox, 'channel').isChecked():
+            params['channel'] = dict(threshold=self.findChild(QDoubleSpinBox, 'impedance').value())
         # 2. filter by neighborhood
-        check = self.findChild(QCheckBox, 'neighbor')
-        if check.isChecked():
-            bd, lb = spre.detect_bad_channels(re, 'neighborhood_r2',
-                                          neighborhood_r2_threshold=self.findChild(QDoubleSpinBox, 'r2_thr').value(),
-                                          neighborhood_r2_radius_um=self.findChild(QDoubleSpinBox, 'rad_um').value(),
-                                          highpass_filter_cutoff=self.findChild(QDoubleSpinBox, 'hp_cutoff').value(),
-                                          num_random_chunks=self.findChild(QSpinBox, 'n_rand').value(),
-                                          welch_window_ms=self.findChild(QDoubleSpinBox, 'welch').value(),
-                                          chunk_duration_s=self.findChild(QDoubleSpinBox, 'chunk').value())
-            re = re.remove_channels(bd)
-        p.setValue(40)
-
+        if self.findChild(QCheckBox, 'neighbor').isChecked():
+            params['neighbor'] = dict(
+                neighborhood_r2_threshold=self.findChild(QDoubleSpinBox, 'r2_thr').value(),
+                neighborhood_r2_radius_um=self.findChild(QDoubleSpinBox, 'rad_um').value(),
+                highpass_filter_cutoff=self.findChild(QDoubleSpinBox, 'hp_cutoff').value(),
+                num_random_chunks=self.findChild(QSpinBox, 'n_rand').value(),
+                welch_window_ms=self.findChild(QDoubleSpinBox, 'welch').value(),
+                chunk_duration_s=self.findChild(QDoubleSpinBox, 'chunk').value())
         # 3. clean mechanical noise
-        check = self.findChild(QCheckBox, 'mech')
-        if check.isChecked():
-            pass
-        p.setValue(60)
-
+        if self.findChild(QCheckBox, 'mech').isChecked():
+            params['mech'] = dict(window=self.findChild(QSpinBox, 'window').value(),
+                                  interval=self.findChild(QSpinBox, 'interval').value(),
+                                  noise_cap=self.findChild(QDoubleSpinBox, 'cap').value())
         # 4. butterworth
-        check = self.findChild(QCheckBox, 'butter')
-        if check.isChecked():
-            lp = self.findChild(QDoubleSpinBox, 'low').value()
-            hp = self.findChild(QDoubleSpinBox, 'high').value()
-            order = self.findChild(QSpinBox, 'order').value()
-            iter = self.findChild(QSpinBox, 'iter').value()
-            step = 33 / iter
-            for i in range(iter):
-                re = spre.filter(re, [lp, hp], 'bandpass', order)
-                p.setValue(60 + int(step * (i + 1)))
-        p.setValue(80)
-
+        if self.findChild(QCheckBox, 'butter').isChecked():
+            params['butter'] = dict(low=self.findChild(QDoubleSpinBox, 'low').value(),
+                                    high=self.findChild(QDoubleSpinBox, 'high').value(),
+                                    order=self.findChild(QSpinBox, 'order').value(),
+                                    iterations=self.findChild(QSpinBox, 'iter').value())
         # 5. rereference
-        check = self.findChild(QCheckBox, 'reref')
-        if check.isChecked():
-            spre.common_reference(re, operator=self.findChild(QComboBox, 'operator').value(),
-                                  reference=self.findChild(QCheckBox, 'reference').value())
-        p.setValue(100)
+        if self.findChild(QCheckBox, 'reref').isChecked():
+            params['reref'] = dict(operator=self.findChild(QComboBox, 'operator_2').currentText(),
+                                   reference=self.findChild(QComboBox, 'reference').currentText(),
+                                   local_radius=(self.findChild(QDoubleSpinBox, 'local_r1').value(),
+                                                 self.findChild(QDoubleSpinBox, 'local_r2').value()))
+        return params
 
-        self.output = re
-        QMessageBox('Information', 'QC Success', 'You can rerender the figure to visualize the new recording.').exec()
+    def running(self):
+        return self.cancel_event is not None and not self.cancel_event.is_set()
+
+    @Slot()
+    def apply(self):
+        params = self.qc_params()
+        if 'channel' in params and self.impedance is None:
+            QMessageBox.critical(self, 'No Impedance Table', 'No impedance for filtering probe IDs.')
+            return
+        # a run in progress is stale now, stop it and drop whatever it returns
+        if self.running():
+            self.cancel_event.set()
+        self.generation += 1
+        self.cancel_event = threading.Event()
+        self.findChild(QProgressBar, 'progress').setValue(0)
+        self.findChild(QPushButton, 'cancel').setEnabled(True)
+
+        thread = QCThread(self.generation, self.input, params, self.impedance, self.cancel_event, self.bad_channels,
+                          self)
+        thread.progress.connect(self.on_progress)
+        thread.step.connect(self.on_step)
+        thread.succeeded.connect(self.on_succeeded)
+        thread.failed.connect(self.on_failed)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+    @Slot()
+    def cancel(self):
+        if self.running():
+            self.cancel_event.set()
+        self.generation += 1
+        self.findChild(QProgressBar, 'progress').setValue(0)
+        self.findChild(QPushButton, 'cancel').setEnabled(False)
+        self.findChild(QProgressBar, 'progress').setFormat('%p%')
+
+    @Slot()
+    def params_changed(self):
+        if self.running():
+            self.apply()
+        if self.findChild(QCheckBox, 'preview').isChecked():
+            self.update_figure()
+
+    @Slot(int, int)
+    def on_progress(self, generation, value):
+        if generation == self.generation:
+            self.findChild(QProgressBar, 'progress').setValue(value)
+
+    @Slot(int, str)
+    def on_step(self, generation, name):
+        if generation == self.generation:
+            self.findChild(QProgressBar, 'progress').setFormat(f'{name} %p%')
+
+    @Slot(int, object)
+    def on_succeeded(self, generation, recording):
+        if generation != self.generation:
+            return
+        self.cancel_event = None
+        self.findChild(QPushButton, 'cancel').setEnabled(False)
+        self.findChild(QProgressBar, 'progress').setValue(100)
+        self.findChild(QProgressBar, 'progress').setFormat('%p%')
+        self.stop_pyramid()
+        self.output = recording
+        QMessageBox.information(self, 'QC Success', 'You can rerender the figure to visualize the new recording.')
+
+    @Slot(int, str)
+    def on_failed(self, generation, message):
+        if generation != self.generation:
+            return
+        self.cancel_event = None
+        self.findChild(QPushButton, 'cancel').setEnabled(False)
+        self.findChild(QProgressBar, 'progress').setFormat('%p%')
+        QMessageBox.critical(self, 'QC Failed', message)
 
     @Slot()
     def open_table(self):
-        fn = QFileDialog.getOpenFileName(self, "Open Image", None, "Table (*.csv)")
-        tab = pd.read_csv(fn)
-        s = resolve_impedance_table(tab)
+        """
+        Load the impedance from an Intan csv, added to the impedance store when there's one,
+        or from a session of an impedance store.
+        """
+        fn, _ = QFileDialog.getOpenFileName(self, "Open Impedance Table", None, "Table (*.csv *.parquet)")
+        if not fn:
+            return
+        if fn.endswith('.parquet'):
+            self.impedance_store = ImpedanceStore(fn)
+            sessions = self.impedance_store.sessions().index.tolist()
+            session, ok = QInputDialog.getItem(self, 'Impedance Session', 'Session:', sessions, len(sessions) - 1,
+                                               False)
+            if not ok:
+                return
+            self.set_impedance(self.impedance_store.impedance(session), f'{fn} [{session}]')
+        elif self.impedance_store is not None:
+            session = Path(fn).parent.name
+            self.impedance_store.add(fn, session)
+            self.set_impedance(self.impedance_store.impedance(session), fn)
+        else:
+            self.set_impedance(resolve_impedance_table(pd.read_csv(fn)), fn)
+
+    def set_impedance(self, s: pd.Series, source: str):
         if not pd.Series(self.input.get_channel_ids()).isin(s.index).all():
-            QMessageBox('Critical', 'Impedance Table Invalid',
-                        'The table fails to cover the probe IDs provided.').exec()
+            QMessageBox.critical(self, 'Impedance Table Invalid', 'The table fails to cover the probe IDs provided.')
             return
-        self.findChild(QLineEdit, 'line').setText(fn)
+        self.findChild(QLineEdit, 'line').setText(source)
         self.impedance = s
+        self.preview = None
 
 
 if __name__ == "__main__":
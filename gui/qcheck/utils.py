@@ -1,6 +1,23 @@
+import sys
+from pathlib import Path
+
 import pandas as pd
 import spikeinterface as si
+import spikeinterface.preprocessing as spre
 
+# the pipeline modules live at the repo root, already on the path when imported by cli.py
+ROOT = str(Path(__file__).resolve().parents[2])
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+import mech_noise
+import profiling
+from bad_channels import BadChannelAnalysis
+from filters import cascade_filter
+from impedance import ImpedanceStore, parse_impedance_table
+from jobs import Cancelled
+from preview import PreviewPipeline
+from pyramid import get_pyramid, plot_timeseries
+from reference import local_reference
 
 
 def resolve_impedance_table(tab: pd.DataFrame):
@@ -10,15 +27,73 @@ def resolve_impedance_table(tab: pd.DataFrame):
     :param tab: a table from the instrument that contains the impedance level for each probe
     :return: a series mapping the probe id to their impedance
     """
-    names = []
-    for i in tab['Channel Name']:
-        id = 0 if i.startswith('A') else 64
-        id += int(i.split('-')[1])
-        names.append(str(id))
-    s = tab['Impedance Magnitude at 1000 Hz (ohms)']
-    s.index = names
-    return s
-
-
-def clean_mechanical_noise(recording: si.BaseRecording):
-    pass
\ No newline at end of file
+    return parse_impedance_table(tab).set_index('channel_id')['impedance']
+
+
+def clean_mechanical_noise(recording: si.BaseRecording, window=2000, interval=200, noise_cap=2.5, progress=None,
+                           cancel=None, **kwargs):
+    """
+    Clear the intervals where the average across channels has a large energy, lazily.
+
+    :param recording: the recording to clean
+    :param window: the moving window in frames for the energy
+    :param interval: the step in frames between two scores
+    :param noise_cap: the multiple of the median normalized energy to clear an interval
+    :param progress: called as progress(done, total) as the scoring advances
+    :param cancel: a threading.Event, raising Cancelled when set during the scoring
+    :param kwargs: job arguments like n_jobs and chunk_duration
+    :return: the cleaned recording
+    """
+    return mech_noise.clean_mechanical_noise(recording, window=window, interval=interval, noise_cap=noise_cap,
+                                             progress=progress, cancel=cancel, **kwargs)
+
+
+QC_STAGES = ['channel', 'neighbor', 'mech', 'butter', 'reref']
+
+
+def run_qc(recording: si.BaseRecording, params: dict, impedance: pd.Series = None, progress=None, cancel=None,
+           bad_channels: BadChannelAnalysis = None):
+    """
+    Apply the QC stages in order, the same steps as the QCheck panel.
+
+    :param recording: the input recording
+    :param params: the keyword arguments of each stage in QC_STAGES, stages missing or None are skipped
+    :param impedance: the series from resolve_impedance_table, needed by the 'channel' stage
+    :param progress: called as progress(stage_index, done, total) as the stages advance
+    :param cancel: a threading.Event, checked between stages and chunks, raising Cancelled when set
+    :param bad_channels: the BadChannelAnalysis of the input recording, to reuse its statistics across runs
+    :return: the lazy output recording
+    """
+    def report(i):
+        return None if progress is None else lambda done, total: progress(i, done, total)
+
+    re = recording
+    for i, stage in enumerate(QC_STAGES):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        kw = params.get(stage)
+        if kw is None:
+            continue
+        if progress is not None:
+            progress(i, 0, 1)
+        with profiling.stage(f'qc.{stage}'):
+            if stage == 'channel':
+                re = re.remove_channels([c for c in re.get_channel_ids() if impedance[c] > kw['threshold']])
+            elif stage == 'neighbor':
+                if bad_channels is None:
+                    bad_channels = BadChannelAnalysis(recording)
+                bd, lb = bad_channels.detect(channel_ids=re.get_channel_ids(), progress=report(i), cancel=cancel,
+                                             **kw)
+                re = re.remove_channels(bd)
+            elif stage == 'mech':
+                re = clean_mechanical_noise(re, progress=report(i), cancel=cancel, **kw)
+            elif stage == 'butter':
+                re = cascade_filter(re, **kw)
+            elif stage == 'reref':
+                if kw.get('reference') == 'local':
+                    re = local_reference(re, kw.get('operator', 'median'), kw.get('local_radius', (30, 55)))
+                else:
+                    re = spre.common_reference(re, **kw)
+        if progress is not None:
+            progress(i, 1, 1)
+    return re
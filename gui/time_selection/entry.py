@@ -1,16 +1,46 @@
 # This Python file uses the following encoding: utf-8
 import os
+import sys
+import threading
 from pathlib import Path
 
 from PySide6.QtWidgets import *
-from PySide6.QtCore import QFile, Slot
+from PySide6.QtCore import QFile, QThread, Signal, Slot
 from PySide6.QtUiTools import QUiLoader
-import spikeinterface.widgets as sw
 import spikeinterface as si
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg, NavigationToolbar2QT
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from jobs import Cancelled
+from pyramid import get_pyramid, plot_timeseries
+
+
+class PyramidThread(QThread):
+    """
+    Build the envelope pyramid of a recording off the GUI thread, it's a full pass over the recording the first time.
+    """
+    progress = Signal(int)
+    succeeded = Signal(object)
+    failed = Signal(str)
+
+    def __init__(self, recording, cancel, parent=None):
+        super(PyramidThread, self).__init__(parent)
+        self.recording = recording
+        self.cancel = cancel
+
+    def run(self):
+        try:
+            pyramid = get_pyramid(self.recording, cancel=self.cancel,
+                                  progress=lambda done, total: self.progress.emit(int(100 * done / max(total, 1))))
+        except Cancelled:
+            return
+        except Exception as e:
+            self.failed.emit(f'{type(e).__name__}: {e}')
+            return
+        self.succeeded.emit(pyramid)
+
 
 # class ChannelItem(QAbstractListModel):
 #     def __init__(self, channel_ids, *args, **kwargs):
@@ -31,6 +61,7 @@ class TimeSelection(QWidget):
     def __init__(self, recording: si.BaseRecording):
         super(TimeSelection, self).__init__()
         self.recording = recording
+        self.pyramid = None
         self.load_ui()
 
         self.max_time = recording.get_duration()
@@ -88,6 +119,36 @@ class TimeSelection(QWidget):
         # self.drop_list = self.findChild(QListView, 'drop_list')
         # self.select_list.sestModel()
 
+        # the whole range is drawn from the pyramid, the figure shows the progress until it's built
+        self.pyramid_cancel = threading.Event()
+        self.pyramid_status = 'Building the envelope of the recording...'
+        thread = PyramidThread(recording, self.pyramid_cancel, self)
+        thread.progress.connect(self.on_pyramid_progress)
+        thread.succeeded.connect(self.on_pyramid_ready)
+        thread.failed.connect(self.on_pyramid_failed)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+
+        self.update_figure()
+
+    def closeEvent(self, event):
+        self.pyramid_cancel.set()
+        super(TimeSelection, self).closeEvent(event)
+
+    @Slot(int)
+    def on_pyramid_progress(self, value):
+        self.pyramid_status = f'Building the envelope of the recording... {value}%'
+        if self.pyramid is None:
+            self.update_figure()
+
+    @Slot(object)
+    def on_pyramid_ready(self, pyramid):
+        self.pyramid = pyramid
+        self.update_figure()
+
+    @Slot(str)
+    def on_pyramid_failed(self, message):
+        self.pyramid_status = f'Failed to build the envelope: {message}'
         self.update_figure()
 
     def load_ui(self):
@@ -158,8 +219,12 @@ class TimeSelection(QWidget):
         self.ax.spines['top'].set_visible(False)
         self.ax.spines['bottom'].set_visible(False)
         channels = self.recording.get_channel_ids()[self.left_ch.value() - 1: self.right_ch.value()]
-        sw.plot_timeseries(self.recording, ax=self.ax, show_channel_ids=True, channel_ids=channels,
-                           time_range=(0, self.max_time), add_legend=False)
+        if self.pyramid is not None:
+            plot_timeseries(self.recording, self.ax, channels, (0, self.max_time), self.pyramid, self.canvas.width())
+        else:
+            self.ax.set_xlim(0, self.max_time)
+            self.ax.set_yticks([])
+            self.ax.text(.5, .5, self.pyramid_status, transform=self.ax.transAxes, ha='center', va='center')
         self.canvas.draw()
         self.bg = self.canvas.copy_from_bbox(self.fig.bbox)
 
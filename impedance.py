@@ -0,0 +1,131 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+MAGNITUDE = 'Impedance Magnitude at 1000 Hz (ohms)'
+PHASE = 'Impedance Phase at 1000 Hz (degrees)'
+COLUMNS = ['session', 'date', 'channel_id', 'name', 'contact', 'impedance', 'phase']
+INDEX = ['session', 'date', 'channel_id']
+
+
+def parse_impedance_table(tab: pd.DataFrame, probe=None):
+    """
+    Parse an impedance table of the Intan software in one vectorized pass. The channels of port A are 0-63,
+    port B 64-127 and so on, the same ids as the amplifier channels of the recording.
+
+    :param tab: the table read from the csv, several tables can be concatenated
+    :param probe: the probe whose device channel indices map the channels to contacts, by default probe.get_probe()
+    :return: a table with the channel id, its name, its contact index in the probe (-1 if not on the probe),
+        the impedance magnitude and phase, and the other columns of tab untouched
+    """
+    if probe is None:
+        from probe import get_probe
+        probe = get_probe()
+    parts = tab['Channel Name'].str.extract(r'^([A-Z])-(\d+)$')
+    number = (parts[0].str.get(0).map(ord) - ord('A')) * 64 + parts[1].astype(int)
+    contacts = np.full(max(number.max(), len(probe.device_channel_indices) - 1) + 1, -1)
+    contacts[np.asarray(probe.device_channel_indices)] = np.arange(len(probe.device_channel_indices))
+
+    out = tab.drop(columns=[MAGNITUDE, PHASE, 'Channel Name'], errors='ignore')
+    out['channel_id'] = number.astype(str)
+    out['name'] = tab['Channel Name']
+    out['contact'] = contacts[number.to_numpy()]
+    out['impedance'] = tab[MAGNITUDE].astype(float)
+    out['phase'] = tab[PHASE].astype(float) if PHASE in tab else np.nan
+    first = [c for c in COLUMNS if c in out]
+    return out[first + [c for c in out if c not in first]]
+
+
+class ImpedanceStore:
+    """
+    The impedance tables of all the sessions in one Parquet file, to follow the electrodes over time.
+
+    Sessions are added from the csv files of the Intan software, a session added again replaces the old one.
+    The table is small, so it's rewritten whole at every addition.
+
+    :param path: the Parquet file, created at the first addition
+    :param probe: the probe mapping the channels to contacts, by default probe.get_probe()
+    """
+
+    def __init__(self, path, probe=None):
+        self.path = Path(path)
+        self.probe = probe
+        self._table = None
+
+    def table(self):
+        """
+        All the impedances, indexed by session, date and channel id.
+        """
+        if self._table is None:
+            if self.path.exists():
+                self._table = pd.read_parquet(self.path)
+            else:
+                self._table = pd.DataFrame(columns=COLUMNS).set_index(INDEX)
+        return self._table
+
+    def add(self, csv_files, sessions=None, dates=None):
+        """
+        Parse impedance csv files and add them to the store.
+
+        :param csv_files: a path or a list of paths
+        :param sessions: the session name of each file, by default the name of its folder
+        :param dates: the date of each file, by default the day it was modified
+        :return: the table of the sessions added
+        """
+        if isinstance(csv_files, (str, Path)):
+            csv_files = [csv_files]
+        csv_files = [Path(f) for f in csv_files]
+        if sessions is None:
+            sessions = [f.parent.name for f in csv_files]
+        elif isinstance(sessions, str):
+            sessions = [sessions]
+        if dates is None:
+            dates = [datetime.date.fromtimestamp(f.stat().st_mtime) for f in csv_files]
+        elif not isinstance(dates, (list, tuple)):
+            dates = [dates]
+        assert len(set(sessions)) == len(sessions), 'Each file needs its own session.'
+
+        tab = pd.concat([pd.read_csv(f) for f in csv_files], keys=list(zip(sessions, dates)),
+                        names=['session', 'date', None]).reset_index(level=[0, 1])
+        new = parse_impedance_table(tab, self.probe)
+        new['date'] = pd.to_datetime(new['date'])
+        new = new.set_index(INDEX)
+
+        old = self.table()
+        old = old[~old.index.get_level_values('session').isin(sessions)]
+        table = pd.concat([old, new]) if len(old) > 0 else new
+        table = table.sort_index()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        table.to_parquet(self.path)
+        self._table = table
+        return new
+
+    def sessions(self):
+        """
+        The sessions with their date, the oldest first.
+        """
+        idx = self.table().index.to_frame(index=False)[['session', 'date']].drop_duplicates()
+        return idx.sort_values('date').set_index('session')['date']
+
+    def impedance(self, session=None):
+        """
+        The impedance of each channel in a session, as resolve_impedance_table returns it.
+
+        :param session: the session, by default the latest one
+        :return: a series mapping the channel id to its impedance
+        """
+        if session is None:
+            session = self.sessions().index[-1]
+        s = self.table().xs(session, level='session')['impedance']
+        return s.droplevel('date')
+
+    def history(self, channel_ids=None):
+        """
+        The impedance of the channels over the sessions, a row per date and a column per channel.
+        """
+        tab = self.table()['impedance'].reset_index()
+        if channel_ids is not None:
+            tab = tab[tab['channel_id'].isin([str(i) for i in channel_ids])]
+        return tab.pivot_table(index='date', columns='channel_id', values='impedance')
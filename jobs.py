@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+
+class Cancelled(Exception):
+    pass
+
+
+def get_n_jobs(n_jobs=-1):
+    """
+    Resolve the number of workers, -1 or None means all the cores.
+    """
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return max(1, n_jobs)
+
+
+def get_chunk_size(recording, chunk_duration='1s'):
+    """
+    Convert a chunk duration like '1s', '500ms' or 1.5 (seconds) to a number of frames.
+    """
+    if isinstance(chunk_duration, str):
+        if chunk_duration.endswith('ms'):
+            chunk_duration = float(chunk_duration[:-2]) / 1000
+        elif chunk_duration.endswith('s'):
+            chunk_duration = float(chunk_duration[:-1])
+        else:
+            chunk_duration = float(chunk_duration)
+    return max(1, int(chunk_duration * recording.get_sampling_frequency()))
+
+
+def chunk_ranges(recording, chunk_size, segment_index=None):
+    """
+    Split the recording into chunks.
+
+    :param recording: the recording to split
+    :param chunk_size: number of frames per chunk
+    :param segment_index: only split this segment, by default all of them
+    :return: a list of (segment_index, start_frame, end_frame)
+    """
+    segments = range(recording.get_num_segments()) if segment_index is None else [segment_index]
+    chunks = []
+    for seg in segments:
+        n = recording.get_num_samples(seg)
+        chunks += [(seg, i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+    return chunks
+
+
+def run_chunks(func, chunks, n_jobs=-1, progress=None, cancel=None):
+    """
+    Apply a function to every chunk in a thread pool. The heavy work in numpy and scipy releases the GIL,
+    so threads use all the cores while sharing the memory maps of the recordings.
+
+    :param func: called as func(*chunk)
+    :param chunks: the argument tuples, e.g. from chunk_ranges
+    :param n_jobs: number of threads, -1 for all the cores
+    :param progress: called as progress(done, total) after each chunk
+    :param cancel: a threading.Event, when set the remaining chunks are dropped and Cancelled is raised
+    :return: the results in the order of the chunks
+    """
+    name = getattr(func, '__qualname__', 'chunk').replace('.<locals>', '')
+
+    def work(chunk):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        with profiling.chunk(name):
+            return func(*chunk)
+
+    n_jobs = get_n_jobs(n_jobs)
+    results = []
+    if n_jobs == 1:
+        for c in chunks:
+            results.append(work(c))
+            if progress is not None:
+                progress(len(results), len(chunks))
+        return results
+    with ThreadPoolExecutor(n_jobs) as pool:
+        try:
+            for r in pool.map(work, chunks):
+                results.append(r)
+                if progress is not None:
+                    progress(len(results), len(chunks))
+        except BaseException:
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    return results
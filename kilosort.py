@@ -1,12 +1,146 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import spikeinterface as si
 import spikeinterface.sorters as ss
 
+import profiling
+from cache import DiskCache, fingerprint_recording, make_key
+
+
+def threshold_sorter(recording, output_folder, detect_threshold=5., dead_time_ms=1., n_before=20, n_after=40,
+                     chunk_duration=10.):
+    """
+    A lightweight stand-in for Kilosort: negative threshold crossings, each channel being one unit.
+    It writes the files of a Kilosort output in output_folder/sorter_output, as ss.run_sorter does,
+    so that everything downstream of the sorting can be run without MATLAB or a GPU.
+
+    :param recording: the preprocessed recording
+    :param output_folder: the output folder
+    :param detect_threshold: the threshold in multiples of the noise level (MAD) of each channel
+    :param dead_time_ms: the minimum interval between two spikes of a channel
+    :param n_before: the frames before the peak in the templates
+    :param n_after: the frames after the peak in the templates
+    :param chunk_duration: the duration in seconds of the chunks to detect on
+    :return: the sorting
+    """
+    folder = Path(output_folder) / 'sorter_output'
+    folder.mkdir(parents=True, exist_ok=True)
+    fs = recording.get_sampling_frequency()
+    num_channels = recording.get_num_channels()
+    dead_time = int(dead_time_ms * fs / 1000)
+    chunk = int(chunk_duration * fs)
+    n = recording.get_num_samples(0)
+    noise = np.median(np.abs(si.get_random_data_chunks(recording, seed=0)), axis=0) / 0.6745
+    times, channels, amplitudes = [], [], []
+    for start in range(0, n, chunk):
+        tr = recording.get_traces(start_frame=start, end_frame=min(n, start + chunk)).astype(np.float32)
+        # local minima under the threshold
+        below = tr < -detect_threshold * noise
+        below[1:-1] &= (tr[1:-1] <= tr[:-2]) & (tr[1:-1] < tr[2:])
+        below[[0, -1]] = False
+        t, c = np.nonzero(below)
+        times.append(t + start)
+        channels.append(c)
+        amplitudes.append(-tr[t, c])
+    times, channels, amplitudes = np.concatenate(times), np.concatenate(channels), np.concatenate(amplitudes)
+    order = np.lexsort((times, channels))
+    times, channels, amplitudes = times[order], channels[order], amplitudes[order]
+    keep = np.ones(len(times), dtype=bool)
+    keep[1:] = (channels[1:] != channels[:-1]) | (np.diff(times) > dead_time)
+    times, channels, amplitudes = times[keep], channels[keep], amplitudes[keep]
+    order = np.argsort(times, kind='stable')
+    times, channels, amplitudes = times[order], channels[order], amplitudes[order]
+
+    templates = np.zeros((num_channels, n_before + n_after, num_channels), dtype=np.float32)
+    for c in range(num_channels):
+        t = times[channels == c]
+        t = t[(t >= n_before) & (t < n - n_after)][:100]
+        if len(t) > 0:
+            snippets = [recording.get_traces(start_frame=i - n_before, end_frame=i + n_after) for i in t]
+            templates[c] = np.mean(snippets, axis=0)
+
+    np.save(folder / 'spike_times.npy', times.astype(np.uint64)[:, None])
+    np.save(folder / 'spike_clusters.npy', channels.astype(np.int32))
+    np.save(folder / 'spike_templates.npy', channels.astype(np.int32)[:, None])
+    np.save(folder / 'amplitudes.npy', amplitudes.astype(np.float64)[:, None])
+    np.save(folder / 'templates.npy', templates)
+    np.save(folder / 'channel_map.npy', np.arange(num_channels, dtype=np.int32)[:, None])
+    np.save(folder / 'channel_positions.npy', recording.get_channel_locations().astype(np.float64))
+    pd.DataFrame({'cluster_id': np.arange(num_channels), 'KSLabel': 'good'}).to_csv(
+        folder / 'cluster_KSLabel.tsv', sep='\t', index=False)
+    with open(folder / 'params.py', 'w') as f:
+        f.write(f"dat_path = 'recording.dat'\nn_channels_dat = {num_channels}\ndtype = 'float32'\noffset = 0\n"
+                f"sample_rate = {fs}\nhp_filtered = True\n")
+    return si.NumpySorting.from_times_labels(times, channels, fs)
+
 
-def kilosort(recording, output_folder=None, docker=False, verbose=False):
-    sorting_KS2 = ss.run_sorter(sorter_name="kilosort2_5", recording=recording, output_folder=output_folder,
-                                docker_image=docker, verbose=verbose)
+def sort_key(recording, sorter_name, sorter_params):
+    """
+    The cache key of a sorting: the fingerprint of the input, with its files, channels and probe,
+    the sorter and its parameters.
+    """
+    return make_key('sort', fingerprint_recording(recording), sorter_name, sorter_params)
+
+
+def kilosort(recording, output_folder=None, docker=False, verbose=False, cache: DiskCache = None,
+             sorter_name='kilosort2_5', sorter=None, **sorter_params):
+    """
+    Run the sorter, or return its stored result for the same recording and parameters.
+
+    :param recording: the preprocessed recording
+    :param output_folder: the output folder of the sorter, unused with a cache, whose entry holds it
+    :param docker: the docker image to run the sorter in, or False
+    :param verbose: print the sorter's output and the result
+    :param cache: a DiskCache, to reuse the sortings
+    :param sorter_name: the spikeinterface sorter
+    :param sorter: called as sorter(recording, output_folder, **sorter_params) instead of ss.run_sorter,
+        e.g. threshold_sorter, its name should be given as sorter_name as it's part of the key
+    :param sorter_params: the parameters of the sorter
+    :return: the sorting, with a cache its 'sorter_output_folder' annotation is the output folder in the entry
+    """
+    @profiling.profiled('run_sorter')
+    def run(folder):
+        if sorter is not None:
+            return sorter(recording, folder, **sorter_params)
+        return ss.run_sorter(sorter_name=sorter_name, recording=recording, output_folder=folder,
+                             docker_image=docker, verbose=verbose, **sorter_params)
+
+    if cache is None:
+        sorting = run(output_folder)
+    else:
+        key = sort_key(recording, sorter_name, sorter_params)
+        hit = cache.get(key)
+        if hit is None:
+            hit = cache.put(key, lambda f: run(f / 'output').save(folder=f / 'sorting'), kind='sort',
+                            description={'sorter_name': sorter_name, 'sorter_params': sorter_params,
+                                         'recording': make_key(fingerprint_recording(recording))})
+        elif verbose:
+            print(f'sort: reusing {hit}')
+        sorting = si.load_extractor(hit / 'sorting')
+        sorting.annotate(sorter_output_folder=str(hit / 'output'))
     if verbose:
-        print(sorting_KS2)
-    return sorting_KS2
+        print(sorting)
+    return sorting
+
+
+def invalidate_sortings(cache: DiskCache, recording=None, sorter_name=None):
+    """
+    Remove the stored sortings of a recording, of a sorter, or all of them.
+
+    :return: the keys removed
+    """
+    tab = cache.list()
+    tab = tab[tab['kind'] == 'sort']
+    if recording is not None:
+        fp = make_key(fingerprint_recording(recording))
+        tab = tab[[d.get('recording') == fp for d in tab['description']]]
+    if sorter_name is not None:
+        tab = tab[[d.get('sorter_name') == sorter_name for d in tab['description']]]
+    for k in tab.index:
+        cache.invalidate(key=k)
+    return list(tab.index)
 
 
 if __name__ == '__main__':
@@ -14,4 +148,4 @@ if __name__ == '__main__':
     s = SignalSelector('data')
     re = s.choose_and_concat(200000, 201000, 'RHD2000 amplifier channel')
     re2 = preprocess(re)
-    re3 = kilosort(re2, verbose=True)
\ No newline at end of file
+    re3 = kilosort(re2, verbose=True)
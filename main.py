@@ -1,4 +1,5 @@
 from pathlib import Path
+import profiling
 from cellexplorer import cell_metrics_gen
 from kilosort import kilosort
 from probe_gen import set_probe_for
@@ -7,11 +8,22 @@ from rhd_selection import SignalSelector
 
 
 if __name__ == '__main__':
-    s = SignalSelector('data')
-    re = s.choose_and_concat(200000, 201000, 'RHD2000 amplifier channel')
-    re2 = preprocess(re)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', default=None, help='save a profile of the run to this json, '
+                                                        f'also enabled by the {profiling.ENV} environment variable')
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+    with profiling.stage('select'):
+        s = SignalSelector('data')
+        re = s.choose_and_concat(200000, 201000, 'RHD2000 amplifier channel')
+    with profiling.stage('preprocess'):
+        re2 = preprocess(re)
     re.get_probe()
     of = 'data/output'
-    kilosort(re2, of)
-    cell_metrics_gen(of)
+    with profiling.stage('sort'):
+        kilosort(re2, of)
+    with profiling.stage('metrics'):
+        cell_metrics_gen(of)
 
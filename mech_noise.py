@@ -0,0 +1,112 @@
+import numpy as np
+from spikeinterface.core.core_tools import define_function_from_class
+from spikeinterface.preprocessing.basepreprocessor import BasePreprocessor, BasePreprocessorSegment
+
+from jobs import get_chunk_size, run_chunks
+
+
+def interval_energy(recording, window=2000, interval=200, segment_index=0, chunk_duration='1s', n_jobs=-1,
+                    progress=None, cancel=None):
+    """
+    The energy of the channel mean within a moving window, sampled every interval.
+
+    This equals the max of np.correlate(v, v) over the window used by the notebook, but with a
+    cumulative sum it's O(N) and the recording is read chunk by chunk with window margins.
+
+    :param recording: the recording to score
+    :param window: the moving window in frames
+    :param interval: the step in frames, every frame in an interval shares the score
+    :param segment_index: the segment to score
+    :param chunk_duration: the approximate duration read by each task
+    :param n_jobs: number of threads
+    :param progress: called as progress(done, total)
+    :param cancel: a threading.Event to stop the computation
+    :return: an array of ceil(num_frames / interval) energies
+    """
+    n = recording.get_num_samples(segment_index)
+    lo, hi = (interval - window) // 2, (interval + window) // 2
+    per_chunk = max(1, get_chunk_size(recording, chunk_duration) // interval)
+    num_intervals = -(-n // interval)
+
+    def score(j0, j1):
+        a = max(0, j0 * interval + lo)
+        b = min(n, (j1 - 1) * interval + hi)
+        tr = recording.get_traces(segment_index=segment_index, start_frame=a, end_frame=b)
+        cum = np.zeros(b - a + 1)
+        np.cumsum(np.square(tr.mean(axis=1, dtype=np.float64)), out=cum[1:])
+        starts = np.arange(j0, j1) * interval
+        idx0 = np.clip(starts + lo, 0, n) - a
+        idx1 = np.clip(starts + hi, 0, n) - a
+        return np.maximum(cum[idx1] - cum[np.minimum(idx0, idx1)], 0)
+
+    chunks = [(j, min(j + per_chunk, num_intervals)) for j in range(0, num_intervals, per_chunk)]
+    return np.concatenate(run_chunks(score, chunks, n_jobs, progress, cancel) or [np.zeros(0)])
+
+
+def noise_mask_from_energy(energy, noise_cap=2.5):
+    """
+    Mark the intervals whose min-max normalized energy exceeds noise_cap times the median.
+    """
+    if len(energy) == 0 or energy.max() == energy.min():
+        return np.zeros(len(energy), dtype=bool)
+    norm = (energy - energy.min()) / (energy.max() - energy.min())
+    return norm > np.median(norm) * noise_cap
+
+
+class MechanicalNoiseCleanRecording(BasePreprocessor):
+    """
+    Zero the intervals of large common-mode energy, which are mostly mechanical artifacts.
+
+    The score is computed once at construction over the whole recording in bounded memory,
+    then traces are cleaned lazily chunk by chunk.
+
+    :param recording: the recording to clean
+    :param window: the moving window in frames to compute the energy of the channel mean
+    :param interval: the step in frames, the resolution of the cleaning
+    :param noise_cap: the multiple of the median normalized energy above which an interval is cleared
+    :param noise_mask: the precomputed bad intervals of each segment, to skip the scoring
+    :param n_jobs: number of threads for the scoring
+    :param chunk_duration: the duration read by each scoring task
+    :param progress: called as progress(done, total) as the scoring advances
+    :param cancel: a threading.Event to stop the scoring
+    """
+    name = 'clean_mechanical_noise'
+
+    def __init__(self, recording, window=2000, interval=200, noise_cap=2.5, noise_mask=None, n_jobs=-1,
+                 chunk_duration='1s', progress=None, cancel=None):
+        BasePreprocessor.__init__(self, recording)
+        if noise_mask is None:
+            noise_mask = []
+            for seg in range(recording.get_num_segments()):
+                energy = interval_energy(recording, window, interval, seg, chunk_duration, n_jobs, progress, cancel)
+                noise_mask.append(noise_mask_from_energy(energy, noise_cap))
+        noise_mask = [np.asarray(m, dtype=bool) for m in noise_mask]
+        for parent_segment, mask in zip(recording._recording_segments, noise_mask):
+            self.add_recording_segment(MechanicalNoiseCleanRecordingSegment(parent_segment, mask, interval))
+        self.noise_mask = noise_mask
+
+        self._kwargs = dict(recording=recording, window=window, interval=interval, noise_cap=noise_cap,
+                            noise_mask=noise_mask)
+
+
+class MechanicalNoiseCleanRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, noise_mask, interval):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.noise_mask = noise_mask
+        self.interval = interval
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_samples()
+        traces = self.parent_recording_segment.get_traces(start_frame, end_frame, channel_indices)
+        bad = self.noise_mask[np.arange(start_frame, end_frame) // self.interval]
+        if bad.any():
+            traces = traces.copy()
+            traces[bad] = 0
+        return traces
+
+
+clean_mechanical_noise = define_function_from_class(source_class=MechanicalNoiseCleanRecording,
+                                                    name='clean_mechanical_noise')
@@ -1,19 +1,331 @@
+import json
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+import spikeinterface as si
 import spikeinterface.preprocessing as spre
+from probeinterface import write_probeinterface, read_probeinterface
+
+from cache import DiskCache, fingerprint_recording, make_key
+from filters import cascade_sos, filter_chunk, sos_margin
+import profiling
+from jobs import chunk_ranges, get_chunk_size, run_chunks
+from probe import channel_neighbors
+from reference import LocalReference
+
+
+def local_neighbors(recording, local_radius=(30, 55)):
+    """
+    The channels in the annulus around each channel, as spre.common_reference selects them.
+    """
+    neighbors = channel_neighbors(recording.get_channel_locations(), annulus=local_radius)
+    assert all(len(i) > 0 for i in neighbors), 'No reference channels available in the local annulus for selection.'
+    return neighbors
+
+
+def preprocess(recording, low=300, high=6000, order=5, iterations=1, direction='forward-backward', reference='global',
+               operator='median', local_radius=(30, 55), folder=None, n_jobs=-1, chunk_duration='1s', verbose=False,
+               progress=None, cancel=None, cache=None, dtype='float32', compression=None, steps_per_noise=32.):
+    """
+    Bandpass filter and common reference the recording in a single pass, and save it as float32 binary.
+
+    Each chunk is read once with margins sized to the filter's impulse response, filtered by the whole cascade,
+    referenced in place and written directly to the output memmap. Chunks are processed in a thread pool.
+
+    As int16 the traces are quantized with a gain per channel, a fraction of its noise estimated on a few chunks
+    first, and the gains are stored as gain_to_uV. The int16 binary is half the size, and Kilosort reads it in place
+    instead of copying it. With compression each chunk is compressed apart into one file per segment, read back by
+    compressed.CompressedRecording, for archival: the zlib fallback reads a chunk about 15 times slower than the
+    binary, as inflating dominates, see benchmark_formats.
+
+    :param recording: the recording to preprocess
+    :param low: the low cutoff in Hz
+    :param high: the high cutoff in Hz
+    :param order: the Butterworth order
+    :param iterations: the number of times the bandpass is applied, compiled into one cascade
+    :param direction: 'forward-backward' for zero phase, 'forward' for causal
+    :param reference: 'global', 'local' or None to skip referencing
+    :param operator: 'median' or 'average'
+    :param local_radius: the excluding and including radius in um for the local reference
+    :param folder: the output folder, by default a new one in spikeinterface's temporary folder
+    :param n_jobs: number of threads, -1 for all the cores
+    :param chunk_duration: the duration of each chunk
+    :param verbose: print the progress and the result
+    :param progress: called as progress(done, total)
+    :param cancel: a threading.Event to stop the run
+    :param cache: a DiskCache, to reuse the output of the same recording and parameters
+    :param dtype: 'float32' or 'int16'
+    :param compression: a codec of compressed.Codec, True for compressed.default_codec(), None for plain binary
+    :param steps_per_noise: the int16 steps per standard deviation of the noise of each channel, 32 leaves a
+        quantization error of 1% of the noise and clips beyond 1000 times the noise
+    :return: the preprocessed binary recording
+    """
+    assert dtype in ('float32', 'int16')
+    if compression is True:
+        from compressed import default_codec
+        compression = default_codec()
+    params = dict(low=low, high=high, order=order, iterations=iterations, direction=direction, reference=reference,
+                  operator=operator, local_radius=list(local_radius))
+    # the default output keeps the keys of the caches written before these options
+    if dtype != 'float32' or compression is not None:
+        params.update(dtype=dtype, compression=compression, steps_per_noise=steps_per_noise)
+    if cache is not None:
+        key = make_key('preprocess', fingerprint_recording(recording), params)
+        hit = cache.get(key)
+        if hit is None:
+            hit = cache.put(key, lambda f: preprocess(recording, folder=f, n_jobs=n_jobs, chunk_duration=chunk_duration,
+                                                      verbose=verbose, progress=progress, cancel=cancel, **params),
+                            kind='preprocess', description=params)
+        elif verbose:
+            print(f'preprocess: reusing {hit}')
+        return load_preprocessed(hit)
+
+    fs = recording.get_sampling_frequency()
+    num_channels = recording.get_num_channels()
+    sos = cascade_sos(low, high, fs, order, iterations)
+    margin = sos_margin(sos, fs)
+    op = np.median if operator == 'median' else np.mean
+    local_ref = LocalReference(local_neighbors(recording, local_radius), operator) if reference == 'local' else None
+
+    folder = Path(folder) if folder is not None else si.get_global_tmp_folder() / f'preprocess_{uuid.uuid4().hex[:8]}'
+    folder.mkdir(parents=True, exist_ok=True)
+    chunk_size = get_chunk_size(recording, chunk_duration)
+    chunks = chunk_ranges(recording, chunk_size)
+    num_segments = recording.get_num_segments()
+    if compression is None:
+        files = [folder / f'traces_seg{i}.raw' for i in range(num_segments)]
+        outputs = [np.memmap(f, dtype=dtype, mode='w+', shape=(recording.get_num_samples(i), num_channels))
+                   for i, f in enumerate(files)]
+    else:
+        from compressed import ChunkWriter, Codec
+        codec = Codec(compression)
+        files = [folder / f'traces_seg{i}.chunks' for i in range(num_segments)]
+        outputs = [ChunkWriter(f, -(-recording.get_num_samples(i) // chunk_size), codec) for i, f in enumerate(files)]
+
+    def read(seg, a, b):
+        # decoding the source, e.g. read_intan, apart from the filter
+        with profiling.chunk('preprocess.read'):
+            return recording.get_traces(segment_index=seg, start_frame=a, end_frame=b)
+
+    def process(seg, start, end):
+        tr = filter_chunk(sos, lambda a, b: read(seg, a, b), start, end, recording.get_num_samples(seg), margin,
+                          direction)
+        with profiling.chunk('preprocess.reference'):
+            if reference == 'global':
+                tr -= op(tr, axis=1, keepdims=True)
+            elif reference == 'local':
+                local_ref(tr)
+        return tr
+
+    scales, clipped = None, [0]
+    if dtype == 'int16':
+        with profiling.stage('preprocess.noise'):
+            # the noise of each channel from the MAD of a few chunks spread over the recording
+            sample = [chunks[i] for i in np.unique(np.linspace(0, len(chunks) - 1, min(10, len(chunks))).astype(int))]
+            mad = np.median([np.median(np.abs(tr - np.median(tr, axis=0)), axis=0)
+                             for tr in run_chunks(process, sample, n_jobs)], axis=0)
+            noise = mad / .6745
+            scales = np.where(noise > 0, noise / steps_per_noise, 1.).astype(np.float32)
+        lock = threading.Lock()
+
+    def work(seg, start, end):
+        tr = process(seg, start, end)
+        if scales is not None:
+            tr /= scales
+            np.rint(tr, out=tr)
+            n = np.count_nonzero((tr < -32768) | (tr > 32767))
+            if n:
+                with lock:
+                    clipped[0] += n
+                np.clip(tr, -32768, 32767, out=tr)
+            tr = tr.astype(np.int16)
+        with profiling.chunk('preprocess.write'):
+            if compression is None:
+                outputs[seg][start: end] = tr
+            else:
+                outputs[seg].write(start // chunk_size, tr)
+
+    def report(done, total):
+        if verbose and (done == total or done % 100 == 0):
+            print(f'preprocess: {done}/{total} chunks')
+        if progress is not None:
+            progress(done, total)
+
+    run_chunks(work, chunks, n_jobs, report, cancel)
+    with profiling.stage('preprocess.flush'):
+        for o in outputs:
+            if compression is None:
+                o.flush()
+            else:
+                o.close()
+        del outputs
 
+    gains = recording.get_channel_gains() if recording.has_scaled() else None
+    if scales is not None:
+        # without gains of the source, the scales give the traces back in its units
+        gains = scales if gains is None else gains * scales
+    meta = {
+        'sampling_frequency': fs,
+        'num_channels': num_channels,
+        'dtype': dtype,
+        'channel_ids': [str(i) for i in recording.get_channel_ids()],
+        'files': [f.name for f in files],
+        'gain_to_uV': gains.tolist() if gains is not None else None,
+        'params': params,
+    }
+    if scales is not None:
+        meta['clipped'] = clipped[0]
+        if clipped[0] and verbose:
+            print(f'preprocess: {clipped[0]} samples clipped to int16')
+    if compression is not None:
+        meta.update(format='compressed', codec=compression, chunk_size=chunk_size,
+                    num_samples=[recording.get_num_samples(i) for i in range(num_segments)])
+    with open(folder / 'preprocess.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    if recording.has_probe():
+        write_probeinterface(folder / 'probe.json', recording.get_probegroup())
 
-def preprocess(recording, low, high, verbose=False):
+    recording_preprocessed = load_preprocessed(folder)
+    if verbose:
+        print(recording_preprocessed)
+    return recording_preprocessed
+
+
+def load_preprocessed(folder):
+    """
+    Open a folder written by preprocess as a memory-mapped recording.
+    """
+    folder = Path(folder)
+    with open(folder / 'preprocess.json') as f:
+        meta = json.load(f)
+    if meta.get('format') == 'compressed':
+        from compressed import CompressedRecording
+        recording = CompressedRecording(folder)
+        if meta.get('gain_to_uV'):
+            recording.set_channel_gains(meta['gain_to_uV'])
+            recording.set_channel_offsets(0)
+    else:
+        recording = si.read_binary([folder / i for i in meta['files']], sampling_frequency=meta['sampling_frequency'],
+                                   dtype=meta['dtype'], num_channels=meta['num_channels'],
+                                   channel_ids=meta['channel_ids'], time_axis=0, is_filtered=True,
+                                   gain_to_uV=meta.get('gain_to_uV'),
+                                   offset_to_uV=0 if meta.get('gain_to_uV') else None)
+    if (folder / 'probe.json').exists():
+        recording = recording.set_probegroup(read_probeinterface(folder / 'probe.json'))
+    return recording
+
+
+def cached_save(recording, cache: DiskCache, verbose=False, **job_kwargs):
+    """
+    Save any lazy recording as binary through the cache, so an unchanged chain is not processed again.
+
+    :param recording: the recording to save, e.g. the notebook's chain of spre steps
+    :param cache: the DiskCache to look up
+    :param job_kwargs: passed to recording.save
+    :return: the saved recording
+    """
+    key = make_key('save', fingerprint_recording(recording))
+    hit = cache.get(key)
+    if hit is None:
+        hit = cache.put(key, lambda f: recording.save(folder=f / 'recording', format='binary', verbose=verbose,
+                                                      **job_kwargs),
+                        kind='save', description={'recording': str(recording)})
+    elif verbose:
+        print(f'save: reusing {hit}')
+    return si.load_extractor(hit / 'recording')
+
+
+def preprocess_chain(recording, low=300, high=6000, verbose=False, **job_kwargs):
+    """
+    The lazy spikeinterface chain that preprocess replaces, kept for comparison.
+    """
     recording_f = spre.filter(recording, band=[low, high])
     if verbose:
         print(recording_f)
     recording_cmr = spre.common_reference(recording_f, reference='global', operator='median')
     if verbose:
         print(recording_cmr)
-    recording_preprocessed = recording_cmr.save(format='binary')
+    recording_preprocessed = recording_cmr.save(format='binary', **job_kwargs)
     if verbose:
         print(recording_preprocessed)
     return recording_preprocessed
 
 
+def benchmark(recording, low=300, high=6000, n_jobs=-1, chunk_duration='1s'):
+    """
+    Compare the throughput of preprocess with the spikeinterface chain, in channel-seconds per wall-second.
+
+    :return: a dict of the throughputs
+    """
+    amount = recording.get_num_channels() * recording.get_total_duration()
+    result = {}
+    t = time.perf_counter()
+    preprocess_chain(recording, low, high)
+    result['chain'] = amount / (time.perf_counter() - t)
+    t = time.perf_counter()
+    preprocess_chain(recording, low, high, n_jobs=n_jobs, chunk_duration=chunk_duration)
+    result['chain_parallel'] = amount / (time.perf_counter() - t)
+    t = time.perf_counter()
+    preprocess(recording, low, high, n_jobs=n_jobs, chunk_duration=chunk_duration)
+    result['fused'] = amount / (time.perf_counter() - t)
+    for k, v in result.items():
+        print(f'{k}: {v:.0f} channel-seconds/s')
+    return result
+
+
+def benchmark_formats(recording, folder, formats=None, n_jobs=-1, chunk_duration='1s', num_random=50, seed=0):
+    """
+    Compare the output formats of preprocess: the footprint on disk, the throughput of the writing and of
+    reading it back in order by chunks as Kilosort does, the time to read a random chunk, and the quantization
+    error against float32 in standard deviations of the noise.
+
+    :param recording: the recording to preprocess
+    :param folder: where the outputs are written, one subfolder per format
+    :param formats: a list of (dtype, compression), by default float32 and int16, plain and compressed
+    :return: a table by format
+    """
+    import pandas as pd
+    from compressed import default_codec, folder_size
+    folder = Path(folder)
+    if formats is None:
+        formats = [('float32', None), ('int16', None), ('int16', True), ('float32', True)]
+    amount = recording.get_num_channels() * recording.get_total_duration()
+    chunk_size = get_chunk_size(recording, chunk_duration)
+    n = recording.get_num_samples(0)
+    starts = np.random.default_rng(seed).integers(0, max(1, n - chunk_size), num_random)
+    rows, reference = [], None
+    for dtype, compression in formats:
+        name = f'{dtype}_{(default_codec() if compression is True else compression) or "binary"}'
+        t = time.perf_counter()
+        re = preprocess(recording, folder=folder / name, n_jobs=n_jobs, chunk_duration=chunk_duration,
+                        dtype=dtype, compression=compression)
+        write = time.perf_counter() - t
+        # the sums touch every sample, the traces of a binary are lazy views of its memmap
+        t = time.perf_counter()
+        for i in range(0, n, chunk_size):
+            np.asarray(re.get_traces(start_frame=i, end_frame=min(n, i + chunk_size))).sum()
+        read = time.perf_counter() - t
+        t = time.perf_counter()
+        for i in starts:
+            np.asarray(re.get_traces(start_frame=i, end_frame=i + chunk_size)).sum()
+        random_ms = (time.perf_counter() - t) / num_random * 1000
+        traces = re.get_traces(start_frame=0, end_frame=min(n, 10 * chunk_size), return_scaled=re.has_scaled())
+        if reference is None:
+            reference = traces.astype(np.float32)
+            noise = np.median(np.abs(reference), axis=0) / .6745
+            noise[noise == 0] = 1
+        rows.append({'format': name, 'mb': folder_size(folder / name) / 2 ** 20,
+                     'write': amount / write, 'read': amount / read, 'random_chunk_ms': random_ms,
+                     'error': float(np.max(np.abs(traces - reference) / noise))})
+        print(rows[-1])
+    table = pd.DataFrame(rows).set_index('format')
+    table['ratio'] = table['mb'] / table['mb'].iloc[0]
+    return table
+
+
 if __name__ == '__main__':
     from rhd_selection import *
     s = SignalSelector('data')
@@ -0,0 +1,219 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.signal
+
+from bad_channels import BadChannelAnalysis
+from cache import make_key
+from filters import cascade_sos, sos_margin
+from jobs import Cancelled, get_chunk_size
+from mech_noise import interval_energy, noise_mask_from_energy
+from preproc import local_neighbors
+from reference import LocalReference
+
+TRACE_STAGES = ['raw', 'mech', 'butter', 'reref']
+
+
+class PreviewPipeline:
+    """
+    Evaluate the QC stages only on a time window, caching the output of every stage for every chunk.
+
+    A stage's output is keyed by the parameters of all the stages up to it, so changing a downstream
+    parameter, like the filter cutoff, reuses the upstream chunks. The channel removals and the mechanical
+    noise mask are global and memoized by their parameters as well. The bad channels and the noise mask read
+    the whole recording, so they're computed on background threads: until they're ready the channels are all
+    kept and the mech stage passes the traces through unmasked without caching them.
+
+    :param recording: the input recording
+    :param impedance: the series from resolve_impedance_table, for the 'channel' stage
+    :param chunk_duration: the duration of the cached chunks
+    :param max_bytes: the memory budget of the chunk cache
+    :param bad_channels: the BadChannelAnalysis of the recording, to share its statistics with run_qc
+    :param on_ready: called from the background thread when the bad channels or a noise mask are ready,
+        to render again
+    """
+
+    def __init__(self, recording, impedance=None, chunk_duration='1s', max_bytes=2 ** 30, bad_channels=None,
+                 on_ready=None):
+        self.recording = recording
+        self.bad_channels = bad_channels if bad_channels is not None else BadChannelAnalysis(recording)
+        self.impedance = impedance
+        self.chunk_size = get_chunk_size(recording, chunk_duration)
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.nbytes = 0
+        self.memo = {}
+        self.on_ready = on_ready
+        self.pending = {}
+        self.lock = threading.Lock()
+        # the index of the first stage whose chunks aren't cached in the current call, as they lack the mask
+        self.skip_from = None
+
+    def _memo(self, key, func):
+        if key not in self.memo:
+            self.memo[key] = func()
+        return self.memo[key]
+
+    def _background(self, key, func):
+        """
+        The result of func(cancel) computed once on a background thread, None until it's ready.
+        A computation of the same kind, the first item of the key, with other parameters is stale and cancelled.
+        """
+        with self.lock:
+            if key in self.memo:
+                return self.memo[key]
+            if key in self.pending:
+                return None
+            for k, cancel in list(self.pending.items()):
+                if k[0] == key[0]:
+                    cancel.set()
+            cancel = threading.Event()
+            self.pending[key] = cancel
+
+        def work():
+            try:
+                result = func(cancel)
+            except Cancelled:
+                with self.lock:
+                    self.pending.pop(key, None)
+                return
+            except BaseException:
+                with self.lock:
+                    self.pending.pop(key, None)
+                raise
+            with self.lock:
+                self.memo[key] = result
+                self.pending.pop(key, None)
+            if self.on_ready is not None:
+                self.on_ready()
+
+        threading.Thread(target=work, daemon=True).start()
+        return None
+
+    def waiting(self):
+        """
+        The kinds of the computations in the background, 'neighbor' or 'mech'.
+        """
+        with self.lock:
+            return sorted({k[0] for k in self.pending})
+
+    def _mask(self, key, kept, kw, seg):
+        """
+        The noise mask of a segment, None while it's computed in the background.
+        """
+        return self._background(('mech', key, seg), lambda cancel: noise_mask_from_energy(
+            interval_energy(kept, kw['window'], kw['interval'], seg, cancel=cancel), kw['noise_cap']))
+
+    def kept(self, params):
+        """
+        The recording after the channel removal stages. The bad channels are detected in the background,
+        the channels are all kept until they're known.
+        """
+        re = self.recording
+        if params.get('channel') is not None:
+            thr = params['channel']['threshold']
+            re = re.remove_channels([c for c in re.get_channel_ids() if self.impedance[c] > thr])
+        if params.get('neighbor') is not None:
+            ids = re.get_channel_ids()
+            bd = self._background(('neighbor', make_key([str(i) for i in ids], params['neighbor'])),
+                                  lambda cancel: self.bad_channels.detect(channel_ids=ids, cancel=cancel,
+                                                                          **params['neighbor'])[0])
+            if bd is not None:
+                re = re.remove_channels(bd)
+        return re
+
+    def _stages(self, params, kept):
+        # the active trace stages with the key of everything upstream of them
+        stages = []
+        parts = [[str(i) for i in kept.get_channel_ids()]]
+        for s in TRACE_STAGES:
+            if s != 'raw' and params.get(s) is None:
+                continue
+            parts.append([s, params.get(s)])
+            stages.append((s, params.get(s), make_key(*parts)))
+        return stages
+
+    def _store(self, key, value):
+        self.chunks[key] = value
+        self.nbytes += value[1].nbytes
+        while self.nbytes > self.max_bytes and len(self.chunks) > 1:
+            _, (_, old) = self.chunks.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def _chunk(self, stages, k, kept, seg, c, channels):
+        """
+        The output of stage k for chunk c on the given channels, from the cache when it holds them.
+        """
+        name, kw, key = stages[k]
+        hit = self.chunks.get((key, seg, c))
+        if hit is not None and set(channels) <= set(hit[0]):
+            self.chunks.move_to_end((key, seg, c))
+            index = {ch: i for i, ch in enumerate(hit[0])}
+            return hit[1][:, [index[ch] for ch in channels]]
+        n = kept.get_num_samples(seg)
+        start, end = c * self.chunk_size, min((c + 1) * self.chunk_size, n)
+
+        if name == 'raw':
+            out = kept.get_traces(segment_index=seg, start_frame=start, end_frame=end, channel_ids=channels)
+            out = out.astype(np.float32)
+        elif name == 'mech':
+            # the score is global, computed once over the kept channels as the mech stage follows the raw one
+            mask = self._mask(key, kept, kw, seg)
+            out = self._chunk(stages, k - 1, kept, seg, c, channels).copy()
+            if mask is None:
+                self.skip_from = k
+            else:
+                out[mask[np.arange(start, end) // kw['interval']]] = 0
+        elif name == 'butter':
+            fs = kept.get_sampling_frequency()
+            sos = self._memo(('sos', key), lambda: cascade_sos(kw['low'], kw['high'], fs, kw['order'],
+                                                               kw['iterations']))
+            margin = self._memo(('margin', key), lambda: sos_margin(sos, fs))
+            m = -(-margin // self.chunk_size)
+            first, last = max(0, c - m), min(-(-n // self.chunk_size), c + m + 1)
+            tr = np.concatenate([self._chunk(stages, k - 1, kept, seg, i, channels) for i in range(first, last)])
+            a = max(first * self.chunk_size, start - margin)
+            tr = tr[a - first * self.chunk_size: end + margin - first * self.chunk_size]
+            out = scipy.signal.sosfiltfilt(sos, tr, axis=0)[start - a: end - a].astype(np.float32)
+        else:
+            tr = self._chunk(stages, k - 1, kept, seg, c, channels)
+            if kw.get('reference', 'global') == 'local':
+                local_ref = self._memo(('local', key), lambda: LocalReference(
+                    local_neighbors(kept, kw.get('local_radius', (30, 55))), kw.get('operator', 'median'), n_jobs=-1))
+                out = local_ref(tr.copy())
+            else:
+                op = np.median if kw.get('operator', 'median') == 'median' else np.mean
+                out = tr - op(tr, axis=1, keepdims=True)
+        if self.skip_from is None or k < self.skip_from:
+            self._store((key, seg, c), (list(channels), out))
+        return out
+
+    def get_traces(self, params, start_frame, end_frame, channel_ids=None, segment_index=0):
+        """
+        The output of the QC stages on a window.
+
+        :param params: the stage parameters, as for run_qc
+        :param start_frame: start of the window
+        :param end_frame: end of the window
+        :param channel_ids: the visible channels, by default all that are kept
+        :param segment_index: the segment
+        :return: (channel ids, traces) where the channel ids are the visible ones not removed
+        """
+        kept = self.kept(params)
+        ids = list(kept.get_channel_ids())
+        visible = ids if channel_ids is None else [i for i in channel_ids if i in ids]
+        if len(visible) == 0:
+            return visible, np.zeros((end_frame - start_frame, 0), dtype=np.float32)
+        stages = self._stages(params, kept)
+        # the mean of the noise score and the reference use all the channels, other stages only the visible
+        spatial = params.get('mech') is not None or params.get('reref') is not None
+        channels = ids if spatial else visible
+        c0, c1 = start_frame // self.chunk_size, -(-end_frame // self.chunk_size)
+        cols = [channels.index(i) for i in visible]
+        self.skip_from = None
+        blocks = [self._chunk(stages, len(stages) - 1, kept, segment_index, c, channels)[:, cols]
+                  for c in range(c0, c1)]
+        self.skip_from = None
+        a = c0 * self.chunk_size
+        return visible, np.concatenate(blocks, axis=0)[start_frame - a: end_frame - a]
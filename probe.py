@@ -1,4 +1,14 @@
+import copy
+import hashlib
+import inspect
+import os
+import threading
+import uuid
+from pathlib import Path
+
 import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
 
 from probeinterface import Probe, ProbeGroup
 from probeinterface.plotting import plot_probe, plot_probe_group
@@ -234,3 +244,199 @@ def my_probe():
     return multi_shank
 
 
+
+PROBES = {'my_probe': my_probe}
+PROBE_FOLDER = Path(__file__).resolve().parent / 'probes'
+_probes = {}
+_indices = {}
+_matches = {}
+
+
+def probe_hash(probe):
+    """
+    A hash of the geometry and wiring of a probe, the contacts with their shapes and the device channel indices.
+    """
+    h = hashlib.sha1(probe.to_numpy(complete=True).tobytes())
+    if probe.device_channel_indices is not None:
+        h.update(np.asarray(probe.device_channel_indices, dtype=np.int64).tobytes())
+    return h.hexdigest()
+
+
+def definition_hash(func):
+    """
+    A hash of the source of a probe function, cheap to compute in every process unlike building the probe.
+    A change in the helpers it calls goes unnoticed, delete the saved files to rebuild then.
+    """
+    try:
+        src = inspect.getsource(func).encode()
+    except (OSError, TypeError):
+        # no source, e.g. defined in an interactive session
+        code = func.__code__
+        src = code.co_code + repr(code.co_consts).encode()
+    return hashlib.sha1(src).hexdigest()
+
+
+def _registry_stem(name, folder):
+    # the files of a probe are named after the hash of its function, so changing the definition makes new ones
+    folder = Path(folder) if folder is not None else PROBE_FOLDER
+    key = (folder, name)
+    if key not in _probes:
+        stem = folder / f'{name}-{definition_hash(PROBES[name])[:16]}'
+        path = stem.with_name(stem.name + '.json')
+        if not path.exists():
+            folder.mkdir(parents=True, exist_ok=True)
+            for f in folder.glob(f'{name}-*'):
+                f.unlink(missing_ok=True)
+            tmp = folder / f'.{uuid.uuid4().hex[:8]}.json'
+            write_probeinterface(tmp, PROBES[name]())
+            os.replace(tmp, path)
+        _probes[key] = stem, read_probeinterface(path).probes[0]
+    return _probes[key]
+
+
+def get_probe(name='my_probe', folder=None):
+    """
+    A probe of the registry, built by its function in PROBES and written with probeinterface under the hash of
+    the function's source, so the file is written again when the function changes and read back otherwise.
+
+    :param name: the name in PROBES
+    :param folder: the folder of the registry, by default 'probes' next to this file
+    :return: a copy of the probe, with its device channel indices
+    """
+    return copy.deepcopy(_registry_stem(name, folder)[1])
+
+
+class NeighborIndex:
+    """
+    The neighbors of every contact of a probe, in CSR matrices computed once per radius with a KD-tree.
+
+    The matrices are over all the contacts, the neighbors among the channels left after removing some are
+    the rows and columns of their contact indices, so removing channels never recomputes distances.
+    The contact positions and the matrices are saved in a npz file, the tree is rebuilt from the positions.
+
+    :param positions: the contact positions
+    :param path: the npz file to save new matrices into
+    """
+
+    def __init__(self, positions, path=None):
+        self.positions = np.asarray(positions, dtype=float)
+        self.tree = cKDTree(self.positions)
+        self.path = path
+        self.matrices = {}
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            index = cls(f['positions'], path)
+            for k in f.files:
+                if k.endswith(':indptr'):
+                    key = k[:-len(':indptr')]
+                    n = len(index.positions)
+                    index.matrices[key] = scipy.sparse.csr_matrix(
+                        (np.ones(len(f[f'{key}:indices']), dtype=bool), f[f'{key}:indices'], f[k]), shape=(n, n))
+        return index
+
+    def save(self, path=None):
+        path = Path(path if path is not None else self.path)
+        with self.lock:
+            arrays = {'positions': self.positions}
+            for k, m in self.matrices.items():
+                arrays[f'{k}:indptr'] = m.indptr
+                arrays[f'{k}:indices'] = m.indices
+            # written aside and renamed, so other processes never load a partial file
+            tmp = path.with_name(f'.{uuid.uuid4().hex[:8]}.npz')
+            with open(tmp, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, path)
+
+    def _matrix(self, key, max_distance, keep):
+        with self.lock:
+            if key not in self.matrices:
+                pairs = self.tree.sparse_distance_matrix(self.tree, max_distance, output_type='ndarray')
+                pairs = pairs[(pairs['i'] != pairs['j']) & keep(pairs['v'])]
+                n = len(self.positions)
+                m = scipy.sparse.csr_matrix((np.ones(len(pairs), dtype=bool), (pairs['i'], pairs['j'])),
+                                            shape=(n, n))
+                m.sort_indices()
+                self.matrices[key] = m
+                if self.path is not None:
+                    self.save()
+            return self.matrices[key]
+
+    def radius(self, radius, contact_indices=None):
+        """
+        The contacts closer than the radius, as neighborhood_r2 selects them.
+
+        :param radius: the radius in um
+        :param contact_indices: the contacts left, by default all
+        :return: a CSR matrix over the contacts left
+        """
+        m = self._matrix(f'radius_{float(radius)}', radius, lambda d: d < radius)
+        return m if contact_indices is None else m[contact_indices][:, contact_indices]
+
+    def annulus(self, inner, outer, contact_indices=None):
+        """
+        The contacts further than the inner radius and not further than the outer one, as the local
+        common_reference selects them.
+        """
+        m = self._matrix(f'annulus_{float(inner)}_{float(outer)}', outer, lambda d: (d > inner) & (d <= outer))
+        return m if contact_indices is None else m[contact_indices][:, contact_indices]
+
+    def match(self, locations):
+        """
+        The contact index of each location, or None if some are not contacts of this probe.
+        """
+        dist, indices = self.tree.query(np.asarray(locations, dtype=float), distance_upper_bound=1e-6)
+        return None if np.isinf(dist).any() else indices
+
+
+def get_neighbor_index(name='my_probe', folder=None, radii=(30.,), annuli=((30., 55.),)):
+    """
+    The NeighborIndex of a probe of the registry, built and saved along with the probe the first time.
+
+    :param radii: the radii to compute when building, the defaults of the pipeline
+    :param annuli: the (inner, outer) radii to compute when building
+    """
+    stem, probe = _registry_stem(name, folder)
+    path = stem.with_name(stem.name + '_neighbors.npz')
+    if path not in _indices:
+        if path.exists():
+            _indices[path] = NeighborIndex.load(path)
+        else:
+            index = NeighborIndex(probe.contact_positions)
+            for r in radii:
+                index.radius(r)
+            for a in annuli:
+                index.annulus(*a)
+            index.save(path)
+            index.path = path
+            _indices[path] = index
+    return _indices[path]
+
+
+def channel_neighbors(locations, radius=None, annulus=None, folder=None):
+    """
+    The neighbors of each channel from its location, looked up in the index of the registered probe the
+    channels belong to, or computed from the locations when they're of no registered probe.
+
+    :param locations: the channel locations, e.g. from recording.get_channel_locations()
+    :param radius: the radius for neighbors closer than it
+    :param annulus: the (inner, outer) radii for neighbors in the annulus
+    :param folder: the folder of the registry
+    :return: a list of the indices of the neighbors of each channel
+    """
+    locations = np.asarray(locations, dtype=float)
+    key = (locations.tobytes(), locations.shape, folder)
+    if key not in _matches:
+        _matches[key] = NeighborIndex(locations), None
+        for name in PROBES:
+            index = get_neighbor_index(name, folder)
+            indices = index.match(locations)
+            if indices is not None:
+                _matches[key] = index, indices
+                break
+    index, indices = _matches[key]
+    m = index.radius(radius, indices) if radius is not None else index.annulus(*annulus, indices)
+    m.sort_indices()
+    return [m.indices[a: b] for a, b in zip(m.indptr[:-1], m.indptr[1:])]
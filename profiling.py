@@ -0,0 +1,231 @@
+import atexit
+import contextlib
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from pathlib import Path
+
+# set to the path of the report, or to 1 for profile.json, to profile a run
+ENV = 'PIPELINE_PROFILE'
+
+_profiler = None
+_listeners = []
+_null = contextlib.nullcontext()
+
+
+def _io():
+    # the bytes read and written by the process, through syscalls and from the storage
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return {k: int(io[k]) for k in ('rchar', 'wchar', 'read_bytes', 'write_bytes')}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler:
+    """
+    Record spans of the pipeline: stages with their wall and CPU time, peak RSS and I/O, and the chunks
+    with their wall and thread CPU time only, which are cheap enough to take per chunk.
+
+    :param path: the JSON report, the Chrome trace is saved next to it as .trace.json
+    """
+
+    def __init__(self, path='profile.json'):
+        self.path = Path(path)
+        self.pid = os.getpid()
+        self.t0 = time.perf_counter()
+        self.started = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, cat='stage', **args):
+        full = cat == 'stage'
+        begin = {'name': name, 'cat': cat, 'ph': 'B', 'tid': threading.get_ident(), 'args': args}
+        for listener in _listeners:
+            listener(begin)
+        wall = time.perf_counter()
+        cpu = time.process_time() if full else time.thread_time()
+        io = _io() if full else None
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = dict(begin, ph='X', ts=wall - self.t0, dur=end - wall,
+                         cpu=(time.process_time() if full else time.thread_time()) - cpu)
+            if full:
+                io2 = _io()
+                event.update({k: io2[k] - io[k] for k in io2}, rss=_rss(), peak_rss=_peak_rss())
+            with self.lock:
+                self.events.append(event)
+            for listener in _listeners:
+                listener(event)
+
+    def summary(self):
+        """
+        The spans aggregated by name: count, wall and CPU seconds, bytes read and written, and the peak RSS.
+        """
+        out = {}
+        for e in self.events:
+            s = out.setdefault(e['name'], {'cat': e['cat'], 'count': 0, 'wall': 0., 'cpu': 0.})
+            s['count'] += 1
+            s['wall'] += e['dur']
+            s['cpu'] += e['cpu']
+            for k in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+                if k in e:
+                    s[k] = s.get(k, 0) + e[k]
+            if e.get('peak_rss') is not None:
+                s['peak_rss'] = max(s.get('peak_rss', 0), e['peak_rss'])
+        return out
+
+    def save(self, path=None):
+        """
+        Write the report and the Chrome trace, to open in chrome://tracing or ui.perfetto.dev. A forked process
+        writes its own, suffixed by its pid.
+
+        :return: the paths of the report and the trace
+        """
+        path = Path(path or self.path)
+        if os.getpid() != self.pid:
+            path = path.with_name(f'{path.stem}.{os.getpid()}{path.suffix}')
+        with self.lock:
+            events = list(self.events)
+        report = {'started': self.started, 'pid': os.getpid(), 'peak_rss': _peak_rss(), 'summary': self.summary(),
+                  'events': events}
+        trace = []
+        for e in events:
+            args = dict(e['args'], **{k: e[k] for k in e if k not in ('name', 'cat', 'ph', 'tid', 'ts', 'dur', 'args')})
+            trace.append({'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'pid': os.getpid(), 'tid': e['tid'],
+                          'ts': e['ts'] * 1e6, 'dur': e['dur'] * 1e6, 'args': args})
+            if e.get('rss') is not None:
+                trace.append({'name': 'rss', 'ph': 'C', 'pid': os.getpid(), 'ts': (e['ts'] + e['dur']) * 1e6,
+                              'args': {'rss': e['rss']}})
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(report, indent=2, default=str))
+        trace_path = path.with_suffix('.trace.json')
+        trace_path.write_text(json.dumps({'traceEvents': trace, 'displayTimeUnit': 'ms'}))
+        return path, trace_path
+
+
+def enable(path='profile.json'):
+    """
+    Start profiling, the report is saved at exit or by save().
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(path)
+        atexit.register(save)
+    else:
+        _profiler.path = Path(path)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def enabled():
+    return _profiler is not None
+
+
+def save(path=None):
+    if _profiler is not None and _profiler.events:
+        return _profiler.save(path)
+
+
+def subscribe(listener):
+    """
+    Call listener(event) when a span begins (ph 'B') and when it ends (ph 'X', with its measures).
+    It's called in the thread of the span.
+    """
+    _listeners.append(listener)
+
+
+def unsubscribe(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+@contextlib.contextmanager
+def _notify(name, cat, **args):
+    # the events of a span for the listeners only, when profiling is disabled
+    begin = {'name': name, 'cat': cat, 'ph': 'B', 'tid': threading.get_ident(), 'args': args}
+    for listener in list(_listeners):
+        listener(begin)
+    wall = time.perf_counter()
+    try:
+        yield
+    finally:
+        event = dict(begin, ph='X', dur=time.perf_counter() - wall)
+        for listener in list(_listeners):
+            listener(event)
+
+
+def _span(name, cat, args):
+    if _profiler is not None:
+        return _profiler.span(name, cat, **args)
+    return _notify(name, cat, **args) if _listeners else _null
+
+
+def stage(name, **args):
+    """
+    A span of a pipeline stage. When profiling is disabled it's a no-op, or only notifies the listeners
+    when there are some.
+
+        with profiling.stage('sort', sorter='kilosort2_5'):
+            ...
+    """
+    return _span(name, 'stage', args)
+
+
+def chunk(name, **args):
+    """
+    A span of a chunk-level operation, timed without the RSS and I/O of the process.
+    """
+    return _span(name, 'chunk', args)
+
+
+def profiled(name=None, cat='stage'):
+    """
+    Decorate a function to record each call as a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.span(name or func.__qualname__, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _after_fork():
+    # a forked worker keeps the switch but not the spans of its parent
+    if _profiler is not None:
+        _profiler.lock = threading.Lock()
+        _profiler.events = []
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+if os.environ.get(ENV):
+    enable('profile.json' if os.environ[ENV].lower() in ('1', 'true', 'yes') else os.environ[ENV])
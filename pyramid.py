@@ -0,0 +1,186 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import spikeinterface as si
+import spikeinterface.widgets as sw
+
+from cache import fingerprint_recording, make_key
+from jobs import chunk_ranges, get_chunk_size, run_chunks
+
+
+def _recording_dir(recording):
+    # the folder of the files behind a binary recording, to store the pyramid next to them
+    kwargs = recording._kwargs
+    for k in ('folder_path', 'file_paths', 'file_path'):
+        if k in kwargs and kwargs[k]:
+            p = kwargs[k][0] if isinstance(kwargs[k], (list, tuple)) else kwargs[k]
+            p = Path(p)
+            return p if p.is_dir() else p.parent
+    return None
+
+
+class Pyramid:
+    """
+    Per-channel min/max envelopes at decreasing resolutions, level k has bins of base * factor ** k frames.
+
+    :param folder: the folder written by build_pyramid
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        with open(self.folder / 'pyramid.json') as f:
+            self.meta = json.load(f)
+        self.base = self.meta['base']
+        self.factor = self.meta['factor']
+        self.levels = [[np.load(self.folder / f'level{k}_seg{s}.npy', mmap_mode='r') for k in range(n)]
+                       for s, n in enumerate(self.meta['num_levels'])]
+
+    def bin_size(self, level):
+        return self.base * self.factor ** level
+
+    def envelope(self, start_frame, end_frame, channel_indices=None, width=1000, segment_index=0):
+        """
+        The envelope of the coarsest level that still has at least `width` bins in the range.
+
+        :param start_frame: start of the range
+        :param end_frame: end of the range
+        :param channel_indices: the channels to return, by default all
+        :param width: the number of bins wanted, usually the pixel width of the axes
+        :param segment_index: the segment
+        :return: (frames of the bin starts, mins, maxs), or None when raw samples should be drawn instead
+        """
+        levels = self.levels[segment_index]
+        level = None
+        for k in range(len(levels)):
+            if (end_frame - start_frame) / self.bin_size(k) >= width:
+                level = k
+        if level is None:
+            return None
+        b = self.bin_size(level)
+        i0, i1 = start_frame // b, -(-end_frame // b)
+        data = levels[level][i0: i1]
+        if channel_indices is not None:
+            data = data[:, :, channel_indices]
+        return np.arange(i0, i1) * b, np.asarray(data[:, 0]), np.asarray(data[:, 1])
+
+
+def build_pyramid(recording, folder, base=16, factor=4, n_jobs=-1, chunk_duration='1s', progress=None, cancel=None):
+    """
+    Compute the min/max envelope pyramid of a recording in one parallel pass.
+
+    :param recording: the recording
+    :param folder: the output folder
+    :param base: the number of frames in each bin of the finest level
+    :param factor: the reduction between two levels
+    :param n_jobs: number of threads
+    :param chunk_duration: the duration of each chunk
+    :return: the Pyramid
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    num_channels = recording.get_num_channels()
+    chunk_size = max(base, get_chunk_size(recording, chunk_duration) // base * base)
+    num_levels = []
+    for seg in range(recording.get_num_segments()):
+        n = recording.get_num_samples(seg)
+        level0 = np.lib.format.open_memmap(folder / f'level0_seg{seg}.npy', mode='w+', dtype='float32',
+                                           shape=(-(-n // base), 2, num_channels))
+
+        def work(seg, start, end):
+            tr = recording.get_traces(segment_index=seg, start_frame=start, end_frame=end)
+            edges = np.arange(0, end - start, base)
+            level0[start // base: start // base + len(edges), 0] = np.minimum.reduceat(tr, edges, axis=0)
+            level0[start // base: start // base + len(edges), 1] = np.maximum.reduceat(tr, edges, axis=0)
+
+        run_chunks(work, chunk_ranges(recording, chunk_size, seg), n_jobs, progress, cancel)
+        level0.flush()
+
+        # the coarser levels reduce the previous one block by block through the memmaps, level 0 of a long
+        # session doesn't fit in memory
+        prev, k = level0, 0
+        step = max(factor, chunk_size // base // factor * factor)
+        while len(prev) > factor:
+            k += 1
+            cur = np.lib.format.open_memmap(folder / f'level{k}_seg{seg}.npy', mode='w+', dtype='float32',
+                                            shape=(-(-len(prev) // factor), 2, num_channels))
+            for a in range(0, len(prev), step):
+                block = np.asarray(prev[a: a + step])
+                edges = np.arange(0, len(block), factor)
+                cur[a // factor: a // factor + len(edges), 0] = np.minimum.reduceat(block[:, 0], edges, axis=0)
+                cur[a // factor: a // factor + len(edges), 1] = np.maximum.reduceat(block[:, 1], edges, axis=0)
+            cur.flush()
+            prev = cur
+        num_levels.append(k + 1)
+
+    meta = {'base': base, 'factor': factor, 'num_levels': num_levels,
+            'channel_ids': [str(i) for i in recording.get_channel_ids()]}
+    with open(folder / 'pyramid.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return Pyramid(folder)
+
+
+def get_pyramid(recording, folder=None, **kwargs):
+    """
+    Load the pyramid of a recording, building it the first time. Pyramids are stored by the fingerprint
+    of the recording, next to its files when it's a binary recording.
+
+    :param recording: the recording
+    :param folder: where to keep the pyramids, by default next to the recording or in the temporary folder
+    :param kwargs: passed to build_pyramid
+    :return: the Pyramid
+    """
+    if folder is None:
+        folder = _recording_dir(recording)
+        folder = folder / 'pyramids' if folder is not None else si.get_global_tmp_folder() / 'pyramids'
+    folder = Path(folder) / make_key(fingerprint_recording(recording))[:16]
+    if (folder / 'pyramid.json').exists():
+        return Pyramid(folder)
+    return build_pyramid(recording, folder, **kwargs)
+
+
+def plot_timeseries(recording, ax, channel_ids=None, time_range=None, pyramid=None, width=1000, segment_index=0,
+                    show_channel_ids=True):
+    """
+    Plot the traces in constant time: the envelope from the pyramid level matching the width, or the raw
+    samples with sw.plot_timeseries when zoomed in enough.
+
+    :param recording: the recording
+    :param ax: the matplotlib axes
+    :param channel_ids: the channels to plot, by default all
+    :param time_range: (start, end) in seconds, by default the whole segment
+    :param pyramid: the Pyramid of the recording, None to always plot raw samples
+    :param width: the pixel width of the axes
+    :param segment_index: the segment
+    :param show_channel_ids: label the traces with their channel id
+    """
+    fs = recording.get_sampling_frequency()
+    if channel_ids is None:
+        channel_ids = recording.get_channel_ids()
+    if time_range is None:
+        time_range = (0, recording.get_num_samples(segment_index) / fs)
+    start, end = int(time_range[0] * fs), int(time_range[1] * fs)
+    env = None
+    if pyramid is not None and len(channel_ids) > 0:
+        env = pyramid.envelope(start, end, recording.ids_to_indices(channel_ids), width, segment_index)
+    if env is None:
+        sw.plot_timeseries(recording, ax=ax, show_channel_ids=show_channel_ids, channel_ids=channel_ids,
+                           time_range=time_range, segment_index=segment_index, add_legend=False)
+        return
+
+    frames, mins, maxs = env
+    # centered on each channel, the raw traces of Intan sit around an offset
+    center = np.median((mins.astype(np.float32) + maxs) / 2, axis=0)
+    mins, maxs = mins - center, maxs - center
+    times = frames / fs
+    spacing = 1.5 * np.median(np.percentile(maxs, 95, axis=0) - np.percentile(mins, 5, axis=0)) or 1
+    offsets = spacing * np.arange(len(channel_ids))[::-1]
+    for i in range(len(channel_ids)):
+        ax.fill_between(times, mins[:, i] + offsets[i], maxs[:, i] + offsets[i], step='post', linewidth=.5)
+    ax.set_xlim(*time_range)
+    ax.set_ylim(-spacing, offsets[0] + spacing if len(offsets) > 0 else spacing)
+    if show_channel_ids:
+        ax.set_yticks(offsets)
+        ax.set_yticklabels([str(i) for i in channel_ids])
+    else:
+        ax.set_yticks([])
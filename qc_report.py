@@ -0,0 +1,256 @@
+import html
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+import profiling
+from cache import fingerprint_recording, make_key
+from jobs import Cancelled, get_n_jobs
+
+# bump to render every tile again after changing how they look
+RENDER_VERSION = 1
+
+_worker = {}
+
+
+def _init(raw, preprocessed, raw_pyramid, preprocessed_pyramid):
+    # the recordings are passed as dicts as spikeinterface does for its own process pools
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import spikeinterface as si
+    from pyramid import Pyramid
+    _worker.update(raw=si.load_extractor(raw) if isinstance(raw, dict) else raw,
+                   preprocessed=si.load_extractor(preprocessed) if isinstance(preprocessed, dict) else preprocessed,
+                   raw_pyramid=Pyramid(raw_pyramid), preprocessed_pyramid=Pyramid(preprocessed_pyramid))
+
+
+def _render_tile(path, channel_ids, time_range, width, dpi):
+    from matplotlib.figure import Figure
+    from pyramid import plot_timeseries
+    fig = Figure(figsize=(width / dpi, max(3., .18 * len(channel_ids) + 1)), dpi=dpi)
+    pre = _worker['preprocessed']
+    kept_ids = {str(i): i for i in pre.get_channel_ids()}
+    kept = [kept_ids[str(i)] for i in channel_ids if str(i) in kept_ids]
+    axes = fig.subplots(1, 2, sharey=False)
+    plot_timeseries(_worker['raw'], axes[0], channel_ids, time_range, _worker['raw_pyramid'], width // 2)
+    axes[0].set_title('raw', fontsize=9)
+    if kept:
+        plot_timeseries(pre, axes[1], kept, time_range, _worker['preprocessed_pyramid'], width // 2)
+    else:
+        axes[1].text(.5, .5, 'all the channels removed', ha='center', va='center', transform=axes[1].transAxes)
+    axes[1].set_title('preprocessed', fontsize=9)
+    for ax in axes:
+        ax.set_xlabel('time (s)', fontsize=8)
+        ax.tick_params(labelsize=6)
+    fig.tight_layout()
+    tmp = path.with_suffix('.tmp.png')
+    fig.savefig(tmp)
+    tmp.replace(path)
+    return path
+
+
+def tiles(recording, channels_per_tile=32, window_duration=300., segment_index=0):
+    """
+    Split a session into tiles of channel blocks and time windows.
+
+    :return: a list of (channel ids, (start, end) in seconds)
+    """
+    ids = list(recording.get_channel_ids())
+    duration = recording.get_num_samples(segment_index) / recording.get_sampling_frequency()
+    starts = np.arange(0, duration, window_duration)
+    return [(ids[c: c + channels_per_tile], (float(t), float(min(duration, t + window_duration))))
+            for c in range(0, len(ids), channels_per_tile) for t in starts]
+
+
+def plot_impedance(impedance, threshold=None, ax=None):
+    """
+    The histogram of the impedance magnitudes in log scale.
+
+    :param impedance: the series from resolve_impedance_table, in ohms
+    :param threshold: the threshold of the 'channel' stage, drawn as a line
+    """
+    z = np.asarray(impedance, dtype=float)
+    z = z[np.isfinite(z) & (z > 0)]
+    ax.hist(z, bins=np.logspace(np.log10(z.min()), np.log10(z.max()) + 1e-9, 40) if len(z) else 10)
+    ax.set_xscale('log')
+    if threshold is not None:
+        ax.axvline(threshold, color='r')
+        ax.set_title(f'impedance, {(z > threshold).sum()} above {threshold:.3g}', fontsize=9)
+    else:
+        ax.set_title('impedance', fontsize=9)
+    ax.set_xlabel('impedance at 1 kHz (ohm)')
+    ax.set_ylabel('channels')
+
+
+def plot_channel_map(recording, values, label, ax=None, bad=None, removed=None):
+    """
+    The contacts of the probe colored by a value per channel, the bad channels crossed and the removed ones circled.
+
+    :param recording: the recording with a probe
+    :param values: one value per channel of the recording, nan for none
+    :param label: the name of the value
+    :param bad: the channel ids marked bad by this value
+    :param removed: the channel ids removed from the preprocessed recording
+    """
+    ids = [str(i) for i in recording.get_channel_ids()]
+    loc = recording.get_channel_locations()
+    sc = ax.scatter(loc[:, 0], loc[:, 1], c=values, s=12, cmap='viridis', plotnonfinite=True)
+    ax.figure.colorbar(sc, ax=ax, label=label)
+    for marked, kw in ((bad, dict(marker='x', c='r', s=30)), (removed, dict(marker='o', facecolors='none',
+                                                                             edgecolors='k', s=40))):
+        if marked is not None and len(marked):
+            i = np.isin(ids, [str(c) for c in marked])
+            ax.scatter(loc[i, 0], loc[i, 1], **kw)
+    ax.set_aspect('equal')
+    ax.set_title(label, fontsize=9)
+    ax.tick_params(labelsize=6)
+
+
+def _save(fig, path):
+    fig.tight_layout()
+    fig.savefig(path)
+    return path.name
+
+
+def qc_report(raw, preprocessed, folder, impedance=None, impedance_threshold=None, neighbor=None,
+              channels_per_tile=32, window_duration=300., width=1600, dpi=100, n_jobs=-1, title=None,
+              progress=None, cancel=None):
+    """
+    Render a static HTML report of a whole session without a display: the raw and preprocessed traces side by
+    side for every block of channels and time window, the impedance histogram and the maps of the bad channels.
+
+    The traces are drawn from the min/max pyramids of pyramid.py, built once per recording in folder/pyramids.
+    The tiles are rendered in a process pool with Agg, and each is named by the key of what it shows, the
+    fingerprints of both recordings and its channels and window, so rendering again only draws the tiles
+    whose recordings or parameters changed.
+
+    :param raw: the raw recording, e.g. from SignalSelector.choose_and_concat with the probe set
+    :param preprocessed: the preprocessed recording, the channels it lacks are shown as removed
+    :param folder: the report folder, with index.html
+    :param impedance: the series from resolve_impedance_table, for the histogram and the impedance map
+    :param impedance_threshold: the threshold of the 'channel' QC stage
+    :param neighbor: the arguments of BadChannelAnalysis.detect to map the r2 of the channels, None to skip it
+    :param channels_per_tile: the channels of a tile
+    :param window_duration: the seconds of a tile
+    :param width: the pixel width of a tile
+    :param dpi: the resolution of the figures
+    :param n_jobs: the rendering processes
+    :param title: the title of the report, by default the folder name
+    :param progress: called as progress(done, total) as the tiles are rendered
+    :param cancel: a threading.Event to stop the rendering, raising Cancelled
+    :return: the path of index.html
+    """
+    from matplotlib.figure import Figure
+    from pyramid import get_pyramid
+    folder = Path(folder)
+    (folder / 'tiles').mkdir(parents=True, exist_ok=True)
+    title = title or folder.resolve().name
+    t0 = time.perf_counter()
+    with profiling.stage('qc_report.pyramids'):
+        raw_pyramid = get_pyramid(raw, folder / 'pyramids', n_jobs=n_jobs)
+        pre_pyramid = get_pyramid(preprocessed, folder / 'pyramids', n_jobs=n_jobs)
+    keep = {str(i) for i in preprocessed.get_channel_ids()}
+    removed = [str(i) for i in raw.get_channel_ids() if str(i) not in keep]
+
+    # the summary figures are few and cheap, they're drawn here every time
+    figures = []
+    with profiling.stage('qc_report.summary'):
+        if impedance is not None:
+            fig = Figure(figsize=(6, 4), dpi=dpi)
+            plot_impedance(impedance, impedance_threshold, fig.add_subplot())
+            figures.append(('impedance', _save(fig, folder / 'impedance.png')))
+        if raw.has_probe():
+            maps = []
+            if impedance is not None:
+                z = np.array([impedance.get(str(i), impedance.get(i, np.nan)) for i in raw.get_channel_ids()],
+                             dtype=float)
+                bad = None if impedance_threshold is None else \
+                    [i for i, v in zip(raw.get_channel_ids(), z) if v > impedance_threshold]
+                maps.append((np.log10(z), 'log10 impedance', bad))
+            if neighbor is not None:
+                from bad_channels import BadChannelAnalysis
+                analysis = BadChannelAnalysis(raw)
+                bad, _ = analysis.detect(**neighbor)
+                chunk_kwargs = {k: neighbor[k] for k in ('highpass_filter_cutoff', 'num_random_chunks',
+                                                         'chunk_duration_s', 'seed') if k in neighbor}
+                r2 = analysis.r2(neighbor.get('neighborhood_r2_radius_um', 30.), **chunk_kwargs)
+                maps.append((r2, 'neighborhood r2', bad))
+            if not maps:
+                maps.append((np.isin([str(i) for i in raw.get_channel_ids()], removed).astype(float), 'removed',
+                             None))
+            fig = Figure(figsize=(3.5 * len(maps), 6), dpi=dpi)
+            for i, (values, label, bad) in enumerate(maps):
+                plot_channel_map(raw, values, label, fig.add_subplot(1, len(maps), i + 1), bad, removed)
+            figures.append(('channel maps', _save(fig, folder / 'channel_maps.png')))
+
+    base = make_key(fingerprint_recording(raw), fingerprint_recording(preprocessed), width, dpi, RENDER_VERSION)
+    specs = []
+    for channel_ids, time_range in tiles(raw, channels_per_tile, window_duration):
+        name = make_key(base, [str(i) for i in channel_ids], time_range)[:20] + '.png'
+        specs.append((folder / 'tiles' / name, channel_ids, time_range))
+    todo = [s for s in specs if not s[0].exists()]
+    # the tiles of other renders
+    current = {s[0].name for s in specs}
+    for f in (folder / 'tiles').glob('*.png'):
+        if f.name not in current:
+            f.unlink()
+
+    with profiling.stage('qc_report.render', tiles=len(todo), skipped=len(specs) - len(todo)):
+        n_jobs = min(get_n_jobs(n_jobs), len(todo))
+        done = 0
+        if n_jobs > 1:
+            initargs = (raw.to_dict(include_annotations=True, include_properties=True, recursive=True),
+                        preprocessed.to_dict(include_annotations=True, include_properties=True, recursive=True),
+                        raw_pyramid.folder, pre_pyramid.folder)
+            with ProcessPoolExecutor(n_jobs, initializer=_init, initargs=initargs) as pool:
+                futures = [pool.submit(_render_tile, path, ids, tr, width, dpi) for path, ids, tr in todo]
+                for fut in as_completed(futures):
+                    fut.result()
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(todo))
+                    if cancel is not None and cancel.is_set():
+                        for f in futures:
+                            f.cancel()
+                        raise Cancelled()
+        else:
+            _init(raw, preprocessed, raw_pyramid.folder, pre_pyramid.folder)
+            for path, ids, tr in todo:
+                if cancel is not None and cancel.is_set():
+                    raise Cancelled()
+                _render_tile(path, ids, tr, width, dpi)
+                done += 1
+                if progress is not None:
+                    progress(done, len(todo))
+
+    fs = raw.get_sampling_frequency()
+    summary = {'title': title, 'channels': raw.get_num_channels(), 'channels_removed': removed,
+               'sampling_frequency': fs, 'duration': raw.get_num_samples() / fs, 'tiles': len(specs),
+               'rendered': len(todo), 'seconds': time.perf_counter() - t0}
+    (folder / 'report.json').write_text(json.dumps(summary, indent=2))
+    index = folder / 'index.html'
+    index.write_text(_html(summary, figures, specs, folder))
+    return index
+
+
+def _html(summary, figures, specs, folder):
+    e = html.escape
+    rows = [f'<h1>{e(summary["title"])}</h1>',
+            f'<p>{summary["channels"]} channels, {summary["duration"]:.1f} s at {summary["sampling_frequency"]:g} Hz, '
+            f'{len(summary["channels_removed"])} channels removed: {e(" ".join(summary["channels_removed"]))}</p>',
+            f'<p>{summary["tiles"]} tiles, {summary["rendered"]} rendered in {summary["seconds"]:.1f} s</p>']
+    for name, png in figures:
+        rows.append(f'<h2>{e(name)}</h2><img src="{e(png)}">')
+    block = None
+    for path, ids, (t1, t2) in specs:
+        if ids[0] != block:
+            block = ids[0]
+            rows.append(f'<h2>channels {e(str(ids[0]))} to {e(str(ids[-1]))}</h2>')
+        rel = path.relative_to(folder).as_posix()
+        rows.append(f'<a href="{e(rel)}" title="{t1:.0f}-{t2:.0f} s"><img class="tile" src="{e(rel)}"></a>')
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>' + e(summary['title']) + '</title>\n'
+            '<style>body{font-family:sans-serif} img.tile{width:32%;margin:2px;border:1px solid #ccc}</style>'
+            '</head><body>\n' + '\n'.join(rows) + '\n</body></html>\n')
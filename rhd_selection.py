@@ -1,18 +1,162 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
+
+import numpy as np
 import pandas as pd
 import spikeinterface.extractors as se
 from spikeinterface import concatenate_recordings
 
+from jobs import get_n_jobs
+
+CATALOG_COLUMNS = ['size', 'mtime', 'num_samples', 'sampling_frequency', 'first_timestamp', 'start_time', 'channel_ids']
+
+
+def _catalog_name(stream_name):
+    return 'catalog_' + re.sub(r'\W+', '_', stream_name).strip('_').lower() + '.csv'
+
+
+def _start_time(path: Path):
+    """
+    Intan names its files as <prefix>_YYMMDD_HHMMSS.rhd, use that as the acquisition time,
+    or fall back to the modification time.
+    """
+    m = re.search(r'(\d{6})_(\d{6})$', path.stem)
+    if m is not None:
+        try:
+            return datetime.strptime(''.join(m.groups()), '%y%m%d%H%M%S').isoformat()
+        except ValueError:
+            pass
+    return datetime.fromtimestamp(path.stat().st_mtime).isoformat()
+
+
+def _first_timestamp(recording):
+    # the sample index stored in the first data block, only available for header-attached files
+    try:
+        return int(np.asarray(recording.neo_reader._raw_data['timestamp']).flat[0])
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+        return -1
+
+
+def scan_rhd(path, stream_name):
+    """
+    Parse the header of an RHD file for the catalog.
+
+    :param path: path to the .rhd file
+    :param stream_name: the neo stream to describe
+    :return: a dict of the catalog columns
+    """
+    path = Path(path)
+    st = path.stat()
+    rec = se.read_intan(path, stream_name=stream_name)
+    return {
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'num_samples': rec.get_num_samples(0),
+        'sampling_frequency': rec.get_sampling_frequency(),
+        'first_timestamp': _first_timestamp(rec),
+        'start_time': _start_time(path),
+        'channel_ids': ' '.join(map(str, rec.get_channel_ids())),
+    }
+
 
 class SignalSelector:
-    def __init__(self, rhd_dir, load_key='0'):
-        self.rhd_files = [*Path(rhd_dir).glob('*.rhd')]
-
-    def choose_and_concat(self, t1, t2, stream_name):
-        files = [se.read_intan(i, stream_name=stream_name) for i in self.data.index[to_include]]
-        print(files)
-        re = concatenate_recordings(files)
-        return re.frame_slice(start_frame=t1, end_frame=t2)
+    """
+    Select a frame range over a folder of continuous RHD files.
+
+    The headers are parsed once into a catalog saved in the folder, so that only the files
+    overlapping the requested frames need to be opened later. The catalog is updated
+    incrementally when files are added or modified.
+
+    :param rhd_dir: the folder of the RHD files
+    :param stream_name: the neo stream cataloged at once
+    :param n_jobs: the processes scanning the headers, -1 or None for all the cores
+    :param live: the acquisition is still writing the newest file, leave it out until a newer one appears
+    """
+
+    def __init__(self, rhd_dir, stream_name='RHD2000 amplifier channel', n_jobs=None, live=False):
+        self.rhd_dir = Path(rhd_dir)
+        self.n_jobs = n_jobs
+        self.live = live
+        self.rhd_files = self._list_files()
+        self._catalogs = {}
+        self.data = self.catalog(stream_name)
+
+    def _list_files(self):
+        files = sorted(self.rhd_dir.glob('*.rhd'))
+        # Intan opens the next file once the previous one is complete
+        return files[:-1] if self.live else files
+
+    def catalog(self, stream_name, refresh=False):
+        """
+        Load the catalog of a stream, scanning the new or modified files in parallel.
+
+        :param stream_name: the neo stream, e.g. 'RHD2000 amplifier channel'
+        :param refresh: rescan the folder for new files
+        :return: a table indexed by file name, sorted
+        """
+        if stream_name in self._catalogs and not refresh:
+            return self._catalogs[stream_name]
+        if refresh:
+            self.rhd_files = self._list_files()
+
+        path = self.rhd_dir / _catalog_name(stream_name)
+        if path.exists():
+            # the mtimes are compared exactly, the default parser doesn't give back the floats written
+            cat = pd.read_csv(path, index_col=0, dtype={'channel_ids': str}, keep_default_na=False,
+                              float_precision='round_trip')
+        else:
+            cat = pd.DataFrame(columns=CATALOG_COLUMNS)
+
+        files = [i.name for i in self.rhd_files]
+        cat = cat[cat.index.isin(files)]
+        stale = []
+        for f in files:
+            st = os.stat(self.rhd_dir / f)
+            if f not in cat.index or cat.at[f, 'size'] != st.st_size or cat.at[f, 'mtime'] != st.st_mtime:
+                stale.append(f)
+
+        if len(stale) > 0:
+            paths = [self.rhd_dir / f for f in stale]
+            n_jobs = min(get_n_jobs(self.n_jobs), len(stale))
+            if n_jobs == 1:
+                rows = [scan_rhd(f, stream_name) for f in paths]
+            else:
+                with ProcessPoolExecutor(n_jobs) as pool:
+                    rows = list(pool.map(scan_rhd, paths, [stream_name] * len(paths)))
+            new = pd.DataFrame(rows, index=stale, columns=CATALOG_COLUMNS)
+            cat = cat.drop(index=stale, errors='ignore')
+            cat = pd.concat([cat, new]) if len(cat) > 0 else new
+            cat = cat.sort_index()
+            cat.to_csv(path)
+
+        cat = cat.sort_index()
+        n = cat['num_samples'].to_numpy(dtype=np.int64)
+        cat['offset'] = np.cumsum(n) - n
+        self._catalogs[stream_name] = cat
+        return cat
+
+    def choose_and_concat(self, t1, t2, stream_name='RHD2000 amplifier channel'):
+        """
+        Concatenate the files covering the frame range [t1, t2) and slice them.
+
+        :param t1: start frame over the whole folder
+        :param t2: end frame (exclusive)
+        :param stream_name: the neo stream to load
+        :return: the sliced recording
+        """
+        cat = self.catalog(stream_name)
+        offsets = cat['offset'].to_numpy()
+        total = offsets[-1] + cat['num_samples'].iat[-1] if len(cat) > 0 else 0
+        if not 0 <= t1 < t2 <= total:
+            raise ValueError(f'Frame range [{t1}, {t2}) is out of [0, {total}).')
+        first = np.searchsorted(offsets, t1, 'right') - 1
+        last = np.searchsorted(offsets, t2, 'left')
+        files = [se.read_intan(self.rhd_dir / i, stream_name=stream_name) for i in cat.index[first:last]]
+        rec = concatenate_recordings(files) if len(files) > 1 else files[0]
+        return rec.frame_slice(start_frame=t1 - offsets[first], end_frame=t2 - offsets[first])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import spikeinterface as si
+import spikeinterface.extractors as se
+from probeinterface import write_probeinterface, read_probeinterface
+
+import profiling
+from jobs import get_n_jobs
+from rhd_selection import SignalSelector
+
+STORE_DTYPE = 'int16'
+
+
+def _ingest_file(path, stream_name, store_file, start, num_samples, num_channels, order, shift,
+                 block_size=600000):
+    """
+    Decode one RHD file and write it into its slot of the store, in blocks to bound the memory.
+    """
+    rec = se.read_intan(path, stream_name=stream_name)
+    assert rec.get_num_samples(0) == num_samples, f'{path} changed during the ingest.'
+    out = np.memmap(store_file, dtype=STORE_DTYPE, mode='r+', shape=(num_samples, num_channels),
+                    offset=start * num_channels * np.dtype(STORE_DTYPE).itemsize)
+    for i in range(0, num_samples, block_size):
+        with profiling.chunk('read_intan'):
+            tr = rec.get_traces(start_frame=i, end_frame=min(i + block_size, num_samples))
+        out[i: i + len(tr)] = (tr[:, order].astype(np.int32) - shift).astype(STORE_DTYPE)
+    out.flush()
+    del out
+
+
+def ingest(rhd_dir, store_dir, stream_name='RHD2000 amplifier channel', probe=None, n_jobs=None, verbose=False):
+    """
+    Convert a folder of RHD files into one contiguous int16 binary, with channels in probe order.
+
+    The conversion is incremental: files already in the store are skipped and new files are
+    appended at the end, so the existing data is never rewritten.
+
+    :param rhd_dir: folder of the .rhd files
+    :param store_dir: folder of the store, containing traces.raw, store.json and probe.json
+    :param stream_name: the neo stream to ingest
+    :param probe: the probe whose device channel indices map the channels, by default probe.get_probe()
+    :param n_jobs: number of processes for decoding, -1 or None for all the cores
+    :param verbose: print the files being ingested
+    :return: the store folder
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    store_file = store_dir / 'traces.raw'
+    meta_file = store_dir / 'store.json'
+
+    cat = SignalSelector(rhd_dir, stream_name=stream_name, n_jobs=n_jobs).data
+    if len(cat) == 0:
+        raise FileNotFoundError(f'No RHD files in {rhd_dir}.')
+    if cat['channel_ids'].nunique() != 1 or cat['sampling_frequency'].nunique() != 1:
+        raise ValueError('The RHD files have different channels or sampling rates.')
+    channel_ids = np.array(cat['channel_ids'].iat[0].split(' '))
+
+    if meta_file.exists():
+        with open(meta_file) as f:
+            meta = json.load(f)
+    else:
+        if probe is None:
+            from probe import get_probe
+            probe = get_probe()
+        order = np.asarray(probe.device_channel_indices)
+        first = se.read_intan(Path(rhd_dir) / cat.index[0], stream_name=stream_name)
+        # intan amplifier data is unsigned, shift it to be signed around zero
+        shift = 32768 if first.get_dtype() == np.uint16 else 0
+        gains = first.get_channel_gains()[order]
+        offsets = first.get_channel_offsets()[order] + gains * shift
+        meta = {
+            'sampling_frequency': float(cat['sampling_frequency'].iat[0]),
+            'num_channels': len(order),
+            'dtype': STORE_DTYPE,
+            'stream_name': stream_name,
+            'channel_ids': channel_ids[order].tolist(),
+            'channel_order': order.tolist(),
+            'shift': shift,
+            'gain_to_uV': gains.tolist(),
+            'offset_to_uV': offsets.tolist(),
+            'num_samples': 0,
+            'files': [],
+        }
+        mapped = probe.copy()
+        mapped.set_device_channel_indices(np.arange(len(order)))
+        write_probeinterface(store_dir / 'probe.json', mapped)
+        store_file.touch()
+
+    if sorted(meta['channel_ids']) != sorted(channel_ids.tolist()):
+        raise ValueError('The RHD files do not match the channels of the store.')
+    done = {i['name']: i for i in meta['files']}
+    for name in done:
+        if name not in cat.index or cat.at[name, 'size'] != done[name]['size'] \
+                or cat.at[name, 'mtime'] != done[name]['mtime']:
+            raise ValueError(f'{name} has been modified or removed since ingested, the store needs a rebuild.')
+    new = [i for i in cat.index if i not in done]
+    if len(new) == 0:
+        return store_dir
+    if len(done) > 0 and new[0] < max(done):
+        raise ValueError(f'{new[0]} comes before the ingested files, the store needs a rebuild.')
+
+    # extend the store first so that every file can be written into its own slot
+    num_channels = meta['num_channels']
+    start = meta['num_samples']
+    entries = []
+    for name in new:
+        n = int(cat.at[name, 'num_samples'])
+        entries.append({'name': name, 'size': int(cat.at[name, 'size']), 'mtime': float(cat.at[name, 'mtime']),
+                        'start': start, 'num_samples': n})
+        start += n
+    with open(store_file, 'r+b') as f:
+        f.truncate(start * num_channels * np.dtype(STORE_DTYPE).itemsize)
+
+    args = [(Path(rhd_dir) / e['name'], stream_name, store_file, e['start'], e['num_samples'], num_channels,
+             meta['channel_order'], meta['shift']) for e in entries]
+    if verbose:
+        print(f'Ingesting {len(args)} RHD files into {store_dir}.')
+    n_jobs = min(get_n_jobs(n_jobs), len(args))
+    if n_jobs <= 1:
+        for a in args:
+            _ingest_file(*a)
+    else:
+        with ProcessPoolExecutor(n_jobs) as pool:
+            [*pool.map(_ingest_file, *zip(*args))]
+
+    meta['files'] += entries
+    meta['num_samples'] = start
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+    return store_dir
+
+
+def read_store(store_dir):
+    """
+    Open an ingested store as a memory-mapped recording with the probe attached.
+
+    :param store_dir: the folder given to ingest
+    :return: a binary recording, the gains and offsets convert it to uV
+    """
+    store_dir = Path(store_dir)
+    with open(store_dir / 'store.json') as f:
+        meta = json.load(f)
+    rec = si.read_binary(store_dir / 'traces.raw', sampling_frequency=meta['sampling_frequency'],
+                         num_channels=meta['num_channels'], dtype=meta['dtype'], channel_ids=meta['channel_ids'],
+                         time_axis=0, gain_to_uV=meta['gain_to_uV'], offset_to_uV=meta['offset_to_uV'])
+    probe = read_probeinterface(store_dir / 'probe.json')
+    return rec.set_probegroup(probe)
+
+
+if __name__ == '__main__':
+    ingest('data', 'data/store', verbose=True)
+    print(read_store('data/store'))
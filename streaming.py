@@ -0,0 +1,314 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.signal
+import spikeinterface.extractors as se
+from probeinterface import write_probeinterface
+
+import profiling
+from filters import cascade_sos, sos_margin
+from mech_noise import clean_mechanical_noise, noise_mask_from_energy
+from preproc import load_preprocessed, local_neighbors
+from reference import LocalReference
+from rhd_selection import SignalSelector
+
+
+class StreamingPreprocessor:
+    """
+    Preprocess a session while it's recorded, appending each RHD file to the preprocessed binary once Intan
+    has moved on to the next one.
+
+    The filter keeps its state from one file to the next: the causal filter carries the final conditions of
+    sosfilt, the zero-phase one holds back a margin of frames until the data after them has arrived, so the
+    binary is what preprocess writes for the whole session. The reference is taken frame by frame.
+    The energy of the mechanical noise is scored on the raw input like run_qc, as the intervals complete, but the
+    mask needs the statistics of the whole session as in clean_mechanical_noise, so it's applied when the binary
+    is loaded by load_stream.
+
+    A folder holding a stream with the same parameters is resumed, from the state saved after each file.
+
+    :param rhd_dir: the folder Intan writes into
+    :param folder: the output folder, read by load_stream or preproc.load_preprocessed
+    :param stream_name: the neo stream to preprocess
+    :param probe: a probe or the name of one in the probe registry, None to keep the files' own
+    :param channel_ids: the channels to keep, e.g. without the bad ones, by default all of them
+    :param low: the low cutoff in Hz
+    :param high: the high cutoff in Hz
+    :param order: the Butterworth order
+    :param iterations: the number of times the bandpass is applied
+    :param direction: 'forward' for causal, 'forward-backward' for zero phase with a delay of the filter margin
+    :param reference: 'global', 'local' or None
+    :param operator: 'median' or 'average'
+    :param local_radius: the excluding and including radius in um for the local reference
+    :param window: the window in frames of the mechanical noise energy
+    :param interval: the step in frames of the mechanical noise energy
+    :param noise_cap: the default threshold of the mechanical noise, see noise_mask_from_energy
+    :param chunk_duration: the duration of the blocks read from each file
+    :param n_jobs: the threads of the local reference
+    """
+
+    def __init__(self, rhd_dir, folder, stream_name='RHD2000 amplifier channel', probe='my_probe', channel_ids=None,
+                 low=300, high=6000, order=5, iterations=1, direction='forward', reference='global',
+                 operator='median', local_radius=(30, 55), window=2000, interval=200, noise_cap=2.5,
+                 chunk_duration=10., n_jobs=1):
+        assert direction in ('forward', 'forward-backward')
+        self.rhd_dir = Path(rhd_dir)
+        self.folder = Path(folder)
+        self.stream_name = stream_name
+        self.probe = probe
+        self.channel_ids = channel_ids
+        self.chunk_duration = chunk_duration
+        self.n_jobs = n_jobs
+        self.params = dict(low=low, high=high, order=order, iterations=iterations, direction=direction,
+                           reference=reference, operator=operator, local_radius=list(local_radius))
+        self.noise = dict(window=window, interval=interval, noise_cap=noise_cap)
+        self.selector = SignalSelector(self.rhd_dir, stream_name, live=True)
+        self.files = []
+        self.done = 0
+        self.lock = threading.Lock()
+        self._ready = False
+        self._output = None
+
+        meta = self.folder / 'preprocess.json'
+        if meta.exists():
+            meta = json.loads(meta.read_text())
+            stream = meta.get('stream', {})
+            if meta['params'] == self.params and stream.get('noise') == self.noise and \
+                    stream.get('channel_ids') == channel_ids and (self.folder / 'stream_state.npz').exists():
+                self._resume(stream)
+        if not self._ready:
+            # a stream of other parameters or without its state starts over
+            for name in ('traces_seg0.raw', 'stream_state.npz', 'noise_energy.npy', 'preprocess.json'):
+                (self.folder / name).unlink(missing_ok=True)
+
+    def _open(self, name):
+        rec = se.read_intan(self.rhd_dir / name, stream_name=self.stream_name)
+        if self.probe is not None:
+            from probe import get_probe
+            rec = rec.set_probe(get_probe(self.probe) if isinstance(self.probe, str) else self.probe)
+        if self.channel_ids is not None:
+            rec = rec.channel_slice(self.channel_ids)
+        return rec
+
+    def _setup(self, rec):
+        self.fs = rec.get_sampling_frequency()
+        self.ids = [str(i) for i in rec.get_channel_ids()]
+        self.num_channels = len(self.ids)
+        p = self.params
+        self.sos = cascade_sos(p['low'], p['high'], self.fs, p['order'], p['iterations'])
+        self.margin = sos_margin(self.sos, self.fs)
+        self.local_ref = LocalReference(local_neighbors(rec, p['local_radius']), p['operator'], self.n_jobs) \
+            if p['reference'] == 'local' else None
+        self.meta = {
+            'sampling_frequency': self.fs,
+            'num_channels': self.num_channels,
+            'dtype': 'float32',
+            'channel_ids': self.ids,
+            'files': ['traces_seg0.raw'],
+            'gain_to_uV': rec.get_channel_gains().tolist() if rec.has_scaled() else None,
+            'params': self.params,
+        }
+        # the filter state: the final conditions of the causal filter, or the raw frames from done - margin
+        self.zi = np.zeros((len(self.sos), 2, self.num_channels))
+        self.tail = np.zeros((0, self.num_channels), dtype=np.float32)
+        # the squared channel mean from sq_start, for the intervals not scored yet
+        self.sq = np.zeros(0)
+        self.sq_start = 0
+        self.energy = []
+        self.folder.mkdir(parents=True, exist_ok=True)
+        if rec.has_probe():
+            write_probeinterface(self.folder / 'probe.json', rec.get_probegroup())
+        self._ready = True
+
+    def _resume(self, stream):
+        self._setup(self._open(stream['files'][0]))
+        state = np.load(self.folder / 'stream_state.npz')
+        self.zi, self.tail, self.sq = state['zi'], state['tail'], state['sq']
+        self.sq_start = int(state['sq_start'])
+        self.energy = list(state['energy'])
+        self.files = list(stream['files'])
+        self.done = int(stream['num_samples'])
+        # drop what was appended after the last state was saved
+        os.truncate(self.folder / 'traces_seg0.raw', self.done * self.num_channels * 4)
+
+    def _filter(self, x, final=False):
+        if self.params['direction'] == 'forward':
+            if len(x) == 0:
+                return x
+            y, self.zi = scipy.signal.sosfilt(self.sos, x, axis=0, zi=self.zi)
+            return y.astype(np.float32)
+        # the frames are filtered once the margin after them is there, with the margin before them
+        buf = np.concatenate([self.tail, x])
+        start = self.done - min(self.done, self.margin)
+        end = start + len(buf) if final else start + len(buf) - self.margin
+        if end <= self.done or (not final and len(buf) <= 3 * (2 * len(self.sos) + 1)):
+            self.tail = buf
+            return np.zeros((0, self.num_channels), dtype=np.float32)
+        y = scipy.signal.sosfiltfilt(self.sos, buf, axis=0)[self.done - start: end - start]
+        self.tail = buf[max(0, end - self.margin - start):]
+        return y.astype(np.float32)
+
+    def _reference(self, y):
+        if self.params['reference'] == 'global':
+            op = np.median if self.params['operator'] == 'median' else np.mean
+            y -= op(y, axis=1, keepdims=True)
+        elif self.params['reference'] == 'local':
+            self.local_ref(y)
+        return y
+
+    def _score(self, x, final=False):
+        # the intervals of interval_energy whose window is complete
+        interval, window = self.noise['interval'], self.noise['window']
+        lo, hi = (interval - window) // 2, (interval + window) // 2
+        self.sq = np.concatenate([self.sq, np.square(x.mean(axis=1, dtype=np.float64))])
+        n = self.sq_start + len(self.sq)
+        j0 = len(self.energy)
+        j1 = -(-n // interval) if final else max(j0, (n - hi) // interval + 1)
+        if j1 > j0:
+            cum = np.zeros(len(self.sq) + 1)
+            np.cumsum(self.sq, out=cum[1:])
+            starts = np.arange(j0, j1) * interval
+            idx0 = np.clip(starts + lo, 0, n) - self.sq_start
+            idx1 = np.clip(starts + hi, 0, n) - self.sq_start
+            self.energy += list(np.maximum(cum[idx1] - cum[np.minimum(idx0, idx1)], 0))
+            keep = max(0, j1 * interval + lo) - self.sq_start
+            self.sq = self.sq[keep:]
+            self.sq_start += keep
+
+    def _push(self, x, final=False):
+        # the noise is common to the channels, scored on the input as run_qc does before the reference removes it
+        self._score(x, final)
+        y = self._reference(self._filter(x, final))
+        self._output.write(y.tobytes())
+        self.done += len(y)
+
+    def _save(self, final=False):
+        self._output.flush()
+        np.save(self.folder / 'noise_energy.npy', np.asarray(self.energy))
+        tmp = self.folder / 'stream_state.tmp.npz'
+        np.savez(tmp, zi=self.zi, tail=self.tail, sq=self.sq, sq_start=self.sq_start, energy=np.asarray(self.energy))
+        tmp.replace(self.folder / 'stream_state.npz')
+        meta = dict(self.meta, stream={'files': self.files, 'num_samples': self.done, 'final': final,
+                                       'noise': self.noise, 'channel_ids': self.channel_ids})
+        (self.folder / 'preprocess.json').write_text(json.dumps(meta, indent=2))
+
+    def _process(self, name):
+        rec = self._open(name)
+        if not self._ready:
+            self._setup(rec)
+        if rec.get_sampling_frequency() != self.fs or [str(i) for i in rec.get_channel_ids()] != self.ids:
+            raise ValueError(f'{name} does not have the sampling frequency or the channels of {self.files[0]}.')
+        step = max(1, int(self.chunk_duration * self.fs))
+        n = rec.get_num_samples()
+        with profiling.stage('stream.file', file=name, frames=n):
+            for a in range(0, n, step):
+                self._push(rec.get_traces(start_frame=a, end_frame=min(n, a + step)).astype(np.float32))
+            self.files.append(name)
+            self._save()
+
+    def update(self, final=False):
+        """
+        Preprocess the files completed since the last update.
+
+        :param final: the acquisition is over, also take the newest file and flush the filter
+        :return: the names of the files preprocessed
+        """
+        with self.lock:
+            self.selector.live = not final
+            cat = self.selector.catalog(self.stream_name, refresh=True)
+            new = [f for f in cat.index if f not in self.files]
+            if self.files and any(f < self.files[-1] for f in new):
+                raise ValueError(f'{[f for f in new if f < self.files[-1]]} sort before the files preprocessed.')
+            if self._output is None and (new or final and self._ready):
+                self.folder.mkdir(parents=True, exist_ok=True)
+                # appending only to the frames of a resumed stream, which _resume truncated to what was saved
+                self._output = open(self.folder / 'traces_seg0.raw', 'ab' if self.files else 'wb')
+            for f in new:
+                self._process(f)
+            if final and self._ready:
+                self._push(np.zeros((0, self.num_channels), dtype=np.float32), final=True)
+                self._save(final=True)
+            if final and self._output is not None:
+                self._output.close()
+                self._output = None
+            return new
+
+    def run(self, poll=10., idle_timeout=None, stop=None, verbose=False):
+        """
+        Watch the folder until stop is set or no file is completed for idle_timeout seconds, then take the last
+        file and flush the filter.
+
+        :param poll: the seconds between two scans of the folder
+        :param idle_timeout: the seconds without a new file to end the session, None to wait for stop only
+        :param stop: a threading.Event ending the session
+        :param verbose: print each file preprocessed
+        :return: the preprocessed recording
+        """
+        stop = stop or threading.Event()
+        last = time.monotonic()
+        while not stop.is_set():
+            new = self.update()
+            if new:
+                last = time.monotonic()
+                if verbose:
+                    print(f'stream: {", ".join(new)}, {self.done / self.fs:.0f}s preprocessed')
+            elif idle_timeout is not None and time.monotonic() - last > idle_timeout:
+                break
+            stop.wait(poll)
+        self.update(final=True)
+        if verbose:
+            print(f'stream: done, {len(self.files)} files, {self.done / self.fs:.0f}s')
+        return self.recording()
+
+    def recording(self, noise_cap=None):
+        """
+        The preprocessed recording so far, see load_stream.
+        """
+        return load_stream(self.folder, noise_cap)
+
+
+def load_stream(folder, noise_cap=None, clean=True):
+    """
+    Open a folder written by StreamingPreprocessor, with its mechanical noise cleaned.
+
+    :param folder: the output folder
+    :param noise_cap: the threshold of the mechanical noise, by default the one of the stream
+    :param clean: clean the mechanical noise
+    :return: the recording of the frames preprocessed so far
+    """
+    folder = Path(folder)
+    recording = load_preprocessed(folder)
+    if not clean:
+        return recording
+    noise = json.loads((folder / 'preprocess.json').read_text())['stream']['noise']
+    energy = np.load(folder / 'noise_energy.npy')
+    mask = noise_mask_from_energy(energy, noise['noise_cap'] if noise_cap is None else noise_cap)
+    # the intervals at the end of a stream in progress are not scored yet
+    mask = np.concatenate([mask, np.zeros(max(0, -(-recording.get_num_samples() // noise['interval']) - len(mask)),
+                                          dtype=bool)])
+    return clean_mechanical_noise(recording, window=noise['window'], interval=noise['interval'],
+                                  noise_cap=noise['noise_cap'], noise_mask=[mask])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Preprocess the RHD files of a session as they are written.')
+    parser.add_argument('rhd_dir')
+    parser.add_argument('folder')
+    parser.add_argument('--probe', default='my_probe')
+    parser.add_argument('--direction', default='forward', choices=['forward', 'forward-backward'])
+    parser.add_argument('--reference', default='global')
+    parser.add_argument('--poll', type=float, default=10.)
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='end the session after this many seconds without a new file')
+    args = parser.parse_args()
+    stream = StreamingPreprocessor(args.rhd_dir, args.folder, probe=args.probe, direction=args.direction,
+                                   reference=args.reference)
+    try:
+        stream.run(args.poll, args.idle_timeout, verbose=True)
+    except KeyboardInterrupt:
+        stream.update(final=True)
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from cellexplorer import EnginePool, MockBackend
+
+
+def test_queue_beyond_pool_size():
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def work(x):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(.05)
+        with lock:
+            running[0] -= 1
+        return x * 2
+
+    pool = EnginePool(MockBackend({'work': work}), size=2)
+    futures = [pool.submit('work', i) for i in range(8)]
+    assert [f.result() for f in futures] == [i * 2 for i in range(8)]
+    assert peak[0] == 2
+    assert sum(s['calls'] for s in pool.stats) == 8
+    assert not any(s['busy'] for s in pool.stats)
+    pool.close()
+
+
+def test_retry_on_restarted_engine_after_crash():
+    pool = None
+    crashes = []
+
+    def flaky(x):
+        # the first call takes its engine down with it
+        if not crashes:
+            crashes.append(x)
+            pool.engines[0].kill()
+            raise RuntimeError('engine terminated')
+        return x + 1
+
+    pool = EnginePool(MockBackend({'flaky': flaky}), size=1, retries=1)
+    first = pool.engines[0]
+    assert pool.call('flaky', 1) == 2
+    assert pool.engines[0] is not first and first.dead
+    assert pool.stats[0]['failures'] == 1 and pool.stats[0]['restarts'] == 1 and pool.stats[0]['calls'] == 1
+    pool.close()
+
+
+def test_crash_after_all_retries():
+    pool = None
+
+    def crash():
+        pool.engines[0].kill()
+        raise RuntimeError('engine terminated')
+
+    pool = EnginePool(MockBackend({'crash': crash, 'ok': lambda: 'ok'}), size=1, retries=2)
+    with pytest.raises(RuntimeError):
+        pool.call('crash')
+    assert pool.stats[0]['failures'] == 3 and pool.stats[0]['restarts'] == 3
+    # the engine is usable again
+    assert pool.call('ok') == 'ok'
+    pool.close()
+
+
+def test_error_of_a_live_engine_is_not_retried():
+    calls = []
+
+    def bad():
+        calls.append(1)
+        raise ValueError('bad input')
+
+    pool = EnginePool(MockBackend({'bad': bad}), size=1, retries=3)
+    with pytest.raises(ValueError):
+        pool.call('bad')
+    assert len(calls) == 1 and pool.stats[0]['restarts'] == 0
+    pool.close()
+
+
+def test_health_report():
+    release = threading.Event()
+    pool = EnginePool(MockBackend({'wait': lambda: release.wait(5), 'ok': lambda: 'ok'}), size=3)
+    pool.call('ok')
+    busy = pool.submit('wait')
+    while not any(s['busy'] for s in pool.stats):
+        time.sleep(.01)
+    b = [s['index'] for s in pool.stats if s['busy']][0]
+    d = (b + 1) % 3
+    dead = pool.engines[d]
+    dead.kill()
+
+    report = pool.health()
+    assert [r['index'] for r in report] == [0, 1, 2]
+    assert report[b]['alive'] is None and report[b]['busy']
+    # the dead idle engine is found and restarted
+    assert report[d]['alive'] is False and report[d]['restarts'] == 1
+    assert pool.engines[d] is not dead
+    assert report[3 - b - d]['alive'] is True
+
+    release.set()
+    busy.result()
+    report = pool.health()
+    assert all(r['alive'] for r in report)
+    assert sum(r['calls'] for r in report) == 2
+    pool.close()
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+import spikeinterface as si
+import spikeinterface.preprocessing as spre
+
+from cache import DiskCache
+from kilosort import invalidate_sortings, kilosort, threshold_sorter
+
+
+@pytest.fixture
+def recording():
+    # the sorter expects preprocessed traces, centered around zero
+    return spre.bandpass_filter(si.generate_recording(num_channels=8, durations=[5.], seed=0), 300, 6000)
+
+
+def counting_sorter(calls):
+    def sorter(recording, output_folder, **kwargs):
+        calls.append(kwargs)
+        return threshold_sorter(recording, output_folder, **kwargs)
+    return sorter
+
+
+def test_threshold_sorter_writes_kilosort_files(recording, tmp_path):
+    sorting = threshold_sorter(recording, tmp_path, detect_threshold=3.)
+    out = tmp_path / 'sorter_output'
+    times = np.load(out / 'spike_times.npy')
+    clusters = np.load(out / 'spike_clusters.npy')
+    assert times.shape == (len(clusters), 1) and times.dtype == np.uint64
+    assert len(clusters) > 0 and np.all(np.diff(times[:, 0].astype(np.int64)) >= 0)
+    assert np.load(out / 'spike_templates.npy').shape == (len(clusters), 1)
+    assert np.load(out / 'amplitudes.npy').shape == (len(clusters), 1)
+    assert np.load(out / 'templates.npy').shape == (8, 60, 8)
+    assert np.array_equal(np.load(out / 'channel_map.npy')[:, 0], np.arange(8))
+    assert np.allclose(np.load(out / 'channel_positions.npy'), recording.get_channel_locations())
+    labels = pd.read_csv(out / 'cluster_KSLabel.tsv', sep='\t')
+    assert list(labels.columns) == ['cluster_id', 'KSLabel'] and len(labels) == 8
+    assert 'n_channels_dat = 8' in (out / 'params.py').read_text()
+    # the same spikes as the sorting returned
+    assert sorting.get_total_num_spikes() == {u: np.sum(clusters == u) for u in sorting.unit_ids}
+    assert np.array_equal(np.sort(sorting.get_unit_spike_train(0)), times[clusters == 0, 0].astype(np.int64))
+
+
+def test_sorting_cache_miss_then_hit(recording, tmp_path):
+    cache = DiskCache(tmp_path / 'cache')
+    calls = []
+    sorter = counting_sorter(calls)
+    a = kilosort(recording, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=3.)
+    b = kilosort(recording, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=3.)
+    assert len(calls) == 1
+    assert a.get_annotation('sorter_output_folder') == b.get_annotation('sorter_output_folder')
+    assert np.array_equal(a.get_unit_spike_train(0), b.get_unit_spike_train(0))
+    assert cache.info(cache.list().index[0])['hits'] == 1
+
+    # other parameters or another recording are other entries
+    kilosort(recording, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=4.)
+    kilosort(recording.channel_slice(recording.channel_ids[:4]), cache=cache, sorter_name='threshold',
+             sorter=sorter, detect_threshold=3.)
+    assert len(calls) == 3 and len(cache.list()) == 3
+
+
+def test_invalidate_sortings(recording, tmp_path):
+    cache = DiskCache(tmp_path / 'cache')
+    calls = []
+    sorter = counting_sorter(calls)
+    other = recording.channel_slice(recording.channel_ids[:4])
+    kilosort(recording, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=3.)
+    kilosort(other, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=3.)
+    kilosort(recording, cache=cache, sorter_name='other', sorter=sorter, detect_threshold=3.)
+
+    assert len(invalidate_sortings(cache, recording=other)) == 1
+    assert len(cache.list()) == 2
+    assert len(invalidate_sortings(cache, sorter_name='other')) == 1
+    kilosort(recording, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=3.)
+    assert len(calls) == 3
+    assert len(invalidate_sortings(cache)) == 1
+    kilosort(recording, cache=cache, sorter_name='threshold', sorter=sorter, detect_threshold=3.)
+    assert len(calls) == 4
@@ -0,0 +1,219 @@
+import json
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from cache import fingerprint_recording, fingerprint_sorting, make_key
+from jobs import chunk_ranges, get_chunk_size, run_chunks
+from probe import channel_neighbors
+
+
+class WaveformStore:
+    """
+    The waveforms of a random subset of the spikes of each unit, on the channels around its peak channel,
+    kept in one memory-mapped file per unit.
+
+    Opening a new store only chooses the spikes and reads a few of them to find the peak channels, the waveforms
+    of a unit are extracted the first time they're asked for, or for many units at once with extract. An
+    extraction reads the recording once, in chunks taken in order, and only the chunks holding spikes of the
+    units to extract.
+    A store reopened with the same parameters, recording and sorting reuses what was extracted.
+
+    :param recording: the preprocessed recording, e.g. from preproc.load_preprocessed
+    :param sorting: the sorting of the recording
+    :param folder: the folder of the store
+    :param ms_before: the ms before each spike
+    :param ms_after: the ms after each spike
+    :param max_spikes_per_unit: the cap of spikes extracted per unit
+    :param radius_um: the channels within this distance of the peak channel are kept
+    :param peak_channels: the peak channel index of each unit, e.g. from the templates of the sorter,
+        by default estimated from num_spikes_for_peak spikes per unit on all the channels
+    :param num_spikes_for_peak: the spikes per unit used to estimate the peak channels
+    :param seed: the seed of the random choice of spikes
+    :param n_jobs: the threads extracting the chunks
+    :param chunk_duration: the duration of the chunks read
+    """
+
+    def __init__(self, recording, sorting, folder, ms_before=1., ms_after=2., max_spikes_per_unit=500,
+                 radius_um=50., peak_channels=None, num_spikes_for_peak=20, seed=0, n_jobs=-1,
+                 chunk_duration='10s'):
+        self.recording = recording
+        self.sorting = sorting
+        self.folder = Path(folder)
+        self.n_jobs = n_jobs
+        self.chunk_size = get_chunk_size(recording, chunk_duration)
+        fs = recording.get_sampling_frequency()
+        self.before = int(ms_before * fs / 1000)
+        self.after = int(ms_after * fs / 1000)
+        self.unit_ids = list(sorting.get_unit_ids())
+        self._index = {u: i for i, u in enumerate(self.unit_ids)}
+        self.dtype = recording.get_dtype()
+        self.lock = threading.Lock()
+        params = {'ms_before': ms_before, 'ms_after': ms_after, 'max_spikes_per_unit': max_spikes_per_unit,
+                  'radius_um': radius_um, 'seed': seed, 'num_spikes_for_peak': num_spikes_for_peak,
+                  'peak_channels': None if peak_channels is None else [int(i) for i in peak_channels],
+                  'unit_ids': [str(u) for u in self.unit_ids], 'num_channels': recording.get_num_channels(),
+                  'num_samples': [recording.get_num_samples(s) for s in range(recording.get_num_segments())],
+                  # re-sorting or preprocessing again into the same folder doesn't serve the old waveforms
+                  'recording': make_key(fingerprint_recording(recording)),
+                  'sorting': make_key(fingerprint_sorting(sorting))}
+
+        info = self.folder / 'info.json'
+        if info.exists():
+            self.info = json.loads(info.read_text())
+            if self.info['params'] != params:
+                shutil.rmtree(self.folder)
+        if not info.exists():
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self._select(max_spikes_per_unit, seed)
+            if peak_channels is None:
+                peak_channels = self._peak_channels(num_spikes_for_peak)
+            self._sparsity(peak_channels, radius_um)
+            self.info = {'params': params, 'extracted': []}
+            self._save_info()
+        selection = np.load(self.folder / 'selection.npz')
+        self.selection = {u: (selection[f'{i}:segments'], selection[f'{i}:frames'], selection[f'{i}:channels'])
+                          for i, u in enumerate(self.unit_ids)}
+
+    def _save_info(self):
+        (self.folder / 'info.json').write_text(json.dumps(self.info, indent=2))
+
+    def _select(self, max_spikes_per_unit, seed):
+        rng = np.random.default_rng(seed)
+        self._spikes = {}
+        for u in self.unit_ids:
+            segments, frames = [], []
+            for s in range(self.sorting.get_num_segments()):
+                t = self.sorting.get_unit_spike_train(u, segment_index=s)
+                # spikes whose window is complete
+                t = t[(t >= self.before) & (t < self.recording.get_num_samples(s) - self.after)]
+                segments.append(np.full(len(t), s))
+                frames.append(t)
+            segments, frames = np.concatenate(segments), np.concatenate(frames)
+            if len(frames) > max_spikes_per_unit:
+                keep = np.sort(rng.choice(len(frames), max_spikes_per_unit, replace=False))
+                segments, frames = segments[keep], frames[keep]
+            self._spikes[u] = segments.astype(np.int64), frames.astype(np.int64)
+
+    def _peak_channels(self, num_spikes):
+        # the channel of the largest mean trough at the spike times, on a few spikes of each unit
+        num_channels = self.recording.get_num_channels()
+        spikes = {u: (s[:num_spikes], f[:num_spikes]) for u, (s, f) in self._spikes.items()}
+        channels = np.arange(num_channels)
+        amplitude = np.zeros((len(self.unit_ids), num_channels))
+
+        def add(unit_index, snippets, rows):
+            with self.lock:
+                amplitude[unit_index] += np.abs(snippets.min(axis=1)).sum(axis=0)
+
+        self._walk(spikes, {u: channels for u in spikes}, add)
+        return amplitude.argmax(axis=1)
+
+    def _sparsity(self, peak_channels, radius_um):
+        neighbors = channel_neighbors(self.recording.get_channel_locations(), radius=radius_um)
+        arrays = {}
+        for i, u in enumerate(self.unit_ids):
+            peak = int(peak_channels[i])
+            arrays[f'{i}:segments'], arrays[f'{i}:frames'] = self._spikes[u]
+            arrays[f'{i}:channels'] = np.sort(np.append(neighbors[peak], peak)).astype(np.int64)
+        np.savez(self.folder / 'selection.npz', **arrays)
+
+    def _walk(self, spikes, channels, func, progress=None, cancel=None):
+        # read the chunks holding the spikes in order and give func the snippets of each unit in the chunk
+        units = list(spikes)
+        segments = np.concatenate([spikes[u][0] for u in units])
+        frames = np.concatenate([spikes[u][1] for u in units])
+        unit_index = np.concatenate([np.full(len(spikes[u][1]), self._index[u]) for u in units])
+        rows = np.concatenate([np.arange(len(spikes[u][1])) for u in units])
+        order = np.lexsort((frames, segments))
+        segments, frames, unit_index, rows = segments[order], frames[order], unit_index[order], rows[order]
+        offsets = np.arange(-self.before, self.after)
+
+        def work(segment, start, end):
+            lo = np.searchsorted(segments, segment, side='left')
+            hi = np.searchsorted(segments, segment, side='right')
+            a = lo + np.searchsorted(frames[lo: hi], start)
+            b = lo + np.searchsorted(frames[lo: hi], end)
+            first = max(0, start - self.before)
+            traces = self.recording.get_traces(segment_index=segment, start_frame=first,
+                                               end_frame=min(self.recording.get_num_samples(segment),
+                                                             end + self.after))
+            for i in np.unique(unit_index[a: b]):
+                sel = a + np.flatnonzero(unit_index[a: b] == i)
+                index = frames[sel, None] - first + offsets
+                func(i, traces[index[:, :, None], channels[self.unit_ids[i]][None, None, :]], rows[sel])
+
+        chunks = chunk_ranges(self.recording, self.chunk_size)
+        keys = segments * (frames.max(initial=0) + 1) + frames
+        count = np.searchsorted(keys, [c[0] * (frames.max(initial=0) + 1) + c[2] for c in chunks]) - \
+            np.searchsorted(keys, [c[0] * (frames.max(initial=0) + 1) + c[1] for c in chunks])
+        chunks = [c for c, k in zip(chunks, count) if k > 0]
+        run_chunks(work, chunks, self.n_jobs, progress, cancel)
+
+    def spikes(self, unit_id):
+        """
+        The spikes of a unit in the store.
+
+        :return: the segment indices and the frames
+        """
+        segments, frames, _ = self.selection[unit_id]
+        return segments, frames
+
+    def channels(self, unit_id):
+        """
+        The channel ids the waveforms of a unit are kept on.
+        """
+        return self.recording.get_channel_ids()[self.selection[unit_id][2]]
+
+    def extracted(self, unit_id):
+        return str(unit_id) in self.info['extracted']
+
+    def extract(self, unit_ids=None, progress=None, cancel=None):
+        """
+        Extract the waveforms of the units not extracted yet, in one pass over the recording.
+
+        :param unit_ids: the units, by default all of them
+        :param progress: called as progress(done, total) after each chunk
+        :param cancel: a threading.Event to stop the extraction, the units in progress are then left out
+        """
+        unit_ids = [u for u in (self.unit_ids if unit_ids is None else unit_ids) if not self.extracted(u)]
+        if not unit_ids:
+            return
+        n_samples = self.before + self.after
+        files = {}
+        for u in unit_ids:
+            _, frames, channels = self.selection[u]
+            files[u] = np.lib.format.open_memmap(self.folder / f'waveforms_{self._index[u]}.npy', mode='w+',
+                                                 dtype=self.dtype, shape=(len(frames), n_samples, len(channels)))
+
+        def write(unit_index, snippets, rows):
+            files[self.unit_ids[unit_index]][rows] = snippets
+
+        self._walk({u: self.selection[u][:2] for u in unit_ids}, {u: self.selection[u][2] for u in unit_ids},
+                   write, progress, cancel)
+        for f in files.values():
+            f.flush()
+        with self.lock:
+            self.info['extracted'] += [str(u) for u in unit_ids]
+            self._save_info()
+
+    def get_waveforms(self, unit_id):
+        """
+        The waveforms of a unit, extracted if they're not yet.
+
+        :return: a read-only memory map of (spikes, samples, channels)
+        """
+        if not self.extracted(unit_id):
+            self.extract([unit_id])
+        return np.load(self.folder / f'waveforms_{self._index[unit_id]}.npy', mmap_mode='r')
+
+    def get_template(self, unit_id, mode='average'):
+        """
+        The average or median waveform of a unit on its channels.
+        """
+        wf = self.get_waveforms(unit_id)
+        if len(wf) == 0:
+            return np.zeros(wf.shape[1:], dtype=np.float32)
+        return np.median(wf, axis=0) if mode == 'median' else wf.mean(axis=0, dtype=np.float32)